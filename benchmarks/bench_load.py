@@ -0,0 +1,235 @@
+"""
+Load test the voice transport against a simulated FreeSwitch.
+
+Runs a VoiceServerTransport (with a fake AMQP broker) and a
+vxfreeswitch.simulator.FreeSwitchSimulator in one process, keeps
+``--concurrency`` calls in progress until ``--calls`` have been made and
+reports calls per second, call setup latency percentiles, the growth in
+resident memory per concurrent call and the reactor's lag. Nothing leaves
+the machine.
+
+In ``inbound`` mode the simulator calls the transport; the application
+answers with a prompt, the caller enters digits and is played a second
+prompt and hangs up. In ``outbound`` mode the application dials calls
+through the simulator's ESL socket, which answers them after
+``--answer-latency`` seconds (failing ``--failure-rate`` of them); the
+callee hears the message and hangs up.
+
+Setup latency is measured from the call connecting (inbound) or being
+originated (outbound) to the transport's first media command. Memory per
+call includes the simulator's side of each call. Run from the repository
+root (Linux only, as it reads /proc)::
+
+    PYTHONPATH=. python benchmarks/bench_load.py [inbound|outbound] \\
+        [--calls N] [--concurrency N] [--answer-latency S] \\
+        [--failure-rate F] [--fast-parser] [--capture FILE]
+"""
+
+import argparse
+import os
+import time
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, inlineCallbacks, succeed)
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from twisted.python import log
+
+from vumi.message import TransportUserMessage
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxfreeswitch import VoiceServerTransport
+from vxfreeswitch.lag import ReactorLagMonitor
+from vxfreeswitch.simulator import FreeSwitchSimulator
+
+
+INBOUND_SCRIPT = [('media',), ('dtmf', '12#'), ('media',), ('hangup',)]
+OUTBOUND_SCRIPT = [('media',), ('hangup',)]
+
+
+class BenchTransport(VoiceServerTransport):
+    """ A transport with an application built in: messages and events are
+    handled in process rather than published.
+    """
+
+    acks = nacks = 0
+    wait_for = '#'
+
+    def publish_message(self, **kw):
+        kw.setdefault('transport_metadata', {})
+        msg = TransportUserMessage(**kw)
+        if msg['session_event'] == TransportUserMessage.SESSION_CLOSE:
+            self.call_finished()
+        elif msg['session_event'] == TransportUserMessage.SESSION_NEW:
+            self.reply(msg.reply(
+                "Welcome. Enter your PIN followed by the hash key.",
+                helper_metadata={'voice': {'wait_for': self.wait_for}}))
+        else:
+            self.reply(msg.reply("Thank you."))
+        return succeed(None)
+
+    def publish_event(self, **kw):
+        if kw['event_type'] == 'ack':
+            self.acks += 1
+        elif kw['event_type'] == 'nack':
+            self.nacks += 1
+            self.call_finished()
+        return succeed(None)
+
+    def call_finished(self):
+        """ Called when an outbound call ends or fails. """
+
+    def reply(self, msg):
+        reactor.callLater(0, self.handle_outbound_message, msg)
+
+
+class LagSamples(object):
+    """ Stands in for the lag monitor's metric, keeping every sample. """
+
+    def __init__(self):
+        self.samples = []
+
+    def set(self, lag):
+        self.samples.append(lag)
+
+
+class ResourceSampler(object):
+    """ Samples resident memory at peak call concurrency. """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.baseline = rss()
+        self.peak_calls = 0
+        self.peak_rss = self.baseline
+
+    def sample(self):
+        calls = len(self.simulator.calls)
+        if calls >= self.peak_calls:
+            self.peak_calls = calls
+            self.peak_rss = max(self.peak_rss, rss())
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+@inlineCallbacks
+def run(reactor, args):
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+    simulator = FreeSwitchSimulator(
+        None, answer_latency=args.answer_latency,
+        failure_rate=args.failure_rate,
+        script=INBOUND_SCRIPT if args.mode == 'inbound' else OUTBOUND_SCRIPT)
+    server = yield TCP4ServerEndpoint(
+        reactor, 0, backlog=1024, interface='127.0.0.1').listen(simulator)
+    helper = TransportHelper(BenchTransport)
+    helper.setup()
+    transport = yield helper.get_transport({
+        'twisted_endpoint': 'tcp:port=0:backlog=1024:interface=127.0.0.1',
+        'freeswitch_endpoint': 'tcp:127.0.0.1:port=%d' % (
+            server.getHost().port,),
+        'originate_parameters': {
+            'call_url': '{{origination_uuid={uuid}}}sofia/gateway/bench',
+            'exten': '{to_addr}',
+            'cid_name': 'bench',
+            'cid_num': '{from_addr}',
+        },
+        'call_log_level': 'WARNING',
+        'esl_fast_parser': args.fast_parser,
+        'esl_capture_file': args.capture,
+    })
+    simulator.call_endpoint = TCP4ClientEndpoint(
+        reactor, '127.0.0.1', transport.voice_server.getHost().port)
+
+    lag = LagSamples()
+    lag_monitor = ReactorLagMonitor(0.05, metric=lag)
+    sampler = ResourceSampler(simulator)
+    sampling = task.LoopingCall(sampler.sample)
+
+    semaphore = DeferredSemaphore(args.concurrency)
+    done = Deferred()
+    finished = [0]
+
+    def call_finished():
+        semaphore.release()
+        finished[0] += 1
+        if finished[0] == args.calls:
+            done.callback(None)
+
+    def start_call(_, i):
+        if args.mode == 'inbound':
+            d = simulator.start_call(caller_id_number='2783%07d' % (i,))
+            d.addCallback(lambda _: call_finished())
+        else:
+            transport.handle_outbound_message(TransportUserMessage(
+                to_addr='2783%07d' % (i,), from_addr='1234',
+                transport_name=transport.transport_name,
+                transport_type='voice',
+                session_event=TransportUserMessage.SESSION_NEW,
+                content="This is a test call. Goodbye."))
+
+    if args.mode == 'outbound':
+        transport.call_finished = call_finished
+    lag_monitor.start()
+    sampling.start(0.1)
+    start = time.time()
+    for i in xrange(args.calls):
+        semaphore.acquire().addCallback(start_call, i)
+    yield done
+    elapsed = time.time() - start
+    sampling.stop()
+    lag_monitor.stop()
+
+    yield simulator.stop()
+    yield helper.cleanup()
+    yield server.stopListening()
+
+    latencies = [s * 1000 for s in simulator.setup_latencies]
+    print "%s: %d calls, %d concurrent" % (
+        args.mode, args.calls, args.concurrency)
+    print "  %.1f calls/s" % (args.calls / elapsed,)
+    if args.mode == 'outbound':
+        print "  %d answered, %d failed, %d acks, %d nacks" % (
+            simulator.completed_calls, simulator.failed_originates,
+            transport.acks, transport.nacks)
+    print "  setup latency: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (
+        percentile(latencies, 50), percentile(latencies, 95),
+        percentile(latencies, 99))
+    if sampler.peak_calls:
+        print "  memory: %d bytes per call (%d calls at peak)" % (
+            (sampler.peak_rss - sampler.baseline) / sampler.peak_calls,
+            sampler.peak_calls)
+    if lag.samples:
+        print "  reactor lag: mean %.1f ms, max %.1f ms" % (
+            sum(lag.samples) / len(lag.samples) * 1000,
+            max(lag.samples) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        'mode', nargs='?', choices=['inbound', 'outbound'],
+        default='inbound')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--answer-latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.1)
+    parser.add_argument('--fast-parser', action='store_true')
+    parser.add_argument(
+        '--capture', metavar='FILE',
+        help="Capture the transport's ESL traffic to FILE, for"
+             " bench_replay.py.")
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark per-call logging while handling ESL events.
+
+Feeds a mix of unbound (logged at DEBUG) and CHANNEL_EXECUTE_COMPLETE
+(logged at INFO) events through FreeSwitchESLProtocol and reports events
+per second, both for whole events (including eventsocket's parsing) and
+for the event handlers alone:
+
+* ``eager``: the protocol formatting every message before logging it, as
+  it did before CallLogger, with a log observer dropping DEBUG messages.
+* ``lazy DEBUG``: CallLogger at call_log_level DEBUG (everything logged).
+* ``lazy INFO``: CallLogger at call_log_level INFO (DEBUG messages are
+  dropped before they are formatted).
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_logging.py
+"""
+
+import logging
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+
+from vumi.log import WrappingLogger
+
+from vxfreeswitch.calllog import CallLogger
+from vxfreeswitch.voice import FreeSwitchESLProtocol
+
+
+class StubConfig(object):
+    call_timeline_size = 0
+    esl_fast_parser = False
+
+
+class StubTransport(object):
+    config = StubConfig()
+    command_timer = None
+    esl_capture = None
+
+    def __init__(self, level):
+        self.log = WrappingLogger(system='bench')
+        self.call_logger = CallLogger(self.log, level)
+
+
+class EagerFreeSwitchESLProtocol(FreeSwitchESLProtocol):
+    """ The protocol's event handlers as they logged before CallLogger. """
+
+    def eager_log(self, msg, level=logging.INFO):
+        self.vumi_transport.log.msg(
+            '[%s] %s' % (self.uniquecallid, msg), logLevel=level)
+
+    @inlineCallbacks
+    def onChannelExecuteComplete(self, ev):
+        self.eager_log("execute complete: %s" % ev.Application)
+        if self.request_hang_up:
+            yield self.hangup()
+
+    def unboundEvent(self, evdata, evname):
+        self.eager_log("Unbound event %r" % (evname,), level=logging.DEBUG)
+
+
+class InfoObserver(object):
+    """ A log observer that formats INFO and above, like a log file. """
+
+    def __init__(self):
+        self.lines = 0
+
+    def __call__(self, event):
+        if event.get('logLevel', logging.INFO) >= logging.INFO:
+            log.textFromEventDict(event)
+            self.lines += 1
+
+
+class ParsedEvent(dict):
+    __getattr__ = dict.__getitem__
+
+
+def plain_event(name, params):
+    params = dict(params, **{'Event-Name': name})
+    data = "".join("%s: %s\n" % item for item in sorted(params.items()))
+    return 'Content-Length: %d\nContent-Type: text/event-plain\n\n%s\n' % (
+        len(data), data)
+
+
+EVENTS = [
+    plain_event('CUSTOM', {'Event-Subclass': 'conference::maintenance'}),
+    plain_event('CUSTOM', {'Event-Subclass': 'sofia::register'}),
+    plain_event('HEARTBEAT', {'Up-Time': '0 years, 1 day'}),
+    plain_event('CHANNEL_EXECUTE_COMPLETE', {'Application': 'playback'}),
+]
+
+
+def mk_proto(protocol_class, level):
+    proto = protocol_class(StubTransport(level))
+    proto.uniquecallid = 'a3f4bd16-8b4c-4d3e-9e1a-0a1b2c3d4e5f'
+    return proto
+
+
+def bench_events(protocol_class, level, number=20000):
+    proto = mk_proto(protocol_class, level)
+    events = EVENTS * (number // len(EVENTS))
+    start = time.time()
+    for event in events:
+        proto.dataReceived(event)
+    return len(events) / (time.time() - start)
+
+
+def bench_handlers(protocol_class, level, number=100000):
+    proto = mk_proto(protocol_class, level)
+    ev = ParsedEvent(Application='playback')
+    start = time.time()
+    for _ in xrange(number // len(EVENTS)):
+        proto.unboundEvent(ev, 'CUSTOM')
+        proto.unboundEvent(ev, 'CUSTOM')
+        proto.unboundEvent(ev, 'HEARTBEAT')
+        proto.onChannelExecuteComplete(ev)
+    return number / (time.time() - start)
+
+
+def main():
+    log.startLoggingWithObserver(InfoObserver(), setStdout=False)
+    print "%-12s %14s %14s" % ("", "events/s", "handlers/s")
+    for name, protocol_class, level in [
+            ('eager', EagerFreeSwitchESLProtocol, logging.DEBUG),
+            ('lazy DEBUG', FreeSwitchESLProtocol, logging.DEBUG),
+            ('lazy INFO', FreeSwitchESLProtocol, logging.INFO)]:
+        events = max(bench_events(protocol_class, level) for _ in range(5))
+        handlers = max(
+            bench_handlers(protocol_class, level) for _ in range(5))
+        print "%-12s %14.0f %14.0f" % (name, events, handlers)
+
+
+if __name__ == '__main__':
+    main()
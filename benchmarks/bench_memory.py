@@ -0,0 +1,144 @@
+"""
+Benchmark the memory used by each concurrent call.
+
+Simulates 10000 concurrent inbound calls, each with a FreeSwitchESLProtocol
+that has connected, answered, played a prompt, collected some DTMF digits
+and is part way through collecting more, and reports the growth in the
+process's resident memory per call. Like the transport, each call has a
+duration limit and an idle timer that is pushed back whenever the caller
+enters input. Replies and events are passed straight
+to the protocols' eventReceived (rather than parsed from bytes, which
+would need the reactor), so the numbers cover call state rather than
+buffered network data. Run from the repository root (Linux only, as it
+reads /proc)::
+
+    PYTHONPATH=. python benchmarks/bench_memory.py [calls]
+"""
+
+import gc
+import logging
+import os
+import sys
+
+from eventsocket import _O
+from twisted.internet.defer import Deferred, succeed
+from twisted.python import log
+
+from vumi.log import WrappingLogger
+
+from vxfreeswitch.calllog import CallLogger
+from vxfreeswitch.scheduler import Scheduler
+from vxfreeswitch.voice import FreeSwitchESLProtocol
+
+
+class StubConfig(object):
+    call_timeline_size = 64
+    esl_fast_parser = False
+    max_call_duration = 3600
+    max_call_idle = 300
+
+
+class StubTransport(object):
+    """ The parts of VoiceServerTransport that calls use. """
+
+    config = StubConfig()
+    command_timer = None
+    esl_capture = None
+
+    def __init__(self):
+        self.log = WrappingLogger(system='bench')
+        self.call_logger = CallLogger(self.log, logging.INFO)
+        self.call_limits = Scheduler()
+        self.inputs = 0
+
+    def admit_client(self, client):
+        return True
+
+    def register_client(self, client):
+        client.registration_d = Deferred()
+        self.call_limits.schedule(
+            (client.get_address(), 'duration'),
+            self.config.max_call_duration, self.reap_call, client,
+            'max_duration')
+        self.reset_idle_timer(client)
+
+    def reset_idle_timer(self, client):
+        self.call_limits.schedule(
+            (client.get_address(), 'idle'), self.config.max_call_idle,
+            self.reap_call, client, 'idle_timeout')
+
+    def reap_call(self, client, reason):
+        pass
+
+    def client_answered(self, client):
+        self.reset_idle_timer(client)
+
+    def handle_input(self, client, digits):
+        self.inputs += 1
+        self.reset_idle_timer(client)
+        return succeed(None)
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+
+def reply(proto):
+    proto.eventReceived(_O(Content_Type='command/reply', Reply_Text='+OK'))
+
+
+def event(proto, name, **data):
+    proto.eventReceived(_O(
+        Content_Type='text/event-plain', data=_O(Event_Name=name, **data)))
+
+
+def simulate_call(vumi_transport, i):
+    proto = FreeSwitchESLProtocol(vumi_transport)
+    proto.makeConnection(NullTransport())
+    proto.dataReceived("")
+    # connect, myevents and answer
+    proto.eventReceived(_O(
+        Content_Type='command/reply', Reply_Text='+OK',
+        variable_call_uuid='a3f4bd16-8b4c-4d3e-9e1a-%012d' % (i,),
+        variable_caller_id_number='2783%07d' % (i,)))
+    reply(proto)
+    reply(proto)
+    event(proto, 'CHANNEL_ANSWER')
+    proto.set_input_type('#')
+    proto.output_stream('/var/lib/prompts/welcome.wav')
+    reply(proto)
+    reply(proto)
+    event(proto, 'CHANNEL_EXECUTE', Application='playback')
+    event(proto, 'CHANNEL_EXECUTE_COMPLETE', Application='playback')
+    for digit in '1234#':
+        event(proto, 'DTMF', DTMF_Digit=digit)
+    event(proto, 'DTMF', DTMF_Digit='5')
+    proto.output_stream('/var/lib/prompts/wait.wav')
+    return proto
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def main(calls=10000):
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+    vumi_transport = StubTransport()
+    # Warm up caches and the allocator's free lists.
+    simulate_call(vumi_transport, 0)
+    gc.collect()
+    start = rss()
+    clients = {}
+    for i in xrange(calls):
+        proto = simulate_call(vumi_transport, i)
+        clients[proto.get_address()] = proto
+    gc.collect()
+    used = rss() - start
+    print "%d calls: %.1f MB, %d bytes per call" % (
+        calls, used / 1e6, used / calls)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Benchmark formatting originate calls.
+
+Compares OriginateFormatter.format_call, which uses a precompiled template,
+with formatting the template with str.format for every call. Run from the
+repository root::
+
+    PYTHONPATH=. python benchmarks/bench_originate.py
+"""
+
+import timeit
+
+from vxfreeswitch.originate import OriginateFormatter
+from vxfreeswitch.routing import OriginateRouter
+
+
+FORMATTER = OriginateFormatter(
+    call_url='{{origination_uuid={uuid}}}sofia/gateway/yogisip/{to_addr}',
+    exten='{from_addr}',
+    cid_name='vxfreeswitch',
+    cid_num='{from_addr}',
+)
+
+ROUTER = OriginateRouter(
+    {
+        'call_url':
+            '{{origination_uuid={uuid}}}sofia/gateway/default/{to_addr}',
+        'exten': '{from_addr}',
+        'cid_name': 'vxfreeswitch',
+        'cid_num': '{from_addr}',
+    },
+    dict(
+        ('27%04d' % i, {'call_url': 'sofia/gateway/gw%d/{to_addr}' % i})
+        for i in range(5000)))
+
+ARGS = (
+    u'+27831234567', u'+27001234567', 'a3f4bd16-8b4c-4d3e-9e1a-0a1b2c3d4e5f')
+
+
+def str_format():
+    FORMATTER.template.format(
+        from_addr=ARGS[0], to_addr=ARGS[1], uuid=ARGS[2])
+
+
+def compiled():
+    FORMATTER.format_call(*ARGS)
+
+
+def routed():
+    ROUTER.format_call(*ARGS)
+
+
+def bench(f, number=200000, repeat=5):
+    best = min(timeit.repeat(f, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def main():
+    for name, f in [
+            ('str.format', str_format),
+            ('compiled', compiled),
+            ('routed (5000 prefixes)', routed)]:
+        print "%-24s %.3f us/call" % (name, bench(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark parsing ESL data from FreeSwitch.
+
+Compares eventsocket's line-based parser with
+vxfreeswitch.eslparser.EventParser on a stream of command replies, API
+responses and full-sized channel events, delivered in 4 KB chunks as they
+would be read from a socket. Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_parser.py
+"""
+
+import time
+
+from eventsocket import EventProtocol, _O
+
+from vxfreeswitch.eslparser import EventParser
+
+
+def body_message(headers, body):
+    return "%sContent-Length: %d\n\n%s" % (headers, len(body), body)
+
+
+def channel_event(name, **extra):
+    """ A plain event with as many headers as FreeSwitch's channel events
+    typically have.
+    """
+    headers = [
+        ('Event-Name', name),
+        ('Core-UUID', '0b8f5a53-5f3c-4b0b-8e3a-5c4b0cd1a8b2'),
+        ('FreeSWITCH-Hostname', 'fs1.example.com'),
+        ('Event-Date-Local', '2016-03-01%2012%3A00%3A00'),
+        ('Unique-ID', 'a3f4bd16-8b4c-4d3e-9e1a-0a1b2c3d4e5f'),
+        ('Caller-Caller-ID-Name', 'Jane%20Doe'),
+        ('Caller-Caller-ID-Number', '27831234567'),
+    ]
+    # Some values (dates, names, SIP URIs) are URL-encoded, most aren't.
+    headers.extend(
+        ('variable_sip_h_X-Header-%d' % i,
+         'value%%20%d' % i if i % 10 == 0 else 'value-%d' % i)
+        for i in range(60))
+    headers.extend(sorted(extra.items()))
+    return body_message(
+        "Content-Type: text/event-plain\n",
+        "".join("%s: %s\n" % header for header in headers) + "\n")
+
+
+MESSAGES = [
+    "Content-Type: command/reply\nReply-Text: +OK\n\n",
+    body_message("Content-Type: api/response\n", "+OK 1234\n"),
+    channel_event('CHANNEL_EXECUTE', Application='playback'),
+    channel_event('CHANNEL_EXECUTE_COMPLETE', Application='playback'),
+    channel_event('DTMF', **{'DTMF-Digit': '5'}),
+]
+
+
+class CountingEventSocket(EventProtocol):
+    def __init__(self):
+        EventProtocol.__init__(self)
+        self.events = 0
+
+    def dispatchEvent(self, ctx, event):
+        ctx.data = _O(event.copy())
+        self.events += 1
+        self._EventSocket__ctx = self._EventSocket__rawlen = None
+
+
+def chunks(repeat=400, size=4096):
+    data = "".join(MESSAGES) * repeat
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def bench_eventsocket(data):
+    proto = CountingEventSocket()
+    start = time.time()
+    for chunk in data:
+        proto.dataReceived(chunk)
+    return proto.events / (time.time() - start)
+
+
+def bench_event_parser(data):
+    parser = EventParser()
+    events = 0
+    start = time.time()
+    for chunk in data:
+        events += len(parser.feed(chunk))
+    return events / (time.time() - start)
+
+
+def main():
+    data = chunks()
+    for name, f in [
+            ('eventsocket', bench_eventsocket),
+            ('EventParser', bench_event_parser)]:
+        rate = max(f(data) for _ in range(5))
+        print "%-12s %8.0f events/s" % (name, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Replay captured ESL traffic to the voice transport.
+
+Reads a capture written by a transport with ``esl_capture_file`` set (or
+by ``bench_load.py --capture``) and replays its calls to a
+VoiceServerTransport running in this process, at the captured pace or
+``--speed`` times faster. The application built into bench_load.py
+replies to each message, so the transport sends the commands the captured
+replies answer; a call whose replay waits more than five seconds for a
+command is hung up and counted as stalled. Reports the time the replay
+took against the captured time, calls per second and the reactor's lag,
+to compare parser and transport changes on the same traffic. Run from the
+repository root::
+
+    PYTHONPATH=. python benchmarks/bench_replay.py CAPTURE [--speed N] \\
+        [--fast-parser] [--wait-for DIGIT]
+"""
+
+import argparse
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.python import log
+
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxfreeswitch.eslcapture import load_capture, replay_calls
+from vxfreeswitch.lag import ReactorLagMonitor
+
+from bench_load import BenchTransport, LagSamples
+
+
+@inlineCallbacks
+def run(reactor, args):
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+    with open(args.capture, 'rb') as f:
+        connections = load_capture(f)
+    calls = [conn for conn in connections if conn.kind == "call"]
+    if not calls:
+        print "No calls in %s" % (args.capture,)
+        return
+    captured = max(conn.opened + conn.duration for conn in calls) - min(
+        conn.opened for conn in calls)
+
+    BenchTransport.wait_for = args.wait_for
+    helper = TransportHelper(BenchTransport)
+    helper.setup()
+    transport = yield helper.get_transport({
+        'twisted_endpoint': 'tcp:port=0:backlog=1024:interface=127.0.0.1',
+        'call_log_level': 'WARNING',
+        'esl_fast_parser': args.fast_parser,
+    })
+    endpoint = TCP4ClientEndpoint(
+        reactor, '127.0.0.1', transport.voice_server.getHost().port)
+
+    lag = LagSamples()
+    lag_monitor = ReactorLagMonitor(0.05, metric=lag)
+    lag_monitor.start()
+    start = time.time()
+    replays = yield replay_calls(calls, endpoint, speed=args.speed)
+    elapsed = time.time() - start
+    lag_monitor.stop()
+    yield helper.cleanup()
+
+    stalled = sum(1 for replay in replays if replay.stalled)
+    print "%d calls, %d frames, %d stalled" % (
+        len(replays), sum(replay.sent for replay in replays), stalled)
+    print "  captured %.1f s, replayed in %.1f s at %gx (%.1f calls/s)" % (
+        captured, elapsed, args.speed, len(replays) / elapsed)
+    if lag.samples:
+        print "  reactor lag: mean %.1f ms, max %.1f ms" % (
+            sum(lag.samples) / len(lag.samples) * 1000,
+            max(lag.samples) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('capture', metavar='CAPTURE')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--fast-parser', action='store_true')
+    parser.add_argument(
+        '--wait-for', default='#',
+        help="The digit the application waits for after its first prompt.")
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
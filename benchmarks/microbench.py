@@ -0,0 +1,238 @@
+"""
+Microbenchmarks of the voice transport's hot paths.
+
+Times, each on its own and against a transport set up as in production:
+
+* send_outbound_message playing text-to-speech from the local cache and
+  playing a list of speech_url files,
+* send_inbound_message building an inbound message's metadata,
+* onDtmf collecting a four digit PIN and its terminator,
+* OriginateFormatter.format_call,
+* get_client finding a call in the registries (1000 calls, half of them
+  originated).
+
+Publishing is stubbed out and FreeSwitch's replies are passed straight to
+the call's protocol, so only the transport's own work is measured.
+
+Results are compared with a baseline file of microseconds per operation,
+and any benchmark more than ``--threshold`` slower than its baseline is
+reported as a regression (and the script exits with status 1). Baselines
+are only comparable on the machine they were recorded on, so record one
+with ``--save`` before starting performance work. The best of several runs
+is taken, but times can still vary by twenty percent or more between runs
+on a busy machine, so the default threshold is 25%. Run from the
+repository root::
+
+    PYTHONPATH=. python benchmarks/microbench.py [--save] \\
+        [--baseline FILE] [--threshold FRACTION]
+"""
+
+import argparse
+import json
+import md5
+import os
+import shutil
+import tempfile
+import timeit
+
+from eventsocket import _O
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.python import log
+
+from vumi.message import TransportUserMessage
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxfreeswitch import VoiceServerTransport
+from vxfreeswitch.originate import OriginateFormatter
+from vxfreeswitch.voice import FreeSwitchESLProtocol
+
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+
+REPLY = _O(Content_Type='command/reply', Reply_Text='+OK')
+
+# The commands an outbound message sends, one after the other: setting the
+# playback terminators, then playing its media.
+OUTBOUND_COMMANDS = 2
+
+
+class MicroTransport(VoiceServerTransport):
+    """ Drops the messages and events the transport publishes. """
+
+    def publish_message(self, **kw):
+        return succeed(None)
+
+    def publish_event(self, **kw):
+        return succeed(None)
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+
+def make_call(transport, i, msisdn=None):
+    client = FreeSwitchESLProtocol(transport)
+    client.transport = NullTransport()
+    client.uniquecallid = 'a3f4bd16-8b4c-4d3e-9e1a-%012d' % (i,)
+    client.caller_id_number = '2783%07d' % (i,)
+    client.answered = True
+    transport._clients[client.uniquecallid] = client
+    if msisdn is not None:
+        transport._msisdn_mapping[client.uniquecallid] = msisdn
+    return client
+
+
+def reply_to_commands(client, commands):
+    for _ in range(commands):
+        client.eventReceived(REPLY)
+
+
+def outbound_message(client, content, voice):
+    return TransportUserMessage(
+        to_addr=client.get_address(), from_addr='1234',
+        transport_name='sphex', transport_type='voice',
+        content=content, helper_metadata={'voice': voice})
+
+
+def send_outbound(transport, client, msg):
+    def f():
+        d = transport.send_outbound_message(client, msg)
+        reply_to_commands(client, OUTBOUND_COMMANDS)
+        assert d.called
+    return f
+
+
+def benchmarks(transport, cache_dir):
+    client = make_call(transport, 0)
+    for i in range(1, 1000):
+        make_call(transport, i, msisdn='2782%07d' % (i,) if i % 2 else None)
+
+    text = "Welcome. Enter your PIN followed by the hash key."
+    # The name stream_text_as_speech gives the cached file.
+    key = md5.md5(("%s\n" % text).replace("\n", " . ")).hexdigest()
+    open(os.path.join(cache_dir, 'voice-%s.wav' % (key,)), 'w').close()
+    tts_msg = outbound_message(client, text, {'wait_for': '#'})
+    url_msg = outbound_message(client, None, {'speech_url': [
+        'http://example.com/prompts/%d.ogg' % (i,) for i in range(5)]})
+
+    def inbound():
+        transport.send_inbound_message(
+            client, '1234', TransportUserMessage.SESSION_RESUME)
+
+    digits = [_O(DTMF_Digit=digit) for digit in '1234#']
+
+    def dtmf():
+        client.set_input_type('#')
+        for ev in digits:
+            client.onDtmf(ev)
+
+    formatter = OriginateFormatter(
+        call_url='{{origination_uuid={uuid}}}sofia/gateway/yogisip/{to_addr}',
+        exten='{from_addr}', cid_name='vxfreeswitch', cid_num='{from_addr}')
+
+    def format_call():
+        formatter.format_call(
+            u'+27831234567', u'+27001234567',
+            'a3f4bd16-8b4c-4d3e-9e1a-0a1b2c3d4e5f')
+
+    def registry():
+        transport.get_client('a3f4bd16-8b4c-4d3e-9e1a-000000000500')
+        transport.get_client('27820000499')
+
+    return [
+        ('send_outbound_message (tts cache hit)',
+         send_outbound(transport, client, tts_msg), 2000),
+        ('send_outbound_message (speech_url list)',
+         send_outbound(transport, client, url_msg), 2000),
+        ('send_inbound_message', inbound, 10000),
+        ('onDtmf (4 digits and #)', dtmf, 10000),
+        ('OriginateFormatter.format_call', format_call, 100000),
+        ('get_client (1000 calls)', registry, 10000),
+    ]
+
+
+def bench(f, number, repeat=9):
+    f()
+    best = min(timeit.repeat(f, number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+def load_baseline(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def report(results, baseline, threshold):
+    """ Print each result against its baseline and return the names of the
+    benchmarks that regressed.
+    """
+    regressions = []
+    for name, us in results:
+        line = "%-42s %10.3f us/op" % (name, us)
+        base = baseline.get(name)
+        if base:
+            change = (us - base) / base
+            line += "  %+6.1f%% vs %.3f" % (change * 100, base)
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print line
+    return regressions
+
+
+@inlineCallbacks
+def run(reactor, args):
+    log.startLoggingWithObserver(lambda event: None, setStdout=False)
+    cache_dir = tempfile.mkdtemp()
+    helper = TransportHelper(MicroTransport)
+    helper.setup()
+    transport = yield helper.get_transport({
+        'twisted_endpoint': 'tcp:port=0:interface=127.0.0.1',
+        'tts_type': 'local',
+        'tts_local_command': 'true',
+        'tts_local_cache': cache_dir,
+        'max_call_idle': 60,
+    })
+    try:
+        results = [
+            (name, bench(f, number))
+            for name, f, number in benchmarks(transport, cache_dir)]
+    finally:
+        # The calls aren't connected, so there's nothing to wait for.
+        transport._clients.clear()
+        yield helper.cleanup()
+        shutil.rmtree(cache_dir)
+
+    regressions = report(
+        results, load_baseline(args.baseline), args.threshold)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(results), f, indent=2, sort_keys=True)
+        print "Saved baseline to %s" % (args.baseline,)
+    elif regressions:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE,
+        help="Baseline file (default: %(default)s).")
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help="Fraction slower than the baseline that counts as a"
+             " regression (default: %(default)s).")
+    parser.add_argument(
+        '--save', action='store_true',
+        help="Save the results as the new baseline.")
+    args = parser.parse_args()
+    task.react(run, [args])
+
+
+if __name__ == '__main__':
+    main()
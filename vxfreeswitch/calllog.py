@@ -0,0 +1,87 @@
+# -*- test-case-name: vxfreeswitch.tests.test_calllog -*-
+
+"""
+Level-gated, lazily formatted logging for per-call messages.
+"""
+
+import logging
+
+
+LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+
+
+def parse_level(level):
+    """ Return the numeric logging level for a name such as ``'INFO'``.
+
+    :raises ValueError: if the level name is unknown.
+    """
+    try:
+        return LEVELS[level.upper()]
+    except KeyError:
+        raise ValueError("Unknown log level %r" % (level,))
+
+
+class CallLogger(object):
+    """ Logs messages below a minimum level without formatting them, and
+    adds bound context (such as a call UUID) to the ones it does log.
+
+    Messages are ``%``-style format strings whose arguments are only
+    interpolated once the level check has passed, so callers in hot paths
+    should pass arguments separately rather than formatting them first::
+
+        logger.debug("Unbound event %r", evname)
+
+    Bound context is passed to the underlying logger as keyword arguments,
+    which end up in the Twisted log event for log observers to use, and
+    ``call_uuid`` (if bound) prefixes the message text.
+
+    :param log:
+        The logger to send messages to (a vumi worker's ``log``).
+
+    :param int level:
+        The minimum level to log at.
+    """
+
+    __slots__ = ('_log', 'level', 'context', '_prefix')
+
+    def __init__(self, log, level=logging.DEBUG, **context):
+        self._log = log
+        self.level = level
+        self.context = context
+        self._prefix = (
+            '[%s] ' % (context['call_uuid'],) if 'call_uuid' in context
+            else '')
+
+    def bind(self, **context):
+        """ Return a logger with the same level and additional context. """
+        bound = dict(self.context)
+        bound.update(context)
+        return CallLogger(self._log, self.level, **bound)
+
+    def is_enabled(self, level):
+        """ Return ``True`` if messages at ``level`` would be logged. Use
+        this to skip work done only to build a log message.
+        """
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+        self._log.msg(self._prefix + msg, logLevel=level, **self.context)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
@@ -0,0 +1,85 @@
+# -*- test-case-name: vxfreeswitch.tests.test_callstate -*-
+
+"""
+Stores for call state that must be visible to every transport worker.
+
+When a call is originated, FreeSwitch connects the call's outbound socket
+to whichever transport worker its load balancer picks, which need not be
+the worker that dialed. The originating worker records the call here and
+the worker that receives the connection claims it.
+"""
+
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from vumi.message import TransportUserMessage
+
+
+class MemoryCallStateStore(object):
+    """ Call state kept in memory. Only suitable for a single worker.
+
+    Entries are removed when they are claimed. The transport claims calls
+    that are never connected when it sweeps stale calls, so ``ttl`` is
+    not needed here.
+    """
+
+    def __init__(self):
+        self._originated_calls = {}
+
+    def add_originated_call(self, call_uuid, message, msisdn, ttl):
+        self._originated_calls[call_uuid] = (message, msisdn)
+        return succeed(None)
+
+    def claim_originated_call(self, call_uuid):
+        """ Remove and return the ``(message, msisdn)`` pair recorded for a
+        call, or ``None`` if there isn't one (or it was already claimed).
+        """
+        return succeed(self._originated_calls.pop(call_uuid, None))
+
+    def originated_call_pending(self, call_uuid):
+        """ Return ``True`` if a call is recorded and not yet claimed. """
+        return succeed(call_uuid in self._originated_calls)
+
+
+class RedisCallStateStore(object):
+    """ Call state kept in Redis and shared between workers.
+
+    :type redis:
+        :class:`vumi.persist.txredis_manager.TxRedisManager`
+    :param redis:
+        The Redis manager to store call state with.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def _originated_key(self, call_uuid):
+        return "originated:%s" % (call_uuid,)
+
+    def add_originated_call(self, call_uuid, message, msisdn, ttl):
+        return self.redis.setex(
+            self._originated_key(call_uuid), ttl, json.dumps({
+                'message': message.to_json(),
+                'msisdn': msisdn,
+            }))
+
+    def originated_call_pending(self, call_uuid):
+        d = self.redis.exists(self._originated_key(call_uuid))
+        return d.addCallback(bool)
+
+    @inlineCallbacks
+    def claim_originated_call(self, call_uuid):
+        key = self._originated_key(call_uuid)
+        # Both commands are written before either reply is read, so they
+        # share a round trip. Only the worker whose delete removes the key
+        # gets the call, even if several read it.
+        get_d = self.redis.get(key)
+        deleted = yield self.redis.delete(key)
+        data = yield get_d
+        if not deleted or data is None:
+            returnValue(None)
+        data = json.loads(data)
+        returnValue((
+            TransportUserMessage.from_json(data['message']),
+            data['msisdn']))
@@ -5,22 +5,50 @@ FreeSwitch ESL API client.
 """
 
 from twisted.internet.protocol import ClientFactory
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, fail)
 
 from eventsocket import EventProtocol, EventError
 
+from vxfreeswitch.eslcapture import EslCaptureMixin
+from vxfreeswitch.eslparser import EventParser, EventParserMixin
+from vxfreeswitch.esltiming import TimedCommandsMixin
 
-class FreeSwitchClientProtocol(EventProtocol):
+
+class FreeSwitchClientProtocol(
+        TimedCommandsMixin, EslCaptureMixin, EventParserMixin, EventProtocol):
     """ Freeswitch ESL client.
 
     :param str auth:
         Authentication string to send to FreeSwitch.
+
+    :type command_timer:
+        :class:`vxfreeswitch.esltiming.CommandTimer`
+    :param command_timer:
+        Optional timer to record command round-trip times with.
+
+    :param bool fast_parser:
+        Parse data from FreeSwitch with
+        :class:`vxfreeswitch.eslparser.EventParser` rather than
+        eventsocket's parser.
+
+    :type esl_capture:
+        :class:`vxfreeswitch.eslcapture.CaptureWriter`
+    :param esl_capture:
+        Optional writer to capture the connection's traffic with.
     """
 
-    def __init__(self, auth):
+    capture_kind = "client"
+
+    def __init__(self, auth, command_timer=None, fast_parser=False,
+                 esl_capture=None):
         EventProtocol.__init__(self)
         self._auth = auth
         self._connected = Deferred()
+        self.command_timer = command_timer
+        if fast_parser:
+            self.event_parser = EventParser()
+        self.esl_capture = esl_capture
 
     @inlineCallbacks
     def connectionMade(self):
@@ -31,18 +59,110 @@ class FreeSwitchClientProtocol(EventProtocol):
 
 class FreeSwitchClientFactory(ClientFactory):
     """ FreeSwitch ESL client factory. """
-    def __init__(self, auth=None, noisy=False):
+    def __init__(self, auth=None, noisy=False, command_timer=None,
+                 fast_parser=False, esl_capture=None):
         self.noisy = noisy
         self.auth = auth
+        self.command_timer = command_timer
+        self.fast_parser = fast_parser
+        self.esl_capture = esl_capture
 
     def protocol(self):
-        return FreeSwitchClientProtocol(self.auth)
+        return FreeSwitchClientProtocol(
+            self.auth, self.command_timer, self.fast_parser,
+            self.esl_capture)
 
 
 class FreeSwitchClientError(Exception):
     """ Raised when a FreeSwitch ESL command fails. """
 
 
+class FreeSwitchConnectionError(FreeSwitchClientError):
+    """ Raised when the client cannot connect to FreeSwitch. No command was
+    sent, so it is safe to retry elsewhere.
+    """
+
+
+class FreeSwitchCircuitOpenError(FreeSwitchConnectionError):
+    """ Raised instead of connecting while a client's circuit breaker is
+    open.
+    """
+
+
+class CircuitBreaker(object):
+    """ Stops connection attempts to a server that keeps failing.
+
+    The breaker starts closed. After ``failure_threshold`` consecutive
+    failures it opens and requests are refused without trying to connect.
+    Once ``reset_timeout`` seconds have passed it is half-open and lets a
+    single request through: if that succeeds the breaker closes, otherwise
+    it opens again.
+
+    :param int failure_threshold:
+        Consecutive failures needed to open the breaker.
+
+    :param float reset_timeout:
+        Seconds to stay open for before trying again.
+
+    :param clock:
+        The reactor to read the time from. Defaults to the global reactor.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+
+    METRIC_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold, reset_timeout, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self._opened_at = None
+        self._trial_pending = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self.clock.seconds() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow_request(self):
+        """ Return ``True`` if a request may be made now. In the half-open
+        state only one request is allowed until its outcome is recorded.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_pending:
+            self._trial_pending = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial_pending = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_pending = False
+        if (self._opened_at is not None or
+                self.failures >= self.failure_threshold):
+            self._opened_at = self.clock.seconds()
+
+    def metric_value(self):
+        """ Return the current state as a metric value: 0 for closed, 1
+        for half-open and 2 for open.
+        """
+        return self.METRIC_VALUES[self.state]
+
+
 class FreeSwitchClientReply(object):
     """ A successful reply to a FreeSwitch ESL command. """
     def __init__(self, *args):
@@ -68,16 +188,50 @@ class FreeSwitchClient(object):
 
     :param str auth:
         Authentication string to send to FreeSwitch on connect.
+
+    :type breaker:
+        :class:`CircuitBreaker`
+    :param breaker:
+        Optional circuit breaker to stop connecting to FreeSwitch while it
+        is failing.
+
+    :type command_timer:
+        :class:`vxfreeswitch.esltiming.CommandTimer`
+    :param command_timer:
+        Optional timer to record command round-trip times with.
+
+    :param bool fast_parser:
+        Parse data from FreeSwitch with
+        :class:`vxfreeswitch.eslparser.EventParser`.
+
+    :type esl_capture:
+        :class:`vxfreeswitch.eslcapture.CaptureWriter`
+    :param esl_capture:
+        Optional writer to capture each connection's traffic with.
     """
-    def __init__(self, endpoint, auth=None, noisy=False):
+    def __init__(self, endpoint, auth=None, noisy=False, breaker=None,
+                 command_timer=None, fast_parser=False, esl_capture=None):
         self.endpoint = endpoint
-        self.factory = FreeSwitchClientFactory(auth=auth, noisy=noisy)
+        self.factory = FreeSwitchClientFactory(
+            auth=auth, noisy=noisy, command_timer=command_timer,
+            fast_parser=fast_parser, esl_capture=esl_capture)
+        self.breaker = breaker
 
     def fallback_error_handler(self, failure):
         if failure.check(FreeSwitchClientError):
             return failure
         raise FreeSwitchClientError(str(failure.value))
 
+    def connection_error_handler(self, failure):
+        if self.breaker is not None:
+            self.breaker.record_failure()
+        raise FreeSwitchConnectionError(str(failure.value))
+
+    def connection_callback(self, client):
+        if self.breaker is not None:
+            self.breaker.record_success()
+        return client
+
     def event_error_handler(self, failure):
         if failure.check(EventError):
             err = failure.value
@@ -98,6 +252,12 @@ class FreeSwitchClient(object):
             raise FreeSwitchClientError(msg)
         return FreeSwitchClientReply(*args)
 
+    def raw_api_request_callback(self, ev):
+        rawresponse = ev.get('data', {}).get('rawresponse', '')
+        if rawresponse.startswith("-ERR"):
+            raise FreeSwitchClientError(rawresponse.strip())
+        return rawresponse
+
     @inlineCallbacks
     def _raw_with_connection(self, client, f):
         yield client._connected
@@ -113,7 +273,13 @@ class FreeSwitchClient(object):
         :param function f:
             f(client) - the function that makes calls to the client.
         """
+        if self.breaker is not None and not self.breaker.allow_request():
+            return fail(FreeSwitchCircuitOpenError(
+                "Circuit breaker open after %d connection failures" % (
+                    self.breaker.failures,)))
         d = self.endpoint.connect(self.factory)
+        d.addCallbacks(
+            self.connection_callback, self.connection_error_handler)
         d.addCallback(lambda client: client._connected)
         d.addCallback(self._raw_with_connection, f)
         d.addErrback(self.event_error_handler)
@@ -126,3 +292,13 @@ class FreeSwitchClient(object):
             d.addCallbacks(self.api_request_callback)
             return d
         return self.with_connection(mk_call)
+
+    def raw_api(self, api_call):
+        """ Make an API call whose response isn't an ``+OK`` reply (e.g.
+        ``status``) and return the response text.
+        """
+        def mk_call(client):
+            d = client.api(api_call)
+            d.addCallbacks(self.raw_api_request_callback)
+            return d
+        return self.with_connection(mk_call)
@@ -0,0 +1,309 @@
+# -*- test-case-name: vxfreeswitch.tests.test_eslcapture -*-
+
+"""
+Capturing ESL traffic to a file and replaying it.
+
+A :class:`CaptureWriter` records every chunk of data an ESL connection
+receives from or sends to FreeSwitch, with the time, as a compact binary
+record. :class:`EslCaptureMixin` adds capturing to the call and client
+protocols. :func:`load_capture` reads a capture back as one
+:class:`CapturedConnection` per connection and :func:`replay_calls` plays
+captured calls back to a voice transport, at their original pace or
+faster.
+"""
+
+import struct
+import time
+from collections import namedtuple
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.protocol import Protocol
+
+from vxfreeswitch.simulator import EslParser
+
+
+MAGIC = "VXESLCAP1\n"
+
+# Each record is a header (time, connection id, record type and data
+# length) followed by the data.
+HEADER = struct.Struct("!dIcI")
+
+OPENED = "o"
+RECEIVED = "<"
+SENT = ">"
+CLOSED = "c"
+
+CaptureRecord = namedtuple(
+    "CaptureRecord", ["timestamp", "connection", "type", "data"])
+
+
+class CaptureWriter(object):
+    """ Writes captured ESL traffic to a file.
+
+    :param f:
+        A file opened for writing in binary mode.
+
+    :param clock:
+        A function returning the current time in seconds.
+    """
+
+    def __init__(self, f, clock=time.time):
+        self._file = f
+        self._clock = clock
+        self._next_connection = 0
+        self._file.write(MAGIC)
+
+    def write(self, connection, record_type, data):
+        if self._file is None:
+            # Closed while connections were still open.
+            return
+        self._file.write(HEADER.pack(
+            self._clock(), connection, record_type, len(data)))
+        self._file.write(data)
+
+    def open_connection(self, kind):
+        """ Start capturing a new connection of the given kind (``call``
+        or ``client``) and return its id.
+        """
+        connection = self._next_connection
+        self._next_connection += 1
+        self.write(connection, OPENED, kind)
+        return connection
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CaptureTransport(object):
+    """ Wraps a protocol's transport, capturing the data written to it. """
+
+    def __init__(self, transport, capture, connection):
+        self._transport = transport
+        self._capture = capture
+        self._connection = connection
+
+    def write(self, data):
+        self._capture.write(self._connection, SENT, data)
+        self._transport.write(data)
+
+    def writeSequence(self, seq):
+        self.write("".join(seq))
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class EslCaptureMixin(object):
+    """ Captures the data a protocol sends and receives with its
+    ``esl_capture``, if it has one. It must come before the protocol's
+    other bases.
+    """
+
+    esl_capture = None
+    capture_kind = "call"
+
+    def makeConnection(self, transport):
+        if self.esl_capture is not None:
+            self._capture_connection = self.esl_capture.open_connection(
+                self.capture_kind)
+            transport = CaptureTransport(
+                transport, self.esl_capture, self._capture_connection)
+        super(EslCaptureMixin, self).makeConnection(transport)
+
+    def dataReceived(self, data):
+        if self.esl_capture is not None:
+            self.esl_capture.write(self._capture_connection, RECEIVED, data)
+        super(EslCaptureMixin, self).dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.esl_capture is not None:
+            self.esl_capture.write(self._capture_connection, CLOSED, "")
+        super(EslCaptureMixin, self).connectionLost(reason)
+
+
+def read_capture(f):
+    """ Yield the :class:`CaptureRecord` s in a capture file. A truncated
+    final record (from a transport that didn't shut down cleanly) is
+    ignored.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not an ESL capture file")
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        timestamp, connection, record_type, length = HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            return
+        yield CaptureRecord(timestamp, connection, record_type, data)
+
+
+class CapturedConnection(object):
+    """ The traffic on one captured connection.
+
+    :attr:`frames` is a list of ``(offset, direction, data)`` tuples, with
+    ``offset`` in seconds from when the connection was opened and
+    ``direction`` either :data:`RECEIVED` or :data:`SENT`.
+    """
+
+    def __init__(self, kind, opened):
+        self.kind = kind
+        self.opened = opened
+        self.duration = None
+        self.frames = []
+
+    def received(self):
+        """ Return the data received from FreeSwitch as a list of
+        ``(offset, data, commands)`` tuples, where ``commands`` is the
+        number of commands the connection had sent before the data
+        arrived.
+        """
+        parser = EslParser()
+        commands = 0
+        received = []
+        for offset, direction, data in self.frames:
+            if direction == SENT:
+                commands += len(parser.parse(data))
+            else:
+                received.append((offset, data, commands))
+        return received
+
+
+def load_capture(f):
+    """ Read a capture file into a list of :class:`CapturedConnection` s,
+    in the order they were opened.
+    """
+    connections = {}
+    ordered = []
+    for record in read_capture(f):
+        if record.type == OPENED:
+            conn = CapturedConnection(record.data, record.timestamp)
+            connections[record.connection] = conn
+            ordered.append(conn)
+            continue
+        conn = connections.get(record.connection)
+        if conn is None:
+            continue
+        offset = record.timestamp - conn.opened
+        if record.type == CLOSED:
+            conn.duration = offset
+            del connections[record.connection]
+        else:
+            conn.frames.append((offset, record.type, record.data))
+    for conn in connections.itervalues():
+        # Still open when the capture ended.
+        conn.duration = conn.frames[-1][0] if conn.frames else 0
+    return ordered
+
+
+class ReplayProtocol(Protocol):
+    """ Plays a captured call's traffic from FreeSwitch back to a voice
+    transport.
+
+    Each chunk is sent at its captured offset (divided by ``speed``), but
+    not before the transport has sent as many commands as it had when the
+    chunk was captured, so that replies line up with commands. If the
+    transport sends nothing for ``stall_timeout`` seconds while the replay
+    is waiting for a command, the call is hung up and marked as
+    :attr:`stalled`.
+    """
+
+    def __init__(self, connection, speed=1.0, stall_timeout=5.0,
+                 clock=None):
+        self.connection = connection
+        self.speed = speed
+        self.stall_timeout = stall_timeout
+        self.clock = clock if clock is not None else reactor
+        self.parser = EslParser()
+        self.commands = 0
+        self.sent = 0
+        self.stalled = False
+        self.done = Deferred()
+        self._pending = connection.received()
+        self._started = None
+        self._delayed = None
+        self._stall = None
+
+    def connectionMade(self):
+        self._started = self.clock.seconds()
+        self._send_due()
+
+    def dataReceived(self, data):
+        self.commands += len(self.parser.parse(data))
+        self._send_due()
+
+    def _cancel(self, delayed):
+        if delayed is not None and delayed.active():
+            delayed.cancel()
+
+    def _send_due(self):
+        self._cancel(self._delayed)
+        self._cancel(self._stall)
+        self._delayed = self._stall = None
+        while self._pending:
+            offset, data, commands = self._pending[0]
+            if self.commands < commands:
+                self._stall = self.clock.callLater(
+                    self.stall_timeout, self._stalled)
+                return
+            delay = self._started + offset / self.speed - self.clock.seconds()
+            if delay > 0:
+                self._delayed = self.clock.callLater(delay, self._send_due)
+                return
+            del self._pending[0]
+            self.transport.write(data)
+            self.sent += 1
+        delay = (self._started + self.connection.duration / self.speed -
+                 self.clock.seconds())
+        self._delayed = self.clock.callLater(
+            max(delay, 0), self.transport.loseConnection)
+
+    def _stalled(self):
+        self.stalled = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self._cancel(self._delayed)
+        self._cancel(self._stall)
+        self.done.callback(self)
+
+
+def replay_calls(connections, endpoint, speed=1.0, stall_timeout=5.0,
+                 clock=None):
+    """ Replay the captured calls in ``connections`` to the voice transport
+    listening on ``endpoint``, starting each at its captured time (divided
+    by ``speed``) relative to the first.
+
+    Client connections (those the transport made to originate calls) are
+    skipped: they only carry FreeSwitch's responses to the transport's own
+    commands.
+
+    Returns a Deferred that fires with the :class:`ReplayProtocol` of each
+    call once they have all finished.
+    """
+    clock = clock if clock is not None else reactor
+    calls = [conn for conn in connections if conn.kind == "call"]
+    if not calls:
+        return DeferredList([])
+    start = calls[0].opened
+    ds = []
+    for conn in calls:
+        d = Deferred()
+        d.addCallback(lambda _, conn=conn: _connect(
+            endpoint, ReplayProtocol(conn, speed, stall_timeout, clock)))
+        clock.callLater((conn.opened - start) / speed, d.callback, None)
+        ds.append(d)
+    d = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallback(lambda results: [proto for _, proto in results])
+    return d
+
+
+def _connect(endpoint, proto):
+    d = connectProtocol(endpoint, proto)
+    d.addCallback(lambda _: proto.done)
+    return d
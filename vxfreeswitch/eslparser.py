@@ -0,0 +1,139 @@
+# -*- test-case-name: vxfreeswitch.tests.test_eslparser -*-
+
+"""
+A buffer-based parser for the messages FreeSwitch sends over ESL.
+
+:class:`eventsocket.EventSocket` parses each header line separately (via
+Twisted's ``LineReceiver``, a regular expression and a ``StringIO`` that
+every message body is copied through). :class:`EventParser` instead keeps
+received data in a single ``bytearray``, finds the end of each header block
+and body with ``find`` and only URL-decodes values that contain a ``%``,
+while producing the same events.
+"""
+
+from urllib import unquote
+
+from eventsocket import EventProtocol, _O
+from twisted.internet import reactor
+
+
+# Content types whose bodies are passed on as is, rather than parsed as an
+# event (see EventSocket.rawDataReceived).
+RAW_RESPONSE_TYPES = ("api/response", "text/disconnect-notice")
+
+
+def parse_headers(block):
+    """ Parse ``Name: value`` lines into an :class:`eventsocket._O` the way
+    ``EventSocket.processLine`` does: dashes in names become underscores,
+    names and values are stripped, values are URL-decoded and lines without
+    a colon are ignored.
+    """
+    ev = _O()
+    if "\r" in block:
+        block = block.replace("\r", "")
+    for line in block.split("\n"):
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        value = value.strip()
+        if "%" in value:
+            value = unquote(value)
+        ev[name.replace("-", "_").strip()] = value
+    return ev
+
+
+def parse_body(body):
+    """ Parse an event body: its headers and, if they include a
+    ``Content-Length``, the ``rawresponse`` following them.
+    """
+    if body.startswith("\n"):
+        end, rest = 0, 1
+    else:
+        end = body.find("\n\n")
+        if end == -1:
+            return parse_headers(body)
+        rest = end + 2
+    ev = parse_headers(body[:end])
+    length = ev.get("Content_Length")
+    if length:
+        ev.rawresponse = body[rest:rest + int(length)]
+    return ev
+
+
+class EventParser(object):
+    """ Splits ESL data into events.
+
+    Each event is the message's headers as an :class:`eventsocket._O`,
+    with the parsed body (or, for API responses and disconnect notices, the
+    raw body as ``rawresponse``) as its ``data``, exactly as
+    :meth:`eventsocket.EventProtocol.eventReceived` receives it.
+    """
+
+    __slots__ = ('_buffer', '_ctx', '_body_length')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._ctx = None
+        self._body_length = None
+
+    def feed(self, data):
+        """ Add received data and return a list of the events completed by
+        it.
+        """
+        buf = self._buffer
+        buf += data
+        events = []
+        pos = 0
+        size = len(buf)
+        while True:
+            if self._ctx is None:
+                if pos == size:
+                    break
+                if buf[pos] == 10:  # A header block with no headers.
+                    end, next_pos = pos, pos + 1
+                else:
+                    end = buf.find("\n\n", pos)
+                    if end == -1:
+                        break
+                    next_pos = end + 2
+                ctx = parse_headers(str(buf[pos:end]))
+                pos = next_pos
+                length = ctx.get("Content_Length")
+                if length:
+                    self._ctx = ctx
+                    self._body_length = int(length)
+                else:
+                    ctx.data = _O()
+                    events.append(ctx)
+            else:
+                end = pos + self._body_length
+                if end > size:
+                    break
+                ctx, self._ctx = self._ctx, None
+                body = str(buf[pos:end])
+                pos = end
+                if ctx.get("Content_Type") in RAW_RESPONSE_TYPES:
+                    ctx.data = _O(rawresponse=body)
+                else:
+                    ctx.data = parse_body(body)
+                events.append(ctx)
+        del buf[:pos]
+        return events
+
+
+class EventParserMixin(object):
+    """ Parses the data an :class:`eventsocket.EventProtocol` receives with
+    an :class:`EventParser` instead of eventsocket's own parser, if its
+    ``event_parser`` is set.
+
+    Events are passed to ``eventReceived`` from the reactor, as
+    eventsocket does.
+    """
+
+    event_parser = None
+
+    def dataReceived(self, data):
+        if self.event_parser is None:
+            return EventProtocol.dataReceived(self, data)
+        for ctx in self.event_parser.feed(data):
+            reactor.callLater(0, self.eventReceived, ctx)
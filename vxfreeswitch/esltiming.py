@@ -0,0 +1,132 @@
+# -*- test-case-name: vxfreeswitch.tests.test_esltiming -*-
+
+"""
+Timing ESL commands from when they are written to when FreeSwitch replies.
+"""
+
+import time
+
+from vxfreeswitch.metrics import Histogram
+
+
+class CommandTimer(object):
+    """ Records ESL command round-trip times in a histogram per command
+    type (``esl.rtt.<command>``) and logs commands slower than a threshold.
+
+    :param float slow_threshold:
+        Seconds above which a command is logged as slow. ``None`` disables
+        logging.
+
+    :param log:
+        The logger to warn about slow commands on (a vumi worker's ``log``).
+
+    :param clock:
+        A function returning the current time in seconds.
+    """
+
+    def __init__(self, slow_threshold=None, log=None, clock=time.time):
+        self.slow_threshold = slow_threshold
+        self.log = log
+        self.clock = clock
+        self.histograms = {}
+        self._manager = None
+
+    def register(self, manager):
+        """ Publish the histograms with a metric manager, including those
+        for command types first seen later.
+        """
+        self._manager = manager
+        for histogram in self.histograms.values():
+            histogram.register(manager)
+        return self
+
+    def histogram(self, command):
+        histogram = self.histograms.get(command)
+        if histogram is None:
+            histogram = self.histograms[command] = Histogram(
+                'esl.rtt.%s' % (command,))
+            if self._manager is not None:
+                histogram.register(self._manager)
+        return histogram
+
+    def observe(self, command, rtt, context=None):
+        """ Record a round-trip time of ``rtt`` seconds for ``command``.
+        ``context`` (such as a call UUID) is included in the slow command
+        log message.
+        """
+        self.histogram(command).observe(rtt)
+        if self.slow_threshold is not None and rtt > self.slow_threshold:
+            self.log.warning("Slow ESL command %r%s: %.3fs" % (
+                command, "" if context is None else " on %s" % (context,),
+                rtt))
+
+
+class TimedCommandsMixin(object):
+    """ Times every command an :class:`eventsocket.EventProtocol` sends
+    with its ``command_timer``, if it has one.
+
+    Every ESL command is written with ``send``, ``rawSend`` or ``sendmsg``,
+    and FreeSwitch replies to commands in the order they were sent, so
+    commands are timed from when they are written to when the next
+    ``command/reply`` or ``api/response`` arrives. Subclasses can extend
+    :meth:`command_sent` and :meth:`command_replied` to see every command.
+    """
+
+    command_timer = None
+    # The name, arguments and start time of each command awaiting a reply,
+    # oldest first.
+    _sent_commands = ()
+
+    REPLY_CONTENT_TYPES = ('command/reply', 'api/response')
+
+    def command_context(self):
+        return None
+
+    def command_sent(self, name, args):
+        """ Called with each command's name and arguments as it is
+        written.
+        """
+
+    def command_replied(self, name, args, error):
+        """ Called with each command's name and arguments when its reply
+        arrives, with the reply text as ``error`` if the command failed and
+        ``None`` otherwise.
+        """
+
+    def _write_command(self, name, args):
+        start = None
+        if self.command_timer is not None:
+            start = self.command_timer.clock()
+        self._sent_commands += ((name, args, start),)
+        self.command_sent(name, args)
+
+    def send(self, cmd):
+        name, _, args = cmd.partition(" ")
+        self._write_command(name, args)
+        return super(TimedCommandsMixin, self).send(cmd)
+
+    def rawSend(self, stuff):
+        name, _, args = stuff.partition(" ")
+        self._write_command(name, args)
+        return super(TimedCommandsMixin, self).rawSend(stuff)
+
+    def sendmsg(self, name, arg=None, uuid="", lock=False):
+        self._write_command(name, arg)
+        return super(TimedCommandsMixin, self).sendmsg(name, arg, uuid, lock)
+
+    def eventReceived(self, ctx):
+        content_type = ctx.get('Content_Type')
+        if content_type in self.REPLY_CONTENT_TYPES and self._sent_commands:
+            (name, args, start), self._sent_commands = (
+                self._sent_commands[0], self._sent_commands[1:])
+            if self.command_timer is not None:
+                self.command_timer.observe(
+                    name, self.command_timer.clock() - start,
+                    self.command_context())
+            error = None
+            if content_type == 'command/reply':
+                reply_text = ctx.get('Reply_Text', '')
+                if not reply_text.startswith('+OK'):
+                    error = reply_text
+            self.command_replied(name, args, error)
+        return super(TimedCommandsMixin, self).eventReceived(ctx)
@@ -0,0 +1,84 @@
+# -*- test-case-name: vxfreeswitch.tests.test_lag -*-
+
+"""
+Event loop lag monitoring.
+"""
+
+
+class ReactorLagMonitor(object):
+    """ Measures how late the reactor runs delayed calls.
+
+    A probe is scheduled with ``callLater`` every ``interval`` seconds and
+    the difference between when it was due and when it actually ran is
+    recorded as the current lag.
+
+    :param float interval:
+        Seconds between probes.
+
+    :param float threshold:
+        Lag (in seconds) above which the reactor is considered to be
+        falling behind. ``None`` disables overload detection.
+
+    :param int samples:
+        The number of consecutive probes that must exceed the threshold
+        before the monitor reports an overload.
+
+    :param metric:
+        Optional vumi metric to record each lag measurement in.
+
+    :param on_change:
+        Optional function called with no arguments whenever
+        :attr:`overloaded` changes.
+
+    :param clock:
+        The reactor to probe. Defaults to the global reactor.
+    """
+
+    def __init__(self, interval, threshold=None, samples=1, metric=None,
+                 on_change=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = samples
+        self.metric = metric
+        self.on_change = on_change
+        self.clock = clock
+        self.lag = 0.0
+        self.overloaded = False
+        self._lagging_samples = 0
+        self._expected = None
+        self._delayed_call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+    def _schedule(self):
+        self._expected = self.clock.seconds() + self.interval
+        self._delayed_call = self.clock.callLater(self.interval, self._probe)
+
+    def _probe(self):
+        self.record_lag(max(0.0, self.clock.seconds() - self._expected))
+        self._schedule()
+
+    def record_lag(self, lag):
+        self.lag = lag
+        if self.metric is not None:
+            self.metric.set(lag)
+        if self.threshold is None:
+            return
+        if lag > self.threshold:
+            self._lagging_samples += 1
+            overloaded = self._lagging_samples >= self.samples
+        else:
+            self._lagging_samples = 0
+            overloaded = False
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if self.on_change is not None:
+                self.on_change()
@@ -0,0 +1,135 @@
+# -*- test-case-name: vxfreeswitch.tests.test_metrics -*-
+
+"""
+Metrics that aggregate in-process and are read when vumi's
+:class:`vumi.blinkenlights.metrics.MetricManager` publishes.
+"""
+
+import time
+from bisect import bisect_left
+
+from vumi.blinkenlights.metrics import Metric, AVG, MAX, SUM
+
+
+class Gauge(Metric):
+    """ A metric whose value is read from a function each time the metric
+    manager publishes, so that nothing needs to be recorded as the value
+    changes.
+
+    :param str name:
+        The name of the metric.
+
+    :param func:
+        A function of no arguments returning the current value, or ``None``
+        if there is no value to publish.
+    """
+
+    DEFAULT_AGGREGATORS = [AVG, MAX]
+
+    def __init__(self, name, func, aggregators=None):
+        super(Gauge, self).__init__(name, aggregators)
+        self.func = func
+
+    def poll(self):
+        value = self.func()
+        if value is None:
+            return []
+        return [(int(time.time()), value)]
+
+
+class Histogram(object):
+    """ Counts observations (such as latencies) into buckets.
+
+    Observing a value only increments a few counters. When published, the
+    observations since the last publish are reported as the metrics
+    ``<name>.count``, ``<name>.avg``, ``<name>.max`` and, for each bucket,
+    ``<name>.le_<bound>`` (the number of observations no greater than
+    ``bound`` and greater than the previous bound, with ``le_inf`` for the
+    rest). Counts can be summed across workers and over time.
+
+    :param str name:
+        The prefix for the names of the histogram's metrics.
+
+    :param buckets:
+        The upper bounds of the buckets.
+    """
+
+    DEFAULT_BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(sorted(buckets))
+        # Totals since the histogram was created, for percentiles.
+        self.totals = [0] * (len(self.buckets) + 1)
+        # Observations since the last publish, cleared as they are read.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._sum_count = 0
+        self._max = None
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        self.totals[i] += 1
+        self._counts[i] += 1
+        self._count += 1
+        self._sum += value
+        self._sum_count += 1
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def percentile(self, q):
+        """ Estimate the ``q``th percentile (0 to 100) of every observation
+        as the upper bound of the bucket it falls in. Returns ``None`` if
+        nothing has been observed, or ``float('inf')`` if the percentile is
+        above the highest bound.
+        """
+        total = sum(self.totals)
+        if not total:
+            return None
+        rank = max(1, q / 100.0 * total)
+        seen = 0
+        for bound, count in zip(self.buckets, self.totals):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def metrics(self):
+        """ Return the metrics to register with a metric manager. """
+        metrics = [
+            Gauge(self.name + '.count', self._take_count, [SUM]),
+            Gauge(self.name + '.avg', self._take_avg, [AVG]),
+            Gauge(self.name + '.max', self._take_max, [MAX]),
+        ]
+        labels = [('%g' % b).replace('.', '_') for b in self.buckets]
+        for i, label in enumerate(labels + ['inf']):
+            metrics.append(Gauge(
+                '%s.le_%s' % (self.name, label),
+                lambda i=i: self._take_bucket(i), [SUM]))
+        return metrics
+
+    def register(self, manager):
+        for metric in self.metrics():
+            manager.register(metric)
+        return self
+
+    def _take_count(self):
+        count, self._count = self._count, 0
+        return count or None
+
+    def _take_avg(self):
+        # The sum has its own count so that publishing doesn't depend on the
+        # order the metrics are polled in.
+        total, self._sum = self._sum, 0.0
+        count, self._sum_count = self._sum_count, 0
+        return total / count if count else None
+
+    def _take_max(self):
+        value, self._max = self._max, None
+        return value
+
+    def _take_bucket(self, i):
+        count, self._counts[i] = self._counts[i], 0
+        return count or None
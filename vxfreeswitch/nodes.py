@@ -0,0 +1,268 @@
+# -*- test-case-name: vxfreeswitch.tests.test_nodes -*-
+
+"""
+Spreading outbound calls over several FreeSwitch nodes.
+"""
+
+import re
+
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.python import log
+
+from vxfreeswitch.client import (
+    CircuitBreaker, FreeSwitchClient, FreeSwitchClientError,
+    FreeSwitchConnectionError)
+
+
+class NoFreeSwitchNodeAvailable(FreeSwitchClientError):
+    """ Raised when every FreeSwitch node is down or at its channel limit. """
+
+
+STATUS_SESSIONS_RE = re.compile(r"^(\d+) session\(s\) - peak", re.MULTILINE)
+STATUS_MAX_SESSIONS_RE = re.compile(r"^(\d+) session\(s\) max", re.MULTILINE)
+
+
+def parse_status(status):
+    """ Return the ``(sessions, max_sessions)`` reported by FreeSwitch's
+    ``status`` API command.
+    """
+    sessions = STATUS_SESSIONS_RE.search(status)
+    max_sessions = STATUS_MAX_SESSIONS_RE.search(status)
+    if sessions is None or max_sessions is None:
+        raise ValueError("Unrecognised status response: %r" % (status,))
+    return int(sessions.group(1)), int(max_sessions.group(1))
+
+
+class FreeSwitchNode(object):
+    """ A FreeSwitch server that outbound calls can be originated on.
+
+    :param str name:
+        Name of the node, used in log messages and metric names.
+
+    :type client:
+        :class:`vxfreeswitch.client.FreeSwitchClient`
+    :param client:
+        Client for making API calls to the node.
+
+    :param int weight:
+        The share of calls this node should get relative to other nodes.
+
+    :param int max_channels:
+        The most calls to have active on this node at once. ``None`` means
+        no limit.
+    """
+
+    def __init__(self, name, client, weight=1, max_channels=None):
+        self.name = name
+        self.client = client
+        self.weight = weight
+        self.max_channels = max_channels
+        self.active_channels = 0
+        # Reported by FreeSwitch when polled, None until the first poll.
+        self.sessions = None
+        self.max_sessions = None
+        self.calls_since_poll = 0
+        self.poll_failed = False
+
+    def __repr__(self):
+        return "<%s name=%r>" % (self.__class__.__name__, self.name)
+
+    def is_up(self):
+        """ Return ``False`` while the client's circuit breaker is open or
+        if the node couldn't be connected to when it was last polled.
+        """
+        if self.poll_failed:
+            return False
+        breaker = self.client.breaker
+        return breaker is None or breaker.state != breaker.OPEN
+
+    def headroom(self):
+        """ The number of sessions FreeSwitch had free when last polled,
+        less the calls originated on it since then, or ``None`` if it hasn't
+        been polled.
+        """
+        if self.max_sessions is None:
+            return None
+        return self.max_sessions - self.sessions - self.calls_since_poll
+
+    def has_headroom(self):
+        headroom = self.headroom()
+        return headroom is None or headroom > 0
+
+    def has_capacity(self):
+        if not self.has_headroom():
+            return False
+        return (self.max_channels is None or
+                self.active_channels < self.max_channels)
+
+    def update_status(self, sessions, max_sessions):
+        self.sessions = sessions
+        self.max_sessions = max_sessions
+        self.calls_since_poll = 0
+        self.poll_failed = False
+
+    def load(self):
+        """ The load on the node if it were given one more call, scaled by
+        its weight.
+        """
+        return (self.active_channels + 1.0) / self.weight
+
+    @classmethod
+    def from_config(cls, config, failure_threshold=None, reset_timeout=30,
+                    command_timer=None, fast_parser=False, esl_capture=None):
+        """ Build a node from a dict with ``name``, ``endpoint``, ``auth``,
+        ``weight`` and ``max_channels`` keys. Only ``endpoint`` (an already
+        parsed client endpoint) is required.
+
+        If ``failure_threshold`` is given, the node's client gets a
+        :class:`vxfreeswitch.client.CircuitBreaker`. ``command_timer``,
+        ``fast_parser`` and ``esl_capture`` are passed on to the client.
+        """
+        breaker = None
+        if failure_threshold is not None:
+            breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        return cls(
+            config.get('name') or str(config['endpoint']),
+            FreeSwitchClient(
+                config['endpoint'], config.get('auth'), breaker=breaker,
+                command_timer=command_timer, fast_parser=fast_parser,
+                esl_capture=esl_capture),
+            weight=config.get('weight', 1),
+            max_channels=config.get('max_channels'))
+
+
+class FreeSwitchNodePool(object):
+    """ Chooses FreeSwitch nodes to originate calls on.
+
+    Calls go to the node with the lowest load (active calls relative to its
+    weight) that is up and below its channel limit, so heavier nodes get
+    proportionally more calls. Nodes with equal load are taken in turn.
+
+    If a node can't be connected to, the call is tried on the next node.
+    Nodes whose client's circuit breaker is open, or that couldn't be
+    connected to when last polled, are skipped.
+
+    :param list nodes:
+        The :class:`FreeSwitchNode` instances to use.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self._calls = {}
+        self._next = 0
+
+    def candidates(self):
+        """ Return the nodes that can take a call, best first. """
+        n = len(self.nodes)
+        # Rotate the starting point so that nodes with equal load take
+        # turns. The sort is stable, so this order breaks ties.
+        start, self._next = self._next, (self._next + 1) % n
+        rotated = self.nodes[start:] + self.nodes[:start]
+        return sorted(
+            [node for node in rotated
+             if node.is_up() and node.has_capacity()],
+            key=lambda node: node.load())
+
+    @inlineCallbacks
+    def api(self, command):
+        """ Originate a call with an API command on the best available
+        node, failing over to the next node if a node can't be connected
+        to.
+
+        The node is charged for the call as soon as it is chosen, so that
+        calls still being dialed count towards its load, channel limit and
+        headroom. The charge is refunded if the command fails. Otherwise
+        the call keeps counting against the node's headroom until it is
+        next polled, and against its channels
+        until the call is passed to :meth:`call_started` and then
+        :meth:`call_ended`, or to :meth:`release` if it is given up on.
+
+        :return:
+            A Deferred that fires with ``(node, reply)``.
+        """
+        for node in self.candidates():
+            # Calls charged while earlier nodes were tried may have filled
+            # this one.
+            if not node.has_capacity():
+                continue
+            self._charge(node)
+            try:
+                reply = yield node.client.api(command)
+            except FreeSwitchConnectionError:
+                self._refund(node)
+                continue
+            except Exception:
+                self._refund(node)
+                raise
+            returnValue((node, reply))
+        raise NoFreeSwitchNodeAvailable(
+            "No FreeSwitch node available (%s)" % (", ".join(
+                self._describe(node) for node in self.nodes),))
+
+    def _describe(self, node):
+        if node.poll_failed:
+            return "%s: poll failed" % (node.name,)
+        if not node.is_up():
+            return "%s: circuit open" % (node.name,)
+        if not node.has_headroom():
+            return "%s: %d/%d sessions" % (
+                node.name, node.max_sessions - node.headroom(),
+                node.max_sessions)
+        return "%s: %d/%s channels" % (
+            node.name, node.active_channels,
+            "-" if node.max_channels is None else node.max_channels)
+
+    def call_started(self, call_uuid, node):
+        """ Attach the call that :meth:`api` charged to ``node`` to
+        ``call_uuid``, so that the charge lasts until :meth:`call_ended`.
+        """
+        self._calls[call_uuid] = node
+
+    def call_ended(self, call_uuid):
+        node = self._calls.pop(call_uuid, None)
+        if node is not None:
+            self.release(node)
+
+    def release(self, node):
+        """ Stop counting a call :meth:`api` charged to ``node`` against its
+        channels.
+        """
+        node.active_channels -= 1
+
+    def _charge(self, node):
+        node.active_channels += 1
+        node.calls_since_poll += 1
+
+    def _refund(self, node):
+        self.release(node)
+        # The node may have been polled since it was charged.
+        node.calls_since_poll = max(0, node.calls_since_poll - 1)
+
+    def has_headroom(self, reserved=0):
+        """ Return ``False`` if polling shows that FreeSwitch has no more
+        than ``reserved`` free sessions over all the nodes that are up.
+        """
+        up = [node for node in self.nodes if node.is_up()]
+        headrooms = [node.headroom() for node in up]
+        if not up or None in headrooms:
+            return True
+        return sum(max(0, headroom) for headroom in headrooms) > reserved
+
+    def poll(self):
+        """ Ask every node for its session count and limit.
+
+        This also checks that the nodes are up: a node that can't be
+        connected to is skipped until it is polled successfully, and the
+        failure counts against its circuit breaker.
+        """
+        return gatherResults([self.poll_node(node) for node in self.nodes])
+
+    @inlineCallbacks
+    def poll_node(self, node):
+        try:
+            status = yield node.client.raw_api("status")
+            node.update_status(*parse_status(status))
+        except FreeSwitchConnectionError:
+            node.poll_failed = True
+        except Exception:
+            log.err(None, "Error polling FreeSwitch node %r" % (node.name,))
@@ -4,6 +4,37 @@
 Utilities for creating originate FreeSwitch API calls.
 """
 
+import operator
+import random
+import re
+from string import Formatter
+
+
+ORIGINATE_ERROR_RE = re.compile(r"^-ERR\s+([A-Z_]+)")
+
+
+def originate_failure_cause(reply):
+    """ Return the hangup cause from a failed originate's reply (e.g.
+    ``'NORMAL_TEMPORARY_FAILURE'`` from
+    ``'-ERR NORMAL_TEMPORARY_FAILURE'``), or ``None`` if there isn't one.
+    """
+    match = ORIGINATE_ERROR_RE.match(reply.strip())
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def backoff_delay(attempt, base, maximum, rand=random.random):
+    """ Return how long to wait before retry number ``attempt`` (counting
+    from zero).
+
+    The delay doubles with each attempt up to ``maximum`` and is then
+    jittered to between half and all of that, so that calls that failed
+    together don't all retry together.
+    """
+    delay = min(maximum, base * (2 ** attempt))
+    return delay / 2.0 + rand() * delay / 2.0
+
 
 class OriginateMissingParameter(Exception):
     """ Raised if required originate parameters are missing. """
@@ -82,8 +113,38 @@ class OriginateFormatter(object):
         'timeout': 60,
     }
 
+    SLOTS = ('from_addr', 'to_addr', 'uuid')
+
     def __init__(self, **kw):
         self.template = self.format_template(**kw)
+        self._plan = self.compile_template(self.template)
+
+    @classmethod
+    def compile_template(cls, template):
+        """ Compile a call template into a ``%``-style format string and a
+        function that picks the values for it from a ``(from_addr, to_addr,
+        uuid)`` tuple, so that formatting a call doesn't need to parse the
+        template again.
+
+        Returns ``None`` for templates with fields other than plain
+        ``{from_addr}``, ``{to_addr}`` and ``{uuid}`` (e.g. with format
+        specs). These are formatted with :meth:`str.format` as usual.
+        """
+        fmt = []
+        order = []
+        for literal, field, spec, conversion in Formatter().parse(template):
+            fmt.append(literal.replace('%', '%%'))
+            if field is None:
+                continue
+            if field not in cls.SLOTS or spec or conversion:
+                return None
+            fmt.append('%s')
+            order.append(cls.SLOTS.index(field))
+        if not order:
+            return ''.join(fmt), lambda values: ()
+        # itemgetter returns a single item rather than a tuple when given
+        # one index, which % accepts just the same.
+        return ''.join(fmt), operator.itemgetter(*order)
 
     def format_call(self, from_addr, to_addr, uuid):
         """ Return a formatted originate call.
@@ -100,8 +161,13 @@ class OriginateFormatter(object):
         :returns str:
             A formatted originate call for passing to Freeswitch.
         """
-        return self.template.format(
-            from_addr=from_addr, to_addr=to_addr, uuid=uuid)
+        if self._plan is None:
+            return self.template.format(
+                from_addr=from_addr, to_addr=to_addr, uuid=uuid)
+        fmt, pick = self._plan
+        # % returns unicode if any value is, where str.format returns the
+        # template's type (raising if a value doesn't fit in it).
+        return type(fmt)(fmt % pick((from_addr, to_addr, uuid)))
 
     @classmethod
     def format_template(cls, **kw):
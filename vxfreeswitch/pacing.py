@@ -0,0 +1,210 @@
+# -*- test-case-name: vxfreeswitch.tests.test_pacing -*-
+
+"""
+Adapting how many outbound calls are dialed at once to how they fare.
+"""
+
+from collections import deque
+
+
+class DialPacer(object):
+    """ Limits the number of originates in progress (dialed but not yet
+    answered or failed) and adjusts the limit AIMD-style.
+
+    Each answered call raises the limit by ``increase / limit`` (so by
+    ``increase`` once a whole limit's worth of calls has been answered), as
+    long as the answer rate over the last ``window`` calls is at least
+    ``target_answer_rate`` and calls are answered within ``max_answer_time``.
+    A failure with one of the ``congestion_causes``, or a full window whose
+    answer rate is below the target, multiplies the limit by ``decrease``.
+    The limit is kept between ``min_limit`` and ``max_limit``.
+
+    :param int min_limit:
+        The lowest the limit may go.
+
+    :param int max_limit:
+        The highest the limit may go. The pacer starts at this limit.
+
+    :param int window:
+        The number of recent call outcomes the answer rate is measured over.
+
+    :param float target_answer_rate:
+        The lowest answer rate (between 0 and 1) at which the limit is
+        raised.
+
+    :param float max_answer_time:
+        The average seconds from dialing to answer above which the limit is
+        no longer raised. ``None`` means no limit.
+
+    :param float increase:
+        How much to raise the limit by per limit's worth of answered calls.
+
+    :param float decrease:
+        The factor to multiply the limit by when backing off.
+
+    :param congestion_causes:
+        FreeSwitch hangup causes that mean the trunks are overloaded.
+
+    :param dict metrics:
+        Optional vumi metrics, keyed by ``limit``, ``in_flight``,
+        ``answer_rate`` and ``answer_time``, to record the pacer's state in.
+
+    :param on_release:
+        Optional function to call with no arguments whenever a slot is
+        released.
+
+    :param clock:
+        The reactor to measure time to answer with. Defaults to the global
+        reactor.
+    """
+
+    def __init__(self, min_limit, max_limit, window=20,
+                 target_answer_rate=0.5, max_answer_time=None, increase=1.0,
+                 decrease=0.5, congestion_causes=(), metrics=None,
+                 on_release=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_answer_rate = target_answer_rate
+        self.max_answer_time = max_answer_time
+        self.increase = increase
+        self.decrease = decrease
+        self.congestion_causes = frozenset(congestion_causes)
+        self.metrics = metrics or {}
+        self.on_release = on_release
+        self.clock = clock
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._outcomes = deque(maxlen=window)
+        self._answer_times = deque(maxlen=window)
+        self._outcomes_since_decrease = 0
+        self._dialing = {}
+
+    def state(self):
+        """ Return the pacer's current state as a dict. """
+        return {
+            'limit': self.current_limit(),
+            'in_flight': self.in_flight,
+            'answer_rate': self.answer_rate(),
+            'answer_time': self.answer_time(),
+        }
+
+    def current_limit(self):
+        return int(self.limit)
+
+    def answer_rate(self):
+        """ The fraction of recent calls that were answered, or ``None`` if
+        there are no recent calls.
+        """
+        if not self._outcomes:
+            return None
+        return float(sum(self._outcomes)) / len(self._outcomes)
+
+    def answer_time(self):
+        """ The average seconds from dialing to answer of recently answered
+        calls, or ``None`` if none have been answered.
+        """
+        if not self._answer_times:
+            return None
+        return sum(self._answer_times) / len(self._answer_times)
+
+    def has_slot(self):
+        """ Return ``True`` if another originate may start now. """
+        return self.in_flight < self.current_limit()
+
+    def dial_started(self, call_uuid, started):
+        """ Take a slot for call ``call_uuid``, dialed at ``started``
+        (in seconds since the epoch). The slot is held until
+        :meth:`dial_failed`, :meth:`call_answered`, :meth:`call_ended` or
+        :meth:`call_adopted` releases it.
+        """
+        self.in_flight += 1
+        self._dialing[call_uuid] = started
+        self._record_state()
+
+    def call_renamed(self, call_uuid, new_call_uuid):
+        """ Move the slot of ``call_uuid`` to ``new_call_uuid``, for calls
+        whose UUID is only known once FreeSwitch replies to the originate.
+        """
+        if call_uuid in self._dialing:
+            self._dialing[new_call_uuid] = self._dialing.pop(call_uuid)
+
+    def dial_failed(self, call_uuid, cause):
+        """ Release the slot of a call whose originate failed with
+        ``cause``, which may be ``None`` if FreeSwitch didn't give one.
+        """
+        if self._dialing.pop(call_uuid, None) is None:
+            return
+        if cause in self.congestion_causes:
+            self._back_off()
+        self._record_outcome(False)
+        self._release_slot()
+
+    def call_answered(self, call_uuid):
+        started = self._dialing.pop(call_uuid, None)
+        if started is None:
+            return
+        self._answer_times.append(self.clock.seconds() - started)
+        self._record_outcome(True)
+        if self._may_increase():
+            self.limit = min(
+                self.max_limit, self.limit + self.increase / self.limit)
+        self._release_slot()
+
+    def call_ended(self, call_uuid):
+        """ Release the slot of a call that ended or was given up on before
+        it was answered. Calls that were answered are ignored.
+        """
+        if self._dialing.pop(call_uuid, None) is None:
+            return
+        self._record_outcome(False)
+        self._release_slot()
+
+    def call_adopted(self, call_uuid):
+        """ Release the slot of a call that another worker took over,
+        without recording an outcome, since only that worker sees whether
+        the call is answered.
+        """
+        self.dial_cancelled(call_uuid)
+
+    def dial_cancelled(self, call_uuid):
+        """ Release the slot of a call that was given up on before it was
+        dialed, without recording an outcome.
+        """
+        if self._dialing.pop(call_uuid, None) is None:
+            return
+        self._release_slot()
+
+    def _may_increase(self):
+        if self.answer_rate() < self.target_answer_rate:
+            return False
+        answer_time = self.answer_time()
+        return self.max_answer_time is None or (
+            answer_time <= self.max_answer_time)
+
+    def _record_outcome(self, answered):
+        self._outcomes.append(answered)
+        self._outcomes_since_decrease += 1
+        # Only back off for a poor answer rate once per window, so that the
+        # calls dialed at the old limit don't drive it straight down to the
+        # minimum.
+        if (self._outcomes_since_decrease >= self._outcomes.maxlen and
+                self.answer_rate() < self.target_answer_rate):
+            self._back_off()
+
+    def _back_off(self):
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self._outcomes_since_decrease = 0
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._record_state()
+        if self.on_release is not None:
+            self.on_release()
+
+    def _record_state(self):
+        for name, value in self.state().iteritems():
+            metric = self.metrics.get(name)
+            if metric is not None and value is not None:
+                metric.set(value)
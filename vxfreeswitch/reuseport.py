@@ -0,0 +1,154 @@
+# -*- test-case-name: vxfreeswitch.tests.test_reuseport -*-
+
+"""
+Listening on a TCP port shared between several processes.
+
+With ``SO_REUSEPORT`` each transport worker process binds its own listening
+socket to the same port and the kernel spreads incoming connections between
+them, so a host can run one transport process per core.
+"""
+
+import socket
+from collections import namedtuple
+
+from twisted.internet.defer import execute
+
+from vumi.config import ConfigServerEndpoint
+
+
+TCPAddress = namedtuple(
+    'TCPAddress', ['family', 'interface', 'port', 'backlog'])
+
+# The address family, positional parameter names and wildcard interface of
+# each endpoint type that can be listened on with SO_REUSEPORT, as parsed by
+# Twisted's serverFromString.
+TCP_ENDPOINT_TYPES = {
+    'tcp': (socket.AF_INET, ('port', 'interface', 'backlog'), '0.0.0.0'),
+    'tcp6': (socket.AF_INET6, ('port', 'backlog', 'interface'), '::'),
+}
+
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def _split_description(description):
+    """ Split a server endpoint description into ``(key, value)`` pairs,
+    with a key of ``None`` for positional arguments. Backslashes escape the
+    next character, as in :func:`twisted.internet.endpoints.serverFromString`.
+    """
+    parts = []
+    key, value = None, ''
+    chars = iter(description)
+    for char in chars:
+        if char == '\\':
+            value += next(chars, '')
+        elif char == '=' and key is None:
+            key, value = value, ''
+        elif char == ':':
+            parts.append((key, value))
+            key, value = None, ''
+        else:
+            value += char
+    parts.append((key, value))
+    return parts
+
+
+def parse_tcp_address(description):
+    """ Return the :class:`TCPAddress` that a ``tcp`` or ``tcp6`` server
+    endpoint description listens on, or ``None`` if the description is for
+    another type of endpoint.
+    """
+    parts = _split_description(description)
+    endpoint_type = parts.pop(0)[1]
+    if endpoint_type not in TCP_ENDPOINT_TYPES:
+        return None
+    family, names, wildcard = TCP_ENDPOINT_TYPES[endpoint_type]
+    params = {'interface': '', 'backlog': 50}
+    params.update(zip(names, [value for key, value in parts if key is None]))
+    params.update((key, value) for key, value in parts if key is not None)
+    return TCPAddress(
+        family, params['interface'] or wildcard, int(params['port']),
+        int(params['backlog']))
+
+
+class ListenEndpoint(object):
+    """ A server endpoint along with the TCP address it listens on.
+
+    :param endpoint:
+        The :class:`twisted.internet.interfaces.IStreamServerEndpoint` to
+        listen with.
+
+    :type address: :class:`TCPAddress`
+    :param address:
+        The address the endpoint listens on, or ``None`` if it isn't a TCP
+        endpoint.
+    """
+
+    def __init__(self, endpoint, address):
+        self.endpoint = endpoint
+        self.address = address
+
+    def __repr__(self):
+        return "<%s endpoint=%r address=%r>" % (
+            self.__class__.__name__, self.endpoint, self.address)
+
+    def listen(self, factory):
+        return self.endpoint.listen(factory)
+
+
+class ConfigListenEndpoint(ConfigServerEndpoint):
+    """ A server endpoint config field whose value is a
+    :class:`ListenEndpoint`, so that :func:`listen_reuse_port` can listen on
+    its address.
+    """
+
+    def clean(self, value):
+        endpoint = super(ConfigListenEndpoint, self).clean(value)
+        return ListenEndpoint(endpoint, parse_tcp_address(value))
+
+
+def _reuse_port_socket(family, interface, port, backlog):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def listen_reuse_port(address, factory, reactor=None):
+    """ Listen on a TCP address with ``SO_REUSEPORT`` set.
+
+    :type address: :class:`TCPAddress`
+    :param address:
+        The address to listen on.
+
+    :param factory:
+        The protocol factory to serve connections with.
+
+    :param reactor:
+        The reactor to listen with. Defaults to the global reactor.
+
+    :return:
+        A Deferred that fires with the listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    def listen():
+        sock = _reuse_port_socket(
+            address.family, address.interface, address.port, address.backlog)
+        try:
+            # The reactor adopts a duplicate of the descriptor.
+            return reactor.adoptStreamPort(
+                sock.fileno(), address.family, factory)
+        finally:
+            sock.close()
+
+    return execute(listen)
@@ -0,0 +1,89 @@
+# -*- test-case-name: vxfreeswitch.tests.test_routing -*-
+
+"""
+Choosing originate parameters by destination prefix.
+"""
+
+from vxfreeswitch.originate import OriginateFormatter
+
+
+class PrefixTrie(object):
+    """ Maps string prefixes to values and finds the value for the longest
+    prefix of a string in time proportional to the length of the string.
+    """
+
+    def __init__(self):
+        # Each node is a dict of child nodes keyed by character. A node's
+        # value, if it has one, is stored under the key None.
+        self._root = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def insert(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if None not in node:
+            self._len += 1
+        node[None] = value
+
+    def longest_match(self, s, default=None):
+        """ Return the value for the longest prefix of ``s`` in the trie, or
+        ``default`` if no prefix of ``s`` is.
+        """
+        node = self._root
+        value = node.get(None, default)
+        for char in s:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+
+class OriginateRouter(object):
+    """ Chooses an :class:`vxfreeswitch.originate.OriginateFormatter` for
+    each destination address.
+
+    :param dict default_parameters:
+        Originate parameters for destinations that match no route.
+
+    :param dict routes:
+        Maps destination address prefixes to originate parameters. Each
+        route's parameters override the defaults for destinations starting
+        with its prefix; the longest matching prefix wins.
+
+    :raises vxfreeswitch.originate.OriginateMissingParameter:
+        If a route (combined with the defaults) is missing a required
+        parameter.
+    """
+
+    def __init__(self, default_parameters, routes=None):
+        self.default = OriginateFormatter(**default_parameters)
+        self.timeouts = [self.get_timeout(default_parameters)]
+        self.routes = PrefixTrie()
+        for prefix, parameters in (routes or {}).iteritems():
+            parameters = dict(default_parameters, **parameters)
+            self.routes.insert(prefix, OriginateFormatter(**parameters))
+            self.timeouts.append(self.get_timeout(parameters))
+
+    @staticmethod
+    def get_timeout(parameters):
+        return int(parameters.get(
+            'timeout', OriginateFormatter.DEFAULT_PARAMS['timeout']))
+
+    def max_timeout(self):
+        """ The longest originate timeout of any route. """
+        return max(self.timeouts)
+
+    def formatter_for(self, to_addr):
+        return self.routes.longest_match(to_addr, self.default)
+
+    def format_call(self, from_addr, to_addr, uuid):
+        """ Return the originate call for ``to_addr``, as for
+        :meth:`vxfreeswitch.originate.OriginateFormatter.format_call`.
+        """
+        return self.formatter_for(to_addr).format_call(
+            from_addr, to_addr, uuid)
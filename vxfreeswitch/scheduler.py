@@ -0,0 +1,121 @@
+# -*- test-case-name: vxfreeswitch.tests.test_scheduler -*-
+
+"""
+A timer heap for scheduling many keyed callbacks with one delayed call.
+"""
+
+import heapq
+import itertools
+
+from twisted.python import log
+
+
+_CANCELLED = object()
+
+
+class Scheduler(object):
+    """ Runs callbacks at given times.
+
+    Pending callbacks are kept in a heap ordered by when they are due and
+    only the earliest one has a reactor delayed call, so scheduling and
+    cancelling stay cheap with tens of thousands of pending callbacks.
+
+    Each callback is scheduled under a key. Scheduling a new callback under
+    an existing key replaces the old one. Cancelled callbacks stay in the
+    heap until they are due, unless they come to outnumber the pending
+    ones, when the heap is rebuilt without them. This keeps timers that are
+    pushed back often (like a call's idle timer) from filling the heap.
+
+    :param clock:
+        The reactor to schedule on. Defaults to the global reactor.
+    """
+
+    # The fewest cancelled entries worth rebuilding the heap for.
+    MIN_COMPACT = 64
+
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._delayed_call = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, delay, f, *args, **kw):
+        """ Call ``f(*args, **kw)`` in ``delay`` seconds. """
+        self.cancel(key)
+        # Most callbacks have no keyword arguments, so don't keep an empty
+        # dict for each.
+        entry = [
+            self.clock.seconds() + delay, next(self._counter),
+            key, f, args, kw or None]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._reschedule()
+
+    def cancel(self, key):
+        """ Cancel the callback scheduled under ``key``, if any. """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        # Cancelled entries are left in the heap and skipped when they reach
+        # the top.
+        entry[2] = _CANCELLED
+        self._cancelled += 1
+        if self._cancelled > max(len(self._entries), self.MIN_COMPACT):
+            self._compact()
+
+    def _compact(self):
+        self._heap = [
+            entry for entry in self._heap if entry[2] is not _CANCELLED]
+        heapq.heapify(self._heap)
+        self._cancelled = 0
+
+    def stop(self):
+        """ Cancel all pending callbacks. """
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+
+    def _reschedule(self):
+        heap = self._heap
+        while heap and heap[0][2] is _CANCELLED:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if not heap:
+            if self._delayed_call is not None and self._delayed_call.active():
+                self._delayed_call.cancel()
+            self._delayed_call = None
+            return
+        delay = max(0, heap[0][0] - self.clock.seconds())
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.reset(delay)
+        else:
+            self._delayed_call = self.clock.callLater(delay, self._run)
+
+    def _run(self):
+        self._delayed_call = None
+        now = self.clock.seconds()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            when, _, key, f, args, kw = heapq.heappop(heap)
+            if key is _CANCELLED:
+                self._cancelled -= 1
+                continue
+            del self._entries[key]
+            try:
+                f(*args, **(kw or {}))
+            except Exception:
+                log.err(None, "Error running scheduled call for %r" % (key,))
+        self._reschedule()
@@ -0,0 +1,577 @@
+# -*- test-case-name: vxfreeswitch.tests.test_simulator -*-
+
+"""
+A simulated FreeSwitch, for exercising the voice transport without one.
+
+:class:`SimulatedCall` is a call's outbound socket connection from
+FreeSwitch to the transport. It replies to the transport's commands and
+can send DTMF digits and hang up. :class:`FreeSwitchSimulator` opens
+simulated calls to a transport, runs a script on each of them and serves
+FreeSwitch's inbound ESL socket so that the transport can originate calls
+on it, answering them with a configurable latency and failure rate.
+
+:class:`RecordingServer` is a simpler ESL server that replies to commands
+with fixtures, for tests of the ESL client.
+"""
+
+import random
+import time
+from uuid import uuid4
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError, Deferred, DeferredList, DeferredQueue, inlineCallbacks,
+    returnValue, succeed)
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.protocol import Factory, Protocol
+from twisted.protocols.basic import LineReceiver
+
+
+class EslCommand(object):
+    """
+    An object representing an ESL command.
+    """
+    def __init__(self, cmd_type, params=None):
+        self.cmd_type = cmd_type
+        self.params = params if params is not None else {}
+
+    def __repr__(self):
+        return "<%s cmd_type=%r params=%r>" % (
+            self.__class__.__name__, self.cmd_type, self.params)
+
+    def __eq__(self, other):
+        if not isinstance(other, EslCommand):
+            return NotImplemented
+        return (self.cmd_type == other.cmd_type and
+                self.params == other.params)
+
+    def __getitem__(self, name):
+        return self.params.get(name)
+
+    def __setitem__(self, name, value):
+        self.params[name] = value
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Convert a dict to an :class:`EslCommand`.
+        """
+        cmd_type = d.get("type")
+        params = {
+            "call-command": d.get("call-command", "execute"),
+            "event-lock": d.get("event-lock", "true"),
+        }
+        if "name" in d:
+            params["execute-app-name"] = d.get("name")
+        if "arg" in d:
+            params["execute-app-arg"] = d.get("arg")
+        return cls(cmd_type, params)
+
+
+class EslParser(object):
+    """
+    Simple in-efficient parser for the FreeSwitch eventsocket protocol.
+    """
+
+    def __init__(self):
+        self.data = ""
+
+    def parse(self, new_data):
+        data = self.data + new_data
+        cmds = []
+        while "\n\n" in data:
+            cmd_data, data = data.split("\n\n", 1)
+            command = EslCommand("unknown")
+            first_line = True
+            for line in cmd_data.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                if first_line:
+                    command.cmd_type = line.strip()
+                    first_line = False
+                    continue
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    command[key] = value.strip()
+            cmds.append(command)
+        self.data = data
+        return cmds
+
+
+class FixtureResponse(object):
+    """ A response to an ESL command. """
+
+    AUTH_REQUEST = 'auth/request'
+    API_RESPONSE = 'api/response'
+    REPLY = 'command/reply'
+    EVENT = 'text/event-plain'
+
+    def __init__(self, content_type, content=None, headers=()):
+        self.content_type = content_type
+        self.content = content
+        self.headers = headers
+
+    def to_bytes(self):
+        lines = []
+        lines.append("Content-Type: %s\n" % self.content_type)
+        if self.content is not None:
+            lines.append("Content-Length: %d\n" % len(self.content))
+        lines.extend("%s: %s\n" % (k, v) for k, v in self.headers)
+        lines.append("\n")
+        if self.content is not None:
+            lines.append(self.content)
+        return "".join(lines)
+
+
+class FixtureReply(FixtureResponse):
+    """ A reply to an ESL command. """
+
+    def __init__(self, *args):
+        headers = [("Reply-Text", " ".join(args))]
+        super(FixtureReply, self).__init__(self.REPLY, headers=headers)
+
+
+class FixtureAuthResponse(FixtureResponse):
+    """ A response to an auth request. """
+
+    def __init__(self, *args):
+        headers = [("Reply-Text", " ".join(args))]
+        super(FixtureAuthResponse, self).__init__(
+            self.AUTH_REQUEST, headers=headers)
+
+
+class FixtureApiResponse(FixtureResponse):
+    """ A reply to an ESL command. """
+
+    def __init__(self, *args):
+        content = " ".join(args)
+        super(FixtureApiResponse, self).__init__(self.API_RESPONSE, content)
+
+
+class FixtureNotFound(Exception):
+    """ Raise when a recording server has no matching fixture. """
+
+
+class RecordingServer(Protocol):
+    def __init__(self):
+        self.command_parser = EslParser()
+
+    def connectionMade(self):
+        self.factory.clients.append(self)
+
+    def _send_event(self, content):
+        self.transport.write(
+            'Content-Length: %s\n' % len(content) +
+            'Content-Type: text/event-plain\n\n' +
+            content)
+
+    def dataReceived(self, line):
+        commands = self.command_parser.parse(line)
+        for cmd in commands:
+            response = self.factory.get_response(cmd)
+            self.transport.write(response.to_bytes())
+
+    def hangup(self):
+        content = (
+            'Event-Name: CHANNEL_HANGUP\n')
+        self._send_event(content)
+
+
+class RecordingServerFactory(Factory):
+    """ Factory for RecordingServer protocols. """
+
+    protocol = RecordingServer
+
+    def __init__(self, fail_connect=False, uuid=uuid4):
+        self.fixtures = []
+        self.clients = []
+
+    def add_fixture(self, cmd, response):
+        self.fixtures.append((cmd, response))
+
+    def get_response(self, received_cmd):
+        for i, (cmd, response) in enumerate(self.fixtures):
+            if received_cmd == cmd:
+                del self.fixtures[i]
+                return response
+        raise FixtureNotFound(received_cmd)
+
+
+class SimulatedCall(LineReceiver):
+    """ A call's outbound socket connection from FreeSwitch.
+
+    Commands are replied to with ``+OK`` and media commands (and the
+    transport hanging up) are put on :attr:`queue`.
+
+    :param str call_uuid:
+        The call's UUID.
+
+    :param str caller_id_number:
+        The number the call is from.
+
+    :param bool events:
+        Send the events FreeSwitch would in response to commands: the
+        start and end of each media command (``media_time`` seconds
+        apart) and the call's hangup when the transport hangs up.
+
+    :param bool originated:
+        Whether the call was originated by the transport. Originated calls
+        send the ``CHANNEL_ANSWER`` event the transport waits for before
+        playing its message.
+
+    :param float media_time:
+        How long each media command takes to play, if ``events`` is set.
+
+    :param clock:
+        The reactor to schedule events with. Defaults to the global
+        reactor.
+    """
+
+    MEDIA_APPS = ("speak", "playback", "play_and_get_digits")
+
+    def __init__(self, call_uuid, caller_id_number, events=False,
+                 originated=False, media_time=0, clock=None):
+        self.call_uuid = call_uuid
+        self.caller_id_number = caller_id_number
+        self.events = events
+        self.originated = originated
+        self.media_time = media_time
+        self.clock = clock if clock is not None else reactor
+        self.esl_parser = EslParser()
+        self.queue = DeferredQueue()
+        self.connect_d = Deferred()
+        self.disconnect_d = Deferred()
+        self.connected_at = None
+        self.hung_up = False
+        self.setRawMode()
+
+    def connectionMade(self):
+        self.connected = True
+        self.connected_at = time.time()
+        self.connect_d.callback(None)
+
+    def sendPlainEvent(self, name, params=None):
+        params = {} if params is None else params
+        params['Event-Name'] = name
+        data = "\n".join("%s: %s" % (k, v) for k, v in params.items()) + "\n"
+        self.sendLine(
+            'Content-Length: %d\nContent-Type: text/event-plain\n\n%s' %
+            (len(data), data))
+
+    def sendCommandReply(self, params=""):
+        self.sendLine('Content-Type: command/reply\nReply-Text: +OK\n%s\n\n' %
+                      params)
+
+    def sendChannelHangupCompleteEvent(self, duration,
+                                       hangup_cause='NORMAL_CLEARING'):
+        """
+        Sends a hangup complete event. Duration = duration of call in ms
+        """
+        hangup_time = int(time.time() * 1000)
+        answer_time = int(hangup_time - duration)
+        self.sendPlainEvent('Channel_Hangup_Complete', {
+            'Caller-Channel-Answered-Time': answer_time,
+            'Caller-Channel-Hangup-Time': hangup_time,
+            'Hangup-Cause': hangup_cause,
+        })
+
+    def sendDtmfEvent(self, digit):
+        self.sendPlainEvent('DTMF', {
+            'DTMF-Digit': digit,
+        })
+
+    def sendDisconnectEvent(self):
+        self.sendLine('Content-Type: text/disconnect-notice\n\n')
+
+    def sendChannelAnswerEvent(self):
+        self.sendPlainEvent('Channel_Answer', {
+            'Variable-Caller-ID': self.call_uuid
+        })
+
+    def send_dtmf(self, digits):
+        """ Send DTMF events for each of the digits. """
+        for digit in digits:
+            self.sendDtmfEvent(digit)
+
+    def hangup(self, hangup_cause='NORMAL_CLEARING'):
+        """ Hang the call up, as FreeSwitch does: send the hangup event
+        (with times in microseconds), a disconnect notice and close the
+        connection.
+        """
+        if self.hung_up or not self.connected:
+            return
+        self.hung_up = True
+        hangup_time = int(time.time() * 1000000)
+        self.sendPlainEvent('Channel_Hangup_Complete', {
+            'Caller-Channel-Answered-Time': int(self.connected_at * 1000000),
+            'Caller-Channel-Hangup-Time': hangup_time,
+            'Hangup-Cause': hangup_cause,
+        })
+        self.sendDisconnectEvent()
+        self.transport.loseConnection()
+
+    def next_command(self):
+        """ Return a Deferred that fires with the next command put on
+        :attr:`queue`, or with ``None`` if the call disconnects first.
+        """
+        if not self.connected:
+            return succeed(None)
+        d = self.queue.get()
+        done = Deferred()
+        d.addCallbacks(done.callback, lambda f: f.trap(CancelledError))
+        self.disconnect_d.addCallback(self._disconnected_waiting, d, done)
+        return done
+
+    def _disconnected_waiting(self, result, d, done):
+        if not done.called:
+            d.cancel()
+            done.callback(None)
+        return result
+
+    def media_started(self, cmd):
+        app = cmd['execute-app-name']
+        self.sendPlainEvent('CHANNEL_EXECUTE', {'Application': app})
+        self.clock.callLater(
+            self.media_time, self.media_finished, app)
+
+    def media_finished(self, app):
+        if self.connected and not self.hung_up:
+            self.sendPlainEvent(
+                'CHANNEL_EXECUTE_COMPLETE', {'Application': app})
+
+    def rawDataReceived(self, data):
+        for cmd in self.esl_parser.parse(data):
+            if cmd.cmd_type == "connect":
+                self.sendCommandReply(
+                    'variable-call-uuid: {}\n'
+                    'variable-caller-id-number: {}'.format(
+                        self.call_uuid, self.caller_id_number))
+            elif cmd.cmd_type == "myevents":
+                self.sendCommandReply()
+            elif cmd.cmd_type == "sendmsg":
+                self.sendCommandReply()
+                cmd_name = cmd.params.get('execute-app-name')
+                if cmd_name in self.MEDIA_APPS:
+                    self.queue.put(cmd)
+                    if self.events:
+                        self.media_started(cmd)
+                elif cmd_name == "hangup":
+                    self.queue.put(cmd)
+                    if self.events:
+                        self.hangup(cmd['execute-app-arg'] or
+                                    'NORMAL_CLEARING')
+                elif cmd_name == "answer" and self.originated:
+                    self.sendChannelAnswerEvent()
+
+    def connectionLost(self, reason):
+        self.connected = False
+        self.disconnect_d.callback(None)
+
+
+def originate_uuid(command):
+    """ Return the ``origination_uuid`` set in an originate command, or
+    ``None`` if it doesn't set one.
+    """
+    start = command.find("origination_uuid=")
+    if start == -1:
+        return None
+    start += len("origination_uuid=")
+    end = start
+    while end < len(command) and command[end] not in ",}] ":
+        end += 1
+    return command[start:end]
+
+
+class SimulatedFreeSwitchServer(LineReceiver):
+    """ FreeSwitch's inbound ESL socket, as the transport uses it to
+    originate calls and poll FreeSwitch's status.
+    """
+
+    delimiter = "\n\n"
+
+    def connectionMade(self):
+        self.transport.write("Content-Type: auth/request\n\n")
+
+    def lineReceived(self, line):
+        if line.startswith("auth "):
+            self.transport.write(FixtureReply("+OK", "accepted").to_bytes())
+        elif line.startswith("api "):
+            d = self.factory.api(line[len("api "):])
+            d.addCallback(self.send_api_response)
+        else:
+            self.transport.write(FixtureReply("+OK").to_bytes())
+
+    def send_api_response(self, response):
+        if self.transport.connected:
+            self.transport.write(FixtureApiResponse(response).to_bytes())
+
+
+class FreeSwitchSimulator(Factory):
+    """ Simulates FreeSwitch for a voice transport.
+
+    As a factory, it serves FreeSwitch's inbound ESL socket for the
+    transport's ``freeswitch_endpoint``. Originated calls are answered
+    after ``answer_latency`` seconds (unless they fail, with probability
+    ``failure_rate``) and then connected to the transport.
+
+    Each call, originated or started with :meth:`start_call`, runs
+    ``script``: a sequence of steps, each one of
+
+    * ``('media',)``: wait for the transport to play something.
+    * ``('dtmf', digits)``: send DTMF digits.
+    * ``('wait', seconds)``: pause.
+    * ``('hangup', cause)``: hang up.
+
+    :param call_endpoint:
+        Client endpoint for connecting calls to the transport's
+        ``twisted_endpoint``.
+
+    :param float answer_latency:
+        Seconds before an originated call is answered.
+
+    :param float failure_rate:
+        The fraction of originated calls that fail.
+
+    :param str failure_cause:
+        The hangup cause failed originates are reported with.
+
+    :param list script:
+        The steps each call runs once it is connected.
+
+    :param float media_time:
+        How long each media command takes to play.
+
+    :param int max_sessions:
+        The session limit reported by the ``status`` API command.
+    """
+
+    protocol = SimulatedFreeSwitchServer
+
+    def __init__(self, call_endpoint, answer_latency=0, failure_rate=0,
+                 failure_cause='NO_ANSWER', script=(), media_time=0,
+                 max_sessions=10000, clock=None, rand=random.random):
+        self.call_endpoint = call_endpoint
+        self.answer_latency = answer_latency
+        self.failure_rate = failure_rate
+        self.failure_cause = failure_cause
+        self.script = list(script)
+        self.media_time = media_time
+        self.max_sessions = max_sessions
+        self.clock = clock if clock is not None else reactor
+        self.rand = rand
+        self.calls = {}
+        self._running = set()
+        self.originates = 0
+        self.failed_originates = 0
+        self.completed_calls = 0
+        self.setup_latencies = []
+
+    def api(self, command):
+        """ Return a Deferred firing with the response to an API command.
+        """
+        if command.startswith("originate "):
+            return self.originate(command)
+        if command == "status":
+            return succeed(
+                "UP 0 years, 0 days\n"
+                "%d session(s) - peak %d, last 5min %d\n"
+                "%d session(s) max\n" % (
+                    len(self.calls), len(self.calls), len(self.calls),
+                    self.max_sessions))
+        return succeed("+OK")
+
+    def originate(self, command):
+        self.originates += 1
+        started = time.time()
+        call_uuid = originate_uuid(command) or str(uuid4())
+        d = Deferred()
+        self.clock.callLater(
+            self.answer_latency, self._answer, d, call_uuid, started)
+        return d
+
+    def _answer(self, d, call_uuid, started):
+        if self.rand() < self.failure_rate:
+            self.failed_originates += 1
+            d.callback("-ERR %s" % (self.failure_cause,))
+            return
+        d.callback("+OK %s" % (call_uuid,))
+        self.start_call(call_uuid, originated=True, started=started)
+
+    def start_call(self, call_uuid=None, caller_id_number="27831234567",
+                   originated=False, started=None):
+        """ Connect a call to the transport and run the script on it.
+
+        Returns a Deferred that fires with the :class:`SimulatedCall`
+        once the script has finished. The call's setup latency, from
+        ``started`` (or now) to the transport's first media command, is
+        added to :attr:`setup_latencies`.
+        """
+        if call_uuid is None:
+            call_uuid = str(uuid4())
+        if started is None:
+            started = time.time()
+        call = SimulatedCall(
+            call_uuid, caller_id_number, events=True, originated=originated,
+            media_time=self.media_time, clock=self.clock)
+        self.calls[call_uuid] = call
+        d = self._run_call(call, started)
+        self._running.add(d)
+        d.addBoth(self._call_done, d)
+        return d
+
+    def _call_done(self, result, d):
+        self._running.discard(d)
+        return result
+
+    @inlineCallbacks
+    def _run_call(self, call, started):
+        try:
+            yield connectProtocol(self.call_endpoint, call)
+            yield self.run_script(call, started)
+        finally:
+            del self.calls[call.call_uuid]
+        self.completed_calls += 1
+        returnValue(call)
+
+    def stop(self):
+        """ Hang up the calls in progress and return a Deferred that fires
+        once they have finished.
+        """
+        for call in self.calls.values():
+            call.hangup()
+        return self.wait_for_calls()
+
+    def wait_for_calls(self):
+        """ Return a Deferred that fires once the calls in progress have
+        finished.
+        """
+        return DeferredList(list(self._running), consumeErrors=True)
+
+    @inlineCallbacks
+    def run_script(self, call, started):
+        first_media = True
+        for step in self.script:
+            if not call.connected:
+                break
+            action, args = step[0], step[1:]
+            if action == 'media':
+                cmd = yield call.next_command()
+                if cmd is None or cmd['execute-app-name'] == 'hangup':
+                    break
+                if first_media:
+                    first_media = False
+                    self.setup_latencies.append(time.time() - started)
+            elif action == 'dtmf':
+                call.send_dtmf(*args)
+            elif action == 'wait':
+                d = Deferred()
+                self.clock.callLater(args[0], d.callback, None)
+                yield d
+            elif action == 'hangup':
+                call.hangup(*args)
+            else:
+                raise ValueError("Unknown script step %r" % (step,))
+        if call.connected:
+            call.hangup()
+        yield call.disconnect_d
@@ -0,0 +1,74 @@
+""" Tests for vxfreeswitch.calllog. """
+
+import logging
+
+from twisted.trial.unittest import TestCase
+
+from vxfreeswitch.calllog import CallLogger, parse_level
+
+
+class FakeLog(object):
+    def __init__(self):
+        self.msgs = []
+
+    def msg(self, msg, **kw):
+        self.msgs.append((msg, kw))
+
+
+class Unformattable(object):
+    def __repr__(self):
+        raise AssertionError("Formatted a message below the log level.")
+
+
+class TestParseLevel(TestCase):
+    def test_parse_level(self):
+        self.assertEqual(parse_level('INFO'), logging.INFO)
+        self.assertEqual(parse_level('warning'), logging.WARNING)
+
+    def test_unknown_level(self):
+        err = self.assertRaises(ValueError, parse_level, 'CHATTY')
+        self.assertEqual(str(err), "Unknown log level 'CHATTY'")
+
+
+class TestCallLogger(TestCase):
+    def test_log(self):
+        log = FakeLog()
+        logger = CallLogger(log)
+        logger.info("Playing back: %r", 'foo.wav')
+        logger.debug("100%")
+        self.assertEqual(log.msgs, [
+            ("Playing back: 'foo.wav'", {'logLevel': logging.INFO}),
+            ("100%", {'logLevel': logging.DEBUG}),
+        ])
+
+    def test_below_level(self):
+        log = FakeLog()
+        logger = CallLogger(log, logging.INFO)
+        logger.debug("Unbound event %r", Unformattable())
+        logger.warning("Unable to get call duration")
+        self.assertEqual(log.msgs, [
+            ("Unable to get call duration", {'logLevel': logging.WARNING}),
+        ])
+
+    def test_slots(self):
+        self.assertFalse(hasattr(CallLogger(FakeLog()), '__dict__'))
+
+    def test_is_enabled(self):
+        logger = CallLogger(FakeLog(), logging.INFO)
+        self.assertFalse(logger.is_enabled(logging.DEBUG))
+        self.assertTrue(logger.is_enabled(logging.INFO))
+
+    def test_bind(self):
+        log = FakeLog()
+        parent = CallLogger(log, logging.INFO, node='fs1')
+        logger = parent.bind(call_uuid='abc-1234')
+        self.assertEqual(logger.level, logging.INFO)
+        logger.info("Channel answered")
+        parent.info("Registration complete.")
+        self.assertEqual(log.msgs, [
+            ("[abc-1234] Channel answered", {
+                'logLevel': logging.INFO, 'node': 'fs1',
+                'call_uuid': 'abc-1234'}),
+            ("Registration complete.", {
+                'logLevel': logging.INFO, 'node': 'fs1'}),
+        ])
@@ -0,0 +1,75 @@
+""" Tests for vxfreeswitch.callstate. """
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from vxfreeswitch.callstate import MemoryCallStateStore, RedisCallStateStore
+
+
+class CallStateStoreTestMixin(object):
+    def mk_message(self):
+        return TransportUserMessage(
+            to_addr='54321', from_addr='12345', transport_name='sphex',
+            transport_type='voice', content='foobar',
+            session_event=TransportUserMessage.SESSION_NEW)
+
+    @inlineCallbacks
+    def test_claim_originated_call(self):
+        store = yield self.mk_store()
+        msg = self.mk_message()
+        yield store.add_originated_call('uuid-1234', msg, '54321', 60)
+        claimed = yield store.claim_originated_call('uuid-1234')
+        self.assertEqual(claimed, (msg, '54321'))
+
+    @inlineCallbacks
+    def test_claim_originated_call_twice(self):
+        store = yield self.mk_store()
+        yield store.add_originated_call(
+            'uuid-1234', self.mk_message(), '54321', 60)
+        yield store.claim_originated_call('uuid-1234')
+        claimed = yield store.claim_originated_call('uuid-1234')
+        self.assertEqual(claimed, None)
+
+    @inlineCallbacks
+    def test_claim_unknown_call(self):
+        store = yield self.mk_store()
+        claimed = yield store.claim_originated_call('uuid-1234')
+        self.assertEqual(claimed, None)
+
+    @inlineCallbacks
+    def test_originated_call_pending(self):
+        store = yield self.mk_store()
+        pending = yield store.originated_call_pending('uuid-1234')
+        self.assertEqual(pending, False)
+        yield store.add_originated_call(
+            'uuid-1234', self.mk_message(), '54321', 60)
+        pending = yield store.originated_call_pending('uuid-1234')
+        self.assertEqual(pending, True)
+        yield store.claim_originated_call('uuid-1234')
+        pending = yield store.originated_call_pending('uuid-1234')
+        self.assertEqual(pending, False)
+
+
+class TestMemoryCallStateStore(CallStateStoreTestMixin, VumiTestCase):
+    def mk_store(self):
+        return MemoryCallStateStore()
+
+
+class TestRedisCallStateStore(CallStateStoreTestMixin, VumiTestCase):
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+
+    @inlineCallbacks
+    def mk_store(self):
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        returnValue(RedisCallStateStore(self.redis))
+
+    @inlineCallbacks
+    def test_originated_call_ttl(self):
+        store = yield self.mk_store()
+        yield store.add_originated_call(
+            'uuid-1234', self.mk_message(), '54321', 60)
+        ttl = yield self.redis.ttl('originated:uuid-1234')
+        self.assertTrue(0 < ttl <= 60)
@@ -5,6 +5,7 @@ from zope.interface import implementer
 from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.internet.defer import inlineCallbacks, Deferred, fail, succeed
 from twisted.internet.protocol import ClientFactory
+from twisted.internet.task import Clock
 from twisted.test.proto_helpers import StringTransportWithDisconnection
 from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
@@ -13,9 +14,11 @@ from eventsocket import EventError
 
 from vxfreeswitch.client import (
     FreeSwitchClientProtocol, FreeSwitchClientFactory,
-    FreeSwitchClient, FreeSwitchClientReply, FreeSwitchClientError)
+    FreeSwitchClient, FreeSwitchClientReply, FreeSwitchClientError,
+    FreeSwitchConnectionError, FreeSwitchCircuitOpenError, CircuitBreaker)
 
-from vxfreeswitch.tests.helpers import FixtureApiResponse, FixtureReply
+from vxfreeswitch.eslparser import EventParser
+from vxfreeswitch.simulator import FixtureApiResponse, FixtureReply
 
 
 def connect_transport(protocol, factory=None):
@@ -62,6 +65,14 @@ class TestFreeSwitchClientProtocol(TestCase):
         tr = connect_transport(p)
         self.assertEqual(tr.value(), "")
 
+    def test_default_parser(self):
+        p = FreeSwitchClientProtocol(auth=None)
+        self.assertEqual(p.event_parser, None)
+
+    def test_fast_parser(self):
+        p = FreeSwitchClientProtocol(auth=None, fast_parser=True)
+        self.assertTrue(isinstance(p.event_parser, EventParser))
+
 
 class TestFreeSwitchClientFactory(TestCase):
     def test_subclasses_client_factory(self):
@@ -87,6 +98,11 @@ class TestFreeSwitchClientFactory(TestCase):
         tr = connect_transport(p)
         self.assertEqual(tr.value(), "")
 
+    def test_fast_parser(self):
+        f = FreeSwitchClientFactory(fast_parser=True)
+        p = f.protocol()
+        self.assertTrue(isinstance(p.event_parser, EventParser))
+
     def test_auth(self):
         f = FreeSwitchClientFactory(auth="pw-1234")
         p = f.protocol()
@@ -104,6 +120,83 @@ class TestFreeSwitchClientError(TestCase):
         self.assertEqual(str(err), "reason")
 
 
+class TestFreeSwitchConnectionError(TestCase):
+    def test_subclasses_client_error(self):
+        err = FreeSwitchConnectionError("foo")
+        self.assertTrue(isinstance(err, FreeSwitchClientError))
+
+
+class TestCircuitBreaker(TestCase):
+    def mk_breaker(self, failure_threshold=2, reset_timeout=10):
+        self.clock = Clock()
+        return CircuitBreaker(
+            failure_threshold, reset_timeout, clock=self.clock)
+
+    def test_closed(self):
+        breaker = self.mk_breaker()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
+
+    def test_opens_after_threshold(self):
+        breaker = self.mk_breaker()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+    def test_success_resets_failures(self):
+        breaker = self.mk_breaker()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_half_open_allows_one_request(self):
+        breaker = self.mk_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.clock.advance(10)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+    def test_half_open_success_closes(self):
+        breaker = self.mk_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.clock.advance(10)
+        breaker.allow_request()
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_half_open_failure_reopens(self):
+        breaker = self.mk_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.clock.advance(10)
+        breaker.allow_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.clock.advance(9)
+        self.assertFalse(breaker.allow_request())
+        self.clock.advance(1)
+        self.assertTrue(breaker.allow_request())
+
+    def test_metric_value(self):
+        breaker = self.mk_breaker(failure_threshold=1)
+        self.assertEqual(breaker.metric_value(), 0)
+        breaker.record_failure()
+        self.assertEqual(breaker.metric_value(), 2)
+        self.clock.advance(10)
+        self.assertEqual(breaker.metric_value(), 1)
+        breaker.allow_request()
+        breaker.record_success()
+        self.assertEqual(breaker.metric_value(), 0)
+
+
 class TestFreeSwitchClientReply(TestCase):
     def test_args(self):
         reply = FreeSwitchClientReply("a", "b")
@@ -148,6 +241,21 @@ class TestFreeSwitchClient(TestCase):
             client.fallback_error_handler, failure)
         self.assertEqual(str(err), "reason")
 
+    def test_connection_error_handler(self):
+        client = self.mk_client()
+        failure = Failure(Exception("refused"))
+        err = self.failUnlessRaises(
+            FreeSwitchConnectionError,
+            client.connection_error_handler, failure)
+        self.assertEqual(str(err), "refused")
+
+    def test_with_connection_connect_failed(self):
+        endpoint = StringClientEndpoint()
+        endpoint.connect = lambda factory: fail(Exception("refused"))
+        client = self.mk_client(endpoint=endpoint)
+        d = client.with_connection(lambda conn: None)
+        return self.assertFailure(d, FreeSwitchConnectionError)
+
     def test_event_error_handler_event_error_has_reply(self):
         client = self.mk_client()
         failure = Failure(EventError({"Reply_Text": "+ERROR eep"}))
@@ -221,6 +329,51 @@ class TestFreeSwitchClient(TestCase):
             })
         self.assertEqual(str(err), "{'data': {}}")
 
+    def test_raw_api_request_callback(self):
+        client = self.mk_client()
+        self.assertEqual(
+            client.raw_api_request_callback({
+                'data': {
+                    'rawresponse': 'UP 0 years\n3 session(s) max\n'
+                }
+            }),
+            'UP 0 years\n3 session(s) max\n')
+
+    def test_raw_api_request_callback_with_error_response(self):
+        client = self.mk_client()
+        err = self.failUnlessRaises(
+            FreeSwitchClientError,
+            client.raw_api_request_callback, {
+                'data': {
+                    'rawresponse': '-ERR no such command\n'
+                }
+            })
+        self.assertEqual(str(err), "-ERR no such command")
+
+    def test_with_connection_circuit_open(self):
+        endpoint = StringClientEndpoint()
+        breaker = CircuitBreaker(1, 10, clock=Clock())
+        breaker.record_failure()
+        client = FreeSwitchClient(endpoint=endpoint, breaker=breaker)
+        d = client.with_connection(lambda conn: None)
+        self.assertEqual(endpoint.transport, None)
+        return self.assertFailure(d, FreeSwitchCircuitOpenError)
+
+    @inlineCallbacks
+    def test_with_connection_records_outcome(self):
+        endpoint = StringClientEndpoint()
+        breaker = CircuitBreaker(2, 10, clock=Clock())
+        client = FreeSwitchClient(endpoint=endpoint, breaker=breaker)
+        connect = endpoint.connect
+        endpoint.connect = lambda factory: fail(Exception("refused"))
+        yield self.assertFailure(
+            client.with_connection(lambda conn: None),
+            FreeSwitchConnectionError)
+        self.assertEqual(breaker.failures, 1)
+        endpoint.connect = connect
+        yield client.with_connection(lambda conn: None)
+        self.assertEqual(breaker.failures, 0)
+
     @inlineCallbacks
     def test_with_connection(self):
         endpoint = StringClientEndpoint()
@@ -265,6 +418,20 @@ class TestFreeSwitchClient(TestCase):
         self.assertEqual(endpoint.transport.value(), "api foo\n\n")
         self.assertEqual(endpoint.transport.connected, False)
 
+    @inlineCallbacks
+    def test_raw_api(self):
+        endpoint = StringClientEndpoint()
+        client = self.mk_client(endpoint=endpoint)
+
+        d = client.raw_api("status")
+        self.assertEqual(endpoint.transport.value(), "api status\n\n")
+        endpoint.transport.protocol.dataReceived(
+            FixtureApiResponse("UP 0 years\n").to_bytes())
+        result = yield d
+
+        self.assertEqual(result, "UP 0 years\n")
+        self.assertEqual(endpoint.transport.connected, False)
+
     @inlineCallbacks
     def test_auth(self):
         endpoint = StringClientEndpoint()
@@ -0,0 +1,241 @@
+""" Tests for vxfreeswitch.eslcapture. """
+
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxfreeswitch import VoiceServerTransport
+from vxfreeswitch.client import FreeSwitchClientProtocol
+from vxfreeswitch.eslcapture import (
+    CLOSED, OPENED, RECEIVED, SENT, CaptureRecord, CaptureWriter,
+    CapturedConnection, ReplayProtocol, load_capture, read_capture,
+    replay_calls)
+from vxfreeswitch.tests.helpers import EslHelper
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class UnclosableStringIO(StringIO):
+    """ Keeps its contents after being closed. """
+
+    def close(self):
+        pass
+
+
+def capture(records):
+    f = UnclosableStringIO()
+    clock = FakeClock()
+    writer = CaptureWriter(f, clock)
+    for now, conn, record_type, data in records:
+        clock.now = now
+        if record_type == OPENED:
+            writer.open_connection(data)
+        else:
+            writer.write(conn, record_type, data)
+    return StringIO(f.getvalue())
+
+
+CALL = [
+    (1000.0, 0, OPENED, "call"),
+    (1000.0, 0, SENT, "connect\n\n"),
+    (1000.1, 0, RECEIVED, "Content-Type: command/reply\n"),
+    (1000.1, 0, RECEIVED, "Reply-Text: +OK\n\n"),
+    (1000.2, 0, SENT, "myevents\n\nsendmsg\ncall-command: execute\n"),
+    (1000.2, 0, SENT, "execute-app-name: answer\n\n\n"),
+    (1000.3, 0, RECEIVED, "Content-Type: command/reply\nReply-Text: +OK\n\n"),
+    (1001.0, 0, CLOSED, ""),
+]
+
+
+class TestCaptureFile(TestCase):
+    def test_round_trip(self):
+        records = list(read_capture(capture(CALL)))
+        self.assertEqual(records, [
+            CaptureRecord(*record) for record in CALL])
+
+    def test_not_a_capture(self):
+        self.assertRaises(
+            ValueError, list, read_capture(StringIO("Content-Type: ")))
+
+    def test_truncated(self):
+        data = capture(CALL).getvalue()
+        records = list(read_capture(StringIO(data[:-10])))
+        self.assertEqual(records, [
+            CaptureRecord(*record) for record in CALL[:-1]])
+
+    def test_write_after_close(self):
+        writer = CaptureWriter(StringIO())
+        writer.close()
+        writer.write(0, CLOSED, "")
+
+    def test_load_capture(self):
+        [call, client] = load_capture(capture(CALL + [
+            (1000.5, 1, OPENED, "client"),
+            (1000.6, 1, SENT, "api status\n\n"),
+        ]))
+        self.assertEqual(call.kind, "call")
+        self.assertEqual(call.opened, 1000.0)
+        self.assertAlmostEqual(call.duration, 1.0)
+        self.assertEqual(
+            [(direction, data) for _, direction, data in call.frames],
+            [(direction, data) for _, _, direction, data in CALL[1:-1]])
+        self.assertEqual(client.kind, "client")
+        self.assertAlmostEqual(client.duration, 0.1)
+
+    def test_received(self):
+        [call] = load_capture(capture(CALL))
+        self.assertEqual(
+            [(data, commands) for _, data, commands in call.received()], [
+                ("Content-Type: command/reply\n", 1),
+                ("Reply-Text: +OK\n\n", 1),
+                ("Content-Type: command/reply\nReply-Text: +OK\n\n", 3),
+            ])
+
+
+class TestEslCaptureMixin(TestCase):
+    def test_capture(self):
+        f = UnclosableStringIO()
+        writer = CaptureWriter(f)
+        proto = FreeSwitchClientProtocol(None, esl_capture=writer)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        proto.api("status")
+        proto.dataReceived("Content-Type: api/response\nContent-Length: 3")
+        proto.connectionLost(Failure(Exception("Bye")))
+        self.assertEqual(transport.value(), "api status\n\n")
+        self.assertEqual([
+            (record.connection, record.type, record.data)
+            for record in read_capture(StringIO(f.getvalue()))], [
+                (0, OPENED, "client"),
+                (0, SENT, "api status\n\n"),
+                (0, RECEIVED,
+                 "Content-Type: api/response\nContent-Length: 3"),
+                (0, CLOSED, ""),
+            ])
+
+    def test_no_capture(self):
+        proto = FreeSwitchClientProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        self.assertIdentical(proto.transport, transport)
+
+
+class TestReplayProtocol(TestCase):
+    def mk_replay(self, records, speed=1.0):
+        [call] = load_capture(capture(records))
+        self.clock = Clock()
+        proto = ReplayProtocol(call, speed, stall_timeout=5, clock=self.clock)
+        proto.makeConnection(StringTransport())
+        self.addCleanup(self.clock.advance, 10)
+        return proto
+
+    def assert_sent(self, proto, data):
+        self.assertEqual(proto.transport.value(), data)
+        proto.transport.clear()
+
+    def test_replay(self):
+        proto = self.mk_replay(CALL, speed=2)
+        # The reply waits for the connect command.
+        self.clock.advance(1)
+        self.assert_sent(proto, "")
+        proto.dataReceived("connect\n\n")
+        self.assert_sent(
+            proto, "Content-Type: command/reply\nReply-Text: +OK\n\n")
+        proto.dataReceived("myevents\n\nsendmsg\ncall-command: execute\n")
+        self.assert_sent(proto, "")
+        proto.dataReceived("execute-app-name: answer\n\n\n")
+        self.assert_sent(
+            proto, "Content-Type: command/reply\nReply-Text: +OK\n\n")
+        self.assertFalse(proto.transport.disconnecting)
+        self.assertEqual(proto.sent, 3)
+
+    def test_speed(self):
+        proto = self.mk_replay([
+            (1000.0, 0, OPENED, "call"),
+            (1002.0, 0, RECEIVED, "Content-Type: text/event-plain\n\n"),
+            (1004.0, 0, CLOSED, ""),
+        ], speed=2)
+        self.clock.advance(0.9)
+        self.assert_sent(proto, "")
+        self.clock.advance(0.1)
+        self.assert_sent(proto, "Content-Type: text/event-plain\n\n")
+        self.clock.advance(0.9)
+        self.assertFalse(proto.transport.disconnecting)
+        self.clock.advance(0.1)
+        self.assertTrue(proto.transport.disconnecting)
+
+    def test_stall(self):
+        proto = self.mk_replay(CALL)
+        self.clock.advance(4.9)
+        self.assertFalse(proto.transport.disconnecting)
+        self.clock.advance(0.1)
+        self.assertTrue(proto.transport.disconnecting)
+        self.assertTrue(proto.stalled)
+
+    def test_done(self):
+        proto = self.mk_replay(CALL)
+        proto.connectionLost(Failure(Exception("Bye")))
+        self.assertIdentical(self.successResultOf(proto.done), proto)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestCaptureAndReplay(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.capture_file = self.mktemp()
+        self.tx_helper = self.add_helper(TransportHelper(VoiceServerTransport))
+        self.esl_helper = self.add_helper(EslHelper())
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'esl_capture_file': self.capture_file,
+        })
+
+    @inlineCallbacks
+    def test_capture_and_replay(self):
+        client = yield self.esl_helper.mk_client(self.worker, "abc-1234")
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        client.sendDisconnectEvent()
+        client.transport.loseConnection()
+        yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.worker.esl_capture.close()
+
+        with open(self.capture_file, 'rb') as f:
+            [call] = load_capture(f)
+        self.assertEqual(call.kind, "call")
+        self.assertEqual(
+            [data for _, direction, data in call.frames
+             if direction == SENT][0], "connect \n\n")
+        self.assertTrue(isinstance(call, CapturedConnection))
+
+        self.tx_helper.clear_dispatched_inbound()
+        [replay] = yield replay_calls(
+            [call], TCP4ClientEndpoint(
+                reactor, '127.0.0.1', self.worker.voice_server.getHost().port),
+            speed=10)
+        self.assertFalse(replay.stalled)
+        [new, close] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(
+            new['session_event'], TransportUserMessage.SESSION_NEW)
+        self.assertEqual(new['from_addr'], "abc-1234")
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+
+    def test_replay_nothing(self):
+        d = replay_calls([CapturedConnection("client", 0)], None)
+        self.assertEqual(self.successResultOf(d), [])
@@ -0,0 +1,171 @@
+""" Tests for vxfreeswitch.eslparser. """
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+
+from eventsocket import EventProtocol, _O
+
+from vxfreeswitch.eslparser import (
+    EventParser, EventParserMixin, parse_body, parse_headers)
+
+
+def body_message(headers, body):
+    return "%sContent-Length: %d\n\n%s" % (headers, len(body), body)
+
+
+PLAIN_EVENT_BODY = (
+    "Event-Name: CHANNEL_EXECUTE_COMPLETE\n"
+    "Unique-ID: a3f4bd16-8b4c-4d3e-9e1a-0a1b2c3d4e5f\n"
+    "Caller-Caller-ID-Name: Jane%20Doe\n"
+    "Application: playback\n"
+    "Application-Data: /tmp/voice%3A1.wav\n\n")
+
+BACKGROUND_JOB_BODY = (
+    "Event-Name: BACKGROUND_JOB\n"
+    "Job-UUID: 7f4db78a-17d7-11dd-b7a0-db4edd065621\n"
+    "Content-Length: 41\n\n"
+    "+OK 7f4db78a-17d7-11dd-b7a0-db4edd065621\n")
+
+# A mix of the messages FreeSwitch sends, including a few oddities
+# (CRLF line endings, blank lines between messages and a header line
+# without a colon) that eventsocket tolerates.
+STREAM = "".join([
+    "Content-Type: auth/request\n\n",
+    "Content-Type: command/reply\nReply-Text: +OK accepted\n\n",
+    body_message(
+        "Content-Type: api/response\n", "+OK Job-UUID: 1234\n\nmore\n"),
+    body_message("Content-Type: text/event-plain\n", PLAIN_EVENT_BODY),
+    "\n",
+    body_message("Content-Type: text/event-plain\n", BACKGROUND_JOB_BODY),
+    "Content-Type: command/reply\r\nReply-Text: -ERR no%20such app\r\n\n",
+    "Content-Type: command/reply\ngarbage\nReply-Text: +OK\n\n",
+    body_message(
+        "Content-Type: text/disconnect-notice\n",
+        "Disconnected, goodbye.\nSee you at ClueCon!\n"),
+    body_message("Content-Type: text/event-plain\n", "Event-Name: HEARTBEAT"),
+    "Content-Type: command/reply\nReply-Text: +OK\n\n",
+])
+
+
+class RecordingEventSocket(EventProtocol):
+    """ Records the events eventsocket's own parser dispatches. """
+
+    def __init__(self):
+        EventProtocol.__init__(self)
+        self.events = []
+
+    def dispatchEvent(self, ctx, event):
+        ctx.data = _O(event.copy())
+        self.events.append(_O(ctx.copy()))
+        self._EventSocket__ctx = self._EventSocket__rawlen = None
+
+
+def eventsocket_events(chunks):
+    proto = RecordingEventSocket()
+    for chunk in chunks:
+        proto.dataReceived(chunk)
+    return proto.events
+
+
+def parser_events(chunks):
+    parser = EventParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events
+
+
+class TestParseFunctions(TestCase):
+    def test_parse_headers(self):
+        ev = parse_headers(
+            "Content-Type: command/reply\r\nReply-Text: +OK a%3Ab\n"
+            "no colon\n Variable-X :  1:2 ")
+        self.assertTrue(isinstance(ev, _O))
+        self.assertEqual(ev, {
+            'Content_Type': 'command/reply',
+            'Reply_Text': '+OK a:b',
+            'Variable_X': '1:2',
+        })
+
+    def test_parse_body(self):
+        self.assertEqual(parse_body(BACKGROUND_JOB_BODY), {
+            'Event_Name': 'BACKGROUND_JOB',
+            'Job_UUID': '7f4db78a-17d7-11dd-b7a0-db4edd065621',
+            'Content_Length': '41',
+            'rawresponse': '+OK 7f4db78a-17d7-11dd-b7a0-db4edd065621\n',
+        })
+
+    def test_parse_body_no_blank_line(self):
+        self.assertEqual(
+            parse_body("Event-Name: HEARTBEAT"), {'Event_Name': 'HEARTBEAT'})
+
+
+class TestEventParser(TestCase):
+    def assert_same_events(self, chunks):
+        expected = eventsocket_events(chunks)
+        events = parser_events(chunks)
+        self.assertEqual(events, expected)
+        self.assertEqual(
+            [type(ev.data) for ev in events], [_O] * len(expected))
+
+    def test_whole_stream(self):
+        self.assert_same_events([STREAM])
+
+    def test_byte_at_a_time(self):
+        self.assert_same_events(list(STREAM))
+
+    def test_chunks(self):
+        for size in (3, 7, 64, 1000):
+            self.assert_same_events([
+                STREAM[i:i + size] for i in range(0, len(STREAM), size)])
+
+    def test_events(self):
+        [auth, reply, api, plain] = parser_events([STREAM])[:4]
+        self.assertEqual(auth, {'Content_Type': 'auth/request', 'data': {}})
+        self.assertEqual(reply.Reply_Text, '+OK accepted')
+        self.assertEqual(api.data.rawresponse, '+OK Job-UUID: 1234\n\nmore\n')
+        self.assertEqual(plain.data.Caller_Caller_ID_Name, 'Jane Doe')
+        self.assertEqual(
+            plain.data.Application_Data, '/tmp/voice:1.wav')
+
+    def test_incomplete(self):
+        parser = EventParser()
+        message = body_message(
+            "Content-Type: api/response\n", "+OK\n")
+        self.assertEqual(parser.feed(message[:-2]), [])
+        [ev] = parser.feed(message[-2:] + "Content-Type: command/")
+        self.assertEqual(ev.data.rawresponse, "+OK\n")
+        [ev] = parser.feed("reply\nReply-Text: +OK\n\n")
+        self.assertEqual(ev.Content_Type, "command/reply")
+        self.assertEqual(len(parser._buffer), 0)
+
+    def test_zero_content_length(self):
+        [ev] = parser_events(
+            [body_message("Content-Type: api/response\n", "")])
+        self.assertEqual(ev.data, {'rawresponse': ''})
+
+
+class ParsingEventSocket(EventParserMixin, RecordingEventSocket):
+    def __init__(self, event_parser):
+        RecordingEventSocket.__init__(self)
+        self.event_parser = event_parser
+
+    def eventReceived(self, ctx):
+        self.events.append(ctx)
+
+
+class TestEventParserMixin(TestCase):
+    @inlineCallbacks
+    def test_event_parser(self):
+        proto = ParsingEventSocket(EventParser())
+        proto.dataReceived(STREAM)
+        self.assertEqual(proto.events, [])
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(proto.events, eventsocket_events([STREAM]))
+
+    def test_no_event_parser(self):
+        proto = ParsingEventSocket(None)
+        proto.dataReceived(STREAM)
+        self.assertEqual(proto.events, eventsocket_events([STREAM]))
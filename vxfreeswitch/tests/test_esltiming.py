@@ -0,0 +1,141 @@
+""" Tests for vxfreeswitch.esltiming. """
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from eventsocket import EventError
+
+from vumi.blinkenlights.metrics import MetricManager
+
+from vxfreeswitch.client import FreeSwitchClientProtocol
+from vxfreeswitch.esltiming import CommandTimer
+from vxfreeswitch.simulator import EslCommand
+from vxfreeswitch.tests.helpers import EslTransport
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLog(object):
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+class TestCommandTimer(TestCase):
+    def mk_timer(self, **kw):
+        self.clock = FakeClock()
+        self.log = FakeLog()
+        return CommandTimer(log=self.log, clock=self.clock, **kw)
+
+    def test_observe(self):
+        timer = self.mk_timer()
+        timer.observe('api', 0.3)
+        self.assertEqual(timer.histograms.keys(), ['api'])
+        self.assertEqual(timer.histograms['api'].percentile(100), 0.5)
+
+    def test_slow_command(self):
+        timer = self.mk_timer(slow_threshold=1.0)
+        timer.observe('api', 1.5, 'uuid-1')
+        timer.observe('api', 0.5)
+        self.assertEqual(self.log.warnings, [
+            "Slow ESL command 'api' on uuid-1: 1.500s",
+        ])
+
+    def test_no_slow_threshold(self):
+        timer = self.mk_timer()
+        timer.observe('api', 100)
+        self.assertEqual(self.log.warnings, [])
+
+    def test_register(self):
+        manager = MetricManager('vumi.test.')
+        timer = self.mk_timer()
+        timer.histogram('api')
+        self.assertEqual(timer.register(manager), timer)
+        self.assertTrue('esl.rtt.api.count' in manager)
+        timer.histogram('playback')
+        self.assertTrue('esl.rtt.playback.count' in manager)
+
+
+class TestTimedCommandsMixin(TestCase):
+    def mk_proto(self, command_timer):
+        proto = FreeSwitchClientProtocol(None, command_timer)
+        proto.transport = EslTransport()
+        return proto
+
+    def send_reply(self, proto, content_type, body=None):
+        headers = "Content-Type: %s\n" % (content_type,)
+        if body is None:
+            proto.dataReceived(headers + "Reply-Text: +OK\n\n")
+        else:
+            proto.dataReceived("%sContent-Length: %d\n\n%s" % (
+                headers, len(body), body))
+
+    @inlineCallbacks
+    def test_api(self):
+        timer = CommandTimer()
+        proto = self.mk_proto(timer)
+        d = proto.api("status")
+        cmd = yield proto.transport.cmds.get()
+        self.assertEqual(cmd, EslCommand("api status"))
+        self.send_reply(proto, "api/response", "+OK")
+        yield d
+        self.assertEqual(sum(timer.histograms['api'].totals), 1)
+
+    @inlineCallbacks
+    def test_sendmsg(self):
+        timer = CommandTimer()
+        proto = self.mk_proto(timer)
+        d = proto.playback("foo.wav")
+        # eventsocket sets the playback terminators before playing.
+        for _ in range(2):
+            yield proto.transport.cmds.get()
+            self.send_reply(proto, "command/reply")
+        yield d
+        self.assertEqual(sorted(timer.histograms), ['playback', 'set'])
+
+    @inlineCallbacks
+    def test_rtt(self):
+        timer = CommandTimer(clock=FakeClock())
+        proto = self.mk_proto(timer)
+        d = proto.api("status")
+        yield proto.transport.cmds.get()
+        timer.clock.now = 0.3
+        self.send_reply(proto, "api/response", "+OK")
+        yield d
+        self.assertEqual(timer.histograms['api'].percentile(100), 0.5)
+
+    @inlineCallbacks
+    def test_command_replied(self):
+        proto = self.mk_proto(CommandTimer())
+        replies = []
+        proto.command_replied = lambda *args: replies.append(args)
+        d = proto.api("status")
+        yield proto.transport.cmds.get()
+        self.send_reply(proto, "api/response", "+OK")
+        yield d
+        d = proto.execute("hangup", "NORMAL_CLEARING")
+        yield proto.transport.cmds.get()
+        proto.dataReceived(
+            "Content-Type: command/reply\nReply-Text: -ERR no call\n\n")
+        yield self.assertFailure(d, EventError)
+        self.assertEqual(replies, [
+            ("api", "status", None),
+            ("hangup", "NORMAL_CLEARING", "-ERR no call"),
+        ])
+
+    @inlineCallbacks
+    def test_no_command_timer(self):
+        proto = self.mk_proto(None)
+        d = proto.api("status")
+        yield proto.transport.cmds.get()
+        self.send_reply(proto, "api/response", "+OK")
+        ev = yield d
+        self.assertEqual(ev.data.rawresponse, "+OK")
@@ -0,0 +1,90 @@
+""" Tests for vxfreeswitch.lag. """
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import Metric
+
+from vxfreeswitch.lag import ReactorLagMonitor
+
+
+class TestReactorLagMonitor(TestCase):
+    def mk_monitor(self, **kw):
+        self.clock = Clock()
+        kw.setdefault('interval', 1.0)
+        monitor = ReactorLagMonitor(clock=self.clock, **kw)
+        self.addCleanup(monitor.stop)
+        return monitor
+
+    def test_no_lag(self):
+        monitor = self.mk_monitor()
+        monitor.start()
+        self.clock.advance(1.0)
+        self.assertEqual(monitor.lag, 0.0)
+        self.assertEqual(monitor.overloaded, False)
+
+    def test_lag(self):
+        monitor = self.mk_monitor()
+        monitor.start()
+        self.clock.advance(1.5)
+        self.assertEqual(monitor.lag, 0.5)
+
+    def test_reschedules_probe(self):
+        monitor = self.mk_monitor()
+        monitor.start()
+        self.clock.advance(1.25)
+        self.clock.advance(1.0)
+        self.assertEqual(monitor.lag, 0.0)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_stop(self):
+        monitor = self.mk_monitor()
+        monitor.start()
+        monitor.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_metric(self):
+        metric = Metric('reactor.lag')
+        monitor = self.mk_monitor(metric=metric)
+        monitor.record_lag(0.25)
+        self.assertEqual([v for _, v in metric.poll()], [0.25])
+
+    def test_no_threshold(self):
+        monitor = self.mk_monitor()
+        monitor.record_lag(100.0)
+        self.assertEqual(monitor.overloaded, False)
+
+    def test_overloaded_after_samples(self):
+        monitor = self.mk_monitor(threshold=0.5, samples=2)
+        monitor.record_lag(1.0)
+        self.assertEqual(monitor.overloaded, False)
+        monitor.record_lag(1.0)
+        self.assertEqual(monitor.overloaded, True)
+
+    def test_lagging_samples_must_be_consecutive(self):
+        monitor = self.mk_monitor(threshold=0.5, samples=2)
+        monitor.record_lag(1.0)
+        monitor.record_lag(0.1)
+        monitor.record_lag(1.0)
+        self.assertEqual(monitor.overloaded, False)
+
+    def test_recovers(self):
+        monitor = self.mk_monitor(threshold=0.5)
+        monitor.record_lag(1.0)
+        self.assertEqual(monitor.overloaded, True)
+        monitor.record_lag(0.1)
+        self.assertEqual(monitor.overloaded, False)
+
+    def test_on_change(self):
+        changes = []
+        monitor = self.mk_monitor(
+            threshold=0.5, samples=2,
+            on_change=lambda: changes.append(monitor.overloaded))
+        monitor.record_lag(1.0)
+        self.assertEqual(changes, [])
+        monitor.record_lag(1.0)
+        monitor.record_lag(1.0)
+        self.assertEqual(changes, [True])
+        monitor.record_lag(0.1)
+        monitor.record_lag(0.1)
+        self.assertEqual(changes, [True, False])
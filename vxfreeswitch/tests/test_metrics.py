@@ -0,0 +1,82 @@
+""" Tests for vxfreeswitch.metrics. """
+
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import MetricManager
+
+from vxfreeswitch.metrics import Gauge, Histogram
+
+
+def poll_values(metrics):
+    return dict(
+        (metric.name, [value for _, value in metric.poll()])
+        for metric in metrics)
+
+
+class TestGauge(TestCase):
+    def test_poll(self):
+        values = [3]
+        gauge = Gauge('calls', lambda: values[0])
+        self.assertEqual([v for _, v in gauge.poll()], [3])
+        values[0] = 5
+        self.assertEqual([v for _, v in gauge.poll()], [5])
+
+    def test_poll_none(self):
+        gauge = Gauge('calls', lambda: None)
+        self.assertEqual(gauge.poll(), [])
+
+    def test_aggregators(self):
+        self.assertEqual(Gauge('calls', lambda: 1).aggs, ('avg', 'max'))
+
+
+class TestHistogram(TestCase):
+    def test_metric_names(self):
+        hist = Histogram('rtt', buckets=(0.5, 1))
+        self.assertEqual([m.name for m in hist.metrics()], [
+            'rtt.count', 'rtt.avg', 'rtt.max', 'rtt.le_0_5', 'rtt.le_1',
+            'rtt.le_inf'])
+
+    def test_observe(self):
+        hist = Histogram('rtt', buckets=(0.5, 1))
+        metrics = hist.metrics()
+        for value in [0.25, 0.5, 0.75, 2.0]:
+            hist.observe(value)
+        self.assertEqual(poll_values(metrics), {
+            'rtt.count': [4],
+            'rtt.avg': [0.875],
+            'rtt.max': [2.0],
+            'rtt.le_0_5': [2],
+            'rtt.le_1': [1],
+            'rtt.le_inf': [1],
+        })
+
+    def test_poll_clears_observations(self):
+        hist = Histogram('rtt', buckets=(0.5, 1))
+        metrics = hist.metrics()
+        hist.observe(0.25)
+        poll_values(metrics)
+        self.assertEqual(poll_values(metrics), dict(
+            (metric.name, []) for metric in metrics))
+
+    def test_percentile(self):
+        hist = Histogram('rtt', buckets=(0.1, 0.5, 1))
+        self.assertEqual(hist.percentile(50), None)
+        for value in [0.05] * 5 + [0.3] * 4 + [5]:
+            hist.observe(value)
+        self.assertEqual(hist.percentile(50), 0.1)
+        self.assertEqual(hist.percentile(90), 0.5)
+        self.assertEqual(hist.percentile(99), float('inf'))
+
+    def test_percentile_survives_poll(self):
+        hist = Histogram('rtt', buckets=(0.1, 0.5))
+        metrics = hist.metrics()
+        hist.observe(0.3)
+        poll_values(metrics)
+        self.assertEqual(hist.percentile(50), 0.5)
+
+    def test_register(self):
+        manager = MetricManager('vumi.test.')
+        hist = Histogram('rtt', buckets=(1,)).register(manager)
+        self.assertTrue(isinstance(hist, Histogram))
+        self.assertTrue('rtt.count' in manager)
+        self.assertTrue('rtt.le_inf' in manager)
@@ -0,0 +1,419 @@
+""" Tests for vxfreeswitch.nodes. """
+
+from twisted.internet.defer import Deferred, inlineCallbacks, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxfreeswitch.client import (
+    CircuitBreaker, FreeSwitchClient, FreeSwitchClientError,
+    FreeSwitchClientReply, FreeSwitchConnectionError)
+from vxfreeswitch.nodes import (
+    FreeSwitchNode, FreeSwitchNodePool, NoFreeSwitchNodeAvailable,
+    parse_status)
+
+
+def mk_status(sessions, max_sessions):
+    return "\n".join([
+        "UP 0 years, 0 days, 1 hour, 2 minutes, 3 seconds, 4 milliseconds,"
+        " 5 microseconds",
+        "FreeSWITCH (Version 1.6.20) is ready",
+        "100 session(s) since startup",
+        "%d session(s) - peak 20, last 5min 10 " % (sessions,),
+        "0 session(s) per Sec out of max 30, peak 5, last 5min 1 ",
+        "%d session(s) max" % (max_sessions,),
+        "min idle cpu 0.00/98.00",
+        "Current Stack Size/Max 240K/8192K",
+    ])
+
+
+class FakeClient(object):
+    """ A FreeSwitch client that records API commands. """
+
+    def __init__(self, error=None, status=None, breaker=None):
+        self.error = error
+        self.status = status
+        self.breaker = breaker
+        self.commands = []
+        # Set to a list to leave API commands pending, with their Deferreds
+        # appended to it.
+        self.pending = None
+
+    def api(self, command):
+        self.commands.append(command)
+        if self.error is not None:
+            return fail(self.error)
+        if self.pending is not None:
+            d = Deferred()
+            self.pending.append(d)
+            return d
+        return succeed(FreeSwitchClientReply('+OK', 'uuid'))
+
+    def raw_api(self, command):
+        self.commands.append(command)
+        if self.error is not None:
+            return fail(self.error)
+        return succeed(self.status)
+
+
+class TestParseStatus(TestCase):
+    def test_parse_status(self):
+        self.assertEqual(parse_status(mk_status(12, 1000)), (12, 1000))
+
+    def test_parse_status_unrecognised(self):
+        self.assertRaises(ValueError, parse_status, "UP 0 years")
+
+
+class TestFreeSwitchNode(TestCase):
+    def test_has_capacity(self):
+        node = FreeSwitchNode('a', FakeClient(), max_channels=1)
+        self.assertTrue(node.has_capacity())
+        node.active_channels = 1
+        self.assertFalse(node.has_capacity())
+
+    def test_has_capacity_no_limit(self):
+        node = FreeSwitchNode('a', FakeClient())
+        node.active_channels = 1000
+        self.assertTrue(node.has_capacity())
+
+    def test_load(self):
+        node = FreeSwitchNode('a', FakeClient(), weight=2)
+        node.active_channels = 3
+        self.assertEqual(node.load(), 2.0)
+
+    def test_headroom(self):
+        node = FreeSwitchNode('a', FakeClient())
+        self.assertEqual(node.headroom(), None)
+        self.assertTrue(node.has_headroom())
+        node.update_status(8, 10)
+        self.assertEqual(node.headroom(), 2)
+        node.calls_since_poll = 2
+        self.assertEqual(node.headroom(), 0)
+        self.assertFalse(node.has_headroom())
+        self.assertFalse(node.has_capacity())
+
+    def test_update_status(self):
+        node = FreeSwitchNode('a', FakeClient())
+        node.calls_since_poll = 3
+        node.update_status(8, 10)
+        self.assertEqual(node.sessions, 8)
+        self.assertEqual(node.max_sessions, 10)
+        self.assertEqual(node.calls_since_poll, 0)
+
+    def test_is_up(self):
+        clock = Clock()
+        breaker = CircuitBreaker(1, 10, clock=clock)
+        node = FreeSwitchNode('a', FakeClient(breaker=breaker))
+        self.assertTrue(node.is_up())
+        breaker.record_failure()
+        self.assertFalse(node.is_up())
+        clock.advance(10)
+        self.assertTrue(node.is_up())
+
+    def test_is_up_without_breaker(self):
+        node = FreeSwitchNode('a', FakeClient())
+        self.assertTrue(node.is_up())
+
+    def test_from_config(self):
+        node = FreeSwitchNode.from_config({
+            'name': 'fs1',
+            'endpoint': 'endpoint',
+            'auth': 'secret',
+            'weight': 3,
+            'max_channels': 100,
+        })
+        self.assertEqual(node.name, 'fs1')
+        self.assertTrue(isinstance(node.client, FreeSwitchClient))
+        self.assertEqual(node.client.endpoint, 'endpoint')
+        self.assertEqual(node.client.factory.auth, 'secret')
+        self.assertEqual(node.weight, 3)
+        self.assertEqual(node.max_channels, 100)
+        self.assertEqual(node.client.breaker, None)
+
+    def test_from_config_breaker(self):
+        node = FreeSwitchNode.from_config(
+            {'endpoint': 'endpoint'}, failure_threshold=3, reset_timeout=5)
+        self.assertTrue(isinstance(node.client.breaker, CircuitBreaker))
+        self.assertEqual(node.client.breaker.failure_threshold, 3)
+        self.assertEqual(node.client.breaker.reset_timeout, 5)
+
+    def test_from_config_defaults(self):
+        node = FreeSwitchNode.from_config({'endpoint': 'endpoint'})
+        self.assertEqual(node.name, 'endpoint')
+        self.assertEqual(node.client.factory.auth, None)
+        self.assertEqual(node.weight, 1)
+        self.assertEqual(node.max_channels, None)
+
+
+class TestFreeSwitchNodePool(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_pool(self, *nodes):
+        return FreeSwitchNodePool(nodes)
+
+    def mk_node(self, name, **kw):
+        error = kw.pop('error', None)
+        status = kw.pop('status', None)
+        breaker = CircuitBreaker(1, 30, clock=self.clock)
+        return FreeSwitchNode(name, FakeClient(error, status, breaker), **kw)
+
+    def open_circuit(self, node):
+        node.client.breaker.record_failure()
+
+    def test_candidates_least_loaded_first(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        a.active_channels = 2
+        b.active_channels = 1
+        self.assertEqual(pool.candidates(), [b, a])
+
+    def test_candidates_weighted(self):
+        a, b = self.mk_node('a', weight=3), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        a.active_channels = 2
+        self.assertEqual(pool.candidates(), [a, b])
+
+    def test_candidates_take_turns(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        self.assertEqual(pool.candidates(), [a, b])
+        self.assertEqual(pool.candidates(), [b, a])
+        self.assertEqual(pool.candidates(), [a, b])
+
+    def test_candidates_skip_full_nodes(self):
+        a, b = self.mk_node('a', max_channels=1), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        a.active_channels = 1
+        b.active_channels = 5
+        self.assertEqual(pool.candidates(), [b])
+
+    def test_candidates_skip_down_nodes(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        self.open_circuit(a)
+        self.assertEqual(pool.candidates(), [b])
+        self.clock.advance(30)
+        self.assertEqual(sorted(pool.candidates()), sorted([a, b]))
+
+    @inlineCallbacks
+    def test_api(self):
+        a = self.mk_node('a')
+        pool = self.mk_pool(a)
+        node, reply = yield pool.api('originate foo')
+        self.assertEqual(node, a)
+        self.assertEqual(reply, FreeSwitchClientReply('+OK', 'uuid'))
+        self.assertEqual(a.client.commands, ['originate foo'])
+
+    @inlineCallbacks
+    def test_api_fails_over(self):
+        a = self.mk_node('a', error=FreeSwitchConnectionError('refused'))
+        b = self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        node, reply = yield pool.api('originate foo')
+        self.assertEqual(node, b)
+        self.assertEqual(a.client.commands, ['originate foo'])
+        self.assertEqual(b.client.commands, ['originate foo'])
+
+    @inlineCallbacks
+    def test_api_command_error_does_not_fail_over(self):
+        a = self.mk_node('a', error=FreeSwitchClientError('-ERR NO_ANSWER'))
+        b = self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        err = yield self.assertFailure(
+            pool.api('originate foo'), FreeSwitchClientError)
+        self.assertEqual(str(err), '-ERR NO_ANSWER')
+        self.assertTrue(a.is_up())
+        self.assertEqual(b.client.commands, [])
+
+    @inlineCallbacks
+    def test_api_no_node_available(self):
+        a = self.mk_node('a', error=FreeSwitchConnectionError('refused'))
+        b = self.mk_node('b', max_channels=0)
+        c = self.mk_node('c')
+        pool = self.mk_pool(a, b, c)
+        self.open_circuit(c)
+        err = yield self.assertFailure(
+            pool.api('originate foo'), NoFreeSwitchNodeAvailable)
+        self.assertEqual(
+            str(err),
+            "No FreeSwitch node available (a: 0/- channels,"
+            " b: 0/0 channels, c: circuit open)")
+
+    @inlineCallbacks
+    def test_call_started_and_ended(self):
+        a = self.mk_node('a')
+        pool = self.mk_pool(a)
+        node, reply = yield pool.api('originate foo')
+        self.assertEqual(a.active_channels, 1)
+        pool.call_started('uuid-1', a)
+        self.assertEqual(a.active_channels, 1)
+        pool.call_ended('uuid-1')
+        self.assertEqual(a.active_channels, 0)
+        pool.call_ended('uuid-1')
+        self.assertEqual(a.active_channels, 0)
+        self.assertEqual(a.calls_since_poll, 1)
+
+    @inlineCallbacks
+    def test_release(self):
+        a = self.mk_node('a')
+        pool = self.mk_pool(a)
+        node, reply = yield pool.api('originate foo')
+        pool.release(node)
+        self.assertEqual(a.active_channels, 0)
+
+    @inlineCallbacks
+    def test_api_failure_refunded(self):
+        a = self.mk_node('a', error=FreeSwitchClientError('-ERR NO_ANSWER'))
+        b = self.mk_node('b', error=FreeSwitchConnectionError('refused'))
+        pool = self.mk_pool(a, b)
+        yield self.assertFailure(
+            pool.api('originate foo'), FreeSwitchClientError)
+        yield self.assertFailure(
+            pool.api('originate foo'), FreeSwitchClientError)
+        self.assertEqual([a.active_channels, b.active_channels], [0, 0])
+        self.assertEqual([a.calls_since_poll, b.calls_since_poll], [0, 0])
+
+    def test_api_pending_calls_use_headroom(self):
+        a = self.mk_node('a')
+        a.client.pending = []
+        pool = self.mk_pool(a)
+        a.update_status(8, 10)
+        ds = [pool.api('originate foo') for _ in range(3)]
+        self.assertEqual(len(a.client.pending), 2)
+        self.assertEqual(a.headroom(), 0)
+        self.assertFalse(pool.has_headroom())
+        self.failureResultOf(ds[2], NoFreeSwitchNodeAvailable)
+
+        a.client.pending[0].errback(FreeSwitchClientError('-ERR NO_ANSWER'))
+        self.failureResultOf(ds[0], FreeSwitchClientError)
+        self.assertEqual(a.headroom(), 1)
+
+    def test_api_refund_after_poll(self):
+        a = self.mk_node('a')
+        a.client.pending = []
+        pool = self.mk_pool(a)
+        d = pool.api('originate foo')
+        a.update_status(1, 10)
+        a.client.pending[0].errback(FreeSwitchClientError('-ERR NO_ANSWER'))
+        self.failureResultOf(d, FreeSwitchClientError)
+        self.assertEqual(a.calls_since_poll, 0)
+        self.assertEqual(a.headroom(), 9)
+
+    def test_api_pending_calls_weighted(self):
+        a = self.mk_node('a', weight=3)
+        b = self.mk_node('b', max_channels=2)
+        a.client.pending, b.client.pending = [], []
+        pool = self.mk_pool(a, b)
+        for _ in range(8):
+            pool.api('originate foo')
+        self.assertEqual(
+            [len(a.client.pending), len(b.client.pending)], [6, 2])
+        self.assertEqual([a.active_channels, b.active_channels], [6, 2])
+
+    def test_api_pending_calls_limited(self):
+        a = self.mk_node('a', max_channels=1)
+        a.client.pending = []
+        pool = self.mk_pool(a)
+        ds = [pool.api('originate foo') for _ in range(5)]
+        self.assertEqual(len(a.client.pending), 1)
+        for d in ds[1:]:
+            self.failureResultOf(d, NoFreeSwitchNodeAvailable)
+
+        a.client.pending[0].callback(FreeSwitchClientReply('+OK', 'uuid'))
+        self.assertEqual(self.successResultOf(ds[0])[0], a)
+        self.assertEqual(a.active_channels, 1)
+
+    def test_api_no_headroom(self):
+        a = self.mk_node('a')
+        pool = self.mk_pool(a)
+        a.update_status(10, 10)
+        d = pool.api('originate foo')
+        return self.assertFailure(d, NoFreeSwitchNodeAvailable)
+
+    def test_has_headroom(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        self.assertTrue(pool.has_headroom())
+        a.update_status(10, 10)
+        self.assertTrue(pool.has_headroom())
+        b.update_status(10, 10)
+        self.assertFalse(pool.has_headroom())
+
+    def test_has_headroom_reserved(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        self.assertTrue(pool.has_headroom(5))
+        a.update_status(9, 10)
+        self.assertTrue(pool.has_headroom(5))
+        b.update_status(9, 10)
+        self.assertTrue(pool.has_headroom(1))
+        self.assertFalse(pool.has_headroom(2))
+
+    def test_has_headroom_ignores_down_nodes(self):
+        a, b = self.mk_node('a'), self.mk_node('b')
+        pool = self.mk_pool(a, b)
+        a.update_status(10, 10)
+        self.open_circuit(b)
+        self.assertFalse(pool.has_headroom())
+
+    def test_has_headroom_all_nodes_down(self):
+        a = self.mk_node('a')
+        pool = self.mk_pool(a)
+        a.update_status(10, 10)
+        self.open_circuit(a)
+        self.assertTrue(pool.has_headroom())
+
+    @inlineCallbacks
+    def test_poll(self):
+        a = self.mk_node('a', status=mk_status(3, 10))
+        pool = self.mk_pool(a)
+        yield pool.poll()
+        self.assertEqual(a.client.commands, ['status'])
+        self.assertEqual(a.headroom(), 7)
+
+    @inlineCallbacks
+    def test_poll_connection_error(self):
+        a = self.mk_node('a', error=FreeSwitchConnectionError('refused'))
+        pool = self.mk_pool(a)
+        yield pool.poll()
+        self.assertEqual(a.headroom(), None)
+        self.assertFalse(a.is_up())
+        self.assertEqual(pool.candidates(), [])
+
+    @inlineCallbacks
+    def test_poll_connection_error_after_success(self):
+        a = self.mk_node('a', status=mk_status(3, 10))
+        b = self.mk_node('b', status=mk_status(3, 10))
+        pool = self.mk_pool(a, b)
+        yield pool.poll()
+        self.assertEqual(a.headroom(), 7)
+
+        a.client.error = FreeSwitchConnectionError('refused')
+        yield pool.poll()
+        self.assertFalse(a.is_up())
+        self.assertEqual(pool.candidates(), [b])
+        node, reply = yield pool.api('originate foo')
+        self.assertEqual(node, b)
+        self.assertEqual(a.client.commands, ['status', 'status'])
+
+        a.client.error = None
+        yield pool.poll()
+        self.assertTrue(a.is_up())
+
+    @inlineCallbacks
+    def test_api_no_node_available_poll_failed(self):
+        a = self.mk_node('a', error=FreeSwitchConnectionError('refused'))
+        pool = self.mk_pool(a)
+        yield pool.poll()
+        err = yield self.assertFailure(
+            pool.api('originate foo'), NoFreeSwitchNodeAvailable)
+        self.assertEqual(
+            str(err), "No FreeSwitch node available (a: poll failed)")
+
+    @inlineCallbacks
+    def test_poll_bad_status(self):
+        a = self.mk_node('a', status="UP 0 years")
+        pool = self.mk_pool(a)
+        yield pool.poll()
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(a.headroom(), None)
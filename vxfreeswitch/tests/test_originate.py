@@ -3,7 +3,33 @@
 from twisted.trial.unittest import TestCase
 
 from vxfreeswitch.originate import (
-    OriginateFormatter, OriginateMissingParameter)
+    OriginateFormatter, OriginateMissingParameter, backoff_delay,
+    originate_failure_cause)
+
+
+class TestOriginateFailureCause(TestCase):
+    def test_cause(self):
+        self.assertEqual(
+            originate_failure_cause("-ERR NORMAL_TEMPORARY_FAILURE\n"),
+            "NORMAL_TEMPORARY_FAILURE")
+
+    def test_no_cause(self):
+        self.assertEqual(originate_failure_cause("+ERROR Bad horse."), None)
+        self.assertEqual(originate_failure_cause(""), None)
+
+
+class TestBackoffDelay(TestCase):
+    def test_doubles(self):
+        self.assertEqual(
+            [backoff_delay(i, 5, 300, rand=lambda: 1.0) for i in range(4)],
+            [5, 10, 20, 40])
+
+    def test_maximum(self):
+        self.assertEqual(backoff_delay(10, 5, 300, rand=lambda: 1.0), 300)
+
+    def test_jitter(self):
+        self.assertEqual(backoff_delay(1, 5, 300, rand=lambda: 0.0), 5)
+        self.assertEqual(backoff_delay(1, 5, 300, rand=lambda: 0.5), 7.5)
 
 
 class TestOriginateFormatter(TestCase):
@@ -57,3 +83,73 @@ class TestOriginateFormatter(TestCase):
                 to_addr="+1234", from_addr="1099", uuid='test-uuid'),
             "originate {origination_uuid=test-uuid}sofia/gateway/yogisip/+1234"
             " 100 XML default elcid 1099 60")
+
+    def test_format_call_unicode_addresses(self):
+        formatter = self.mk_formatter()
+        call = formatter.format_call(
+            to_addr=u"+1234", from_addr=u"1099", uuid='test-uuid')
+        self.assertEqual(type(call), str)
+        self.assertEqual(
+            call,
+            "originate {origination_uuid=test-uuid}sofia/gateway/yogisip/+1234"
+            " 100 XML default elcid 1099 60")
+
+    def assert_format_call_like_str_format(self, formatter, **kw):
+        expected = formatter.template.format(**kw)
+        call = formatter.format_call(**kw)
+        self.assertEqual(type(call), type(expected))
+        self.assertEqual(call, expected)
+        return call
+
+    def test_format_call_non_ascii_addresses(self):
+        formatter = self.mk_formatter(
+            call_url=u'{{origination_uuid={uuid}}}sofia/gateway/yogisip/'
+                     u'{to_addr}')
+        call = self.assert_format_call_like_str_format(
+            formatter, to_addr=u'sip:jos\xe9@x', from_addr=u"1099",
+            uuid='test-uuid')
+        self.assertEqual(
+            call,
+            u"originate {origination_uuid=test-uuid}sofia/gateway/yogisip/"
+            u"sip:jos\xe9@x 100 XML default elcid 1099 60")
+
+    def test_format_call_non_ascii_addresses_str_template(self):
+        formatter = self.mk_formatter()
+        kw = {'to_addr': u'sip:jos\xe9@x', 'from_addr': u"1099",
+              'uuid': 'test-uuid'}
+        self.assertRaises(
+            UnicodeEncodeError, formatter.template.format, **kw)
+        self.assertRaises(UnicodeEncodeError, formatter.format_call, **kw)
+
+    def format_compiled(self, template):
+        fmt, pick = OriginateFormatter.compile_template(template)
+        return fmt % pick(("from", "to", "id"))
+
+    def test_compile_template(self):
+        self.assertEqual(
+            self.format_compiled(
+                "{to_addr} {{literal}} 100% {from_addr} {to_addr} {uuid}"),
+            "to {literal} 100% from to id")
+
+    def test_compile_template_one_field(self):
+        self.assertEqual(self.format_compiled("call {to_addr}"), "call to")
+
+    def test_compile_template_no_fields(self):
+        self.assertEqual(
+            self.format_compiled("call {{nobody}}"), "call {nobody}")
+
+    def test_compile_template_format_spec(self):
+        self.assertEqual(
+            OriginateFormatter.compile_template("call {to_addr:>4}"), None)
+
+    def test_compile_template_unknown_field(self):
+        self.assertEqual(
+            OriginateFormatter.compile_template("call {other}"), None)
+
+    def test_format_call_not_compiled(self):
+        formatter = self.mk_formatter(exten='{to_addr:>6}')
+        self.assertEqual(
+            formatter.format_call(
+                to_addr="+1234", from_addr="1099", uuid='test-uuid'),
+            "originate {origination_uuid=test-uuid}sofia/gateway/yogisip/+1234"
+            "  +1234 XML default elcid 1099 60")
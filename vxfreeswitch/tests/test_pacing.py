@@ -0,0 +1,195 @@
+""" Tests for vxfreeswitch.pacing. """
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import Metric
+
+from vxfreeswitch.pacing import DialPacer
+
+
+class TestDialPacer(TestCase):
+    def mk_pacer(self, min_limit=1, max_limit=4, **kw):
+        self.clock = Clock()
+        return DialPacer(min_limit, max_limit, clock=self.clock, **kw)
+
+    def dial(self, pacer, call_uuid):
+        self.assertTrue(pacer.has_slot())
+        pacer.dial_started(call_uuid, self.clock.seconds())
+
+    def test_starts_at_max_limit(self):
+        pacer = self.mk_pacer(max_limit=4)
+        self.assertEqual(pacer.current_limit(), 4)
+        self.assertEqual(pacer.state(), {
+            'limit': 4, 'in_flight': 0, 'answer_rate': None,
+            'answer_time': None})
+
+    def test_has_slot(self):
+        pacer = self.mk_pacer(max_limit=2)
+        self.dial(pacer, 'uuid-0')
+        self.dial(pacer, 'uuid-1')
+        self.assertFalse(pacer.has_slot())
+        self.assertEqual(pacer.in_flight, 2)
+        pacer.call_answered('uuid-0')
+        self.assertTrue(pacer.has_slot())
+        self.assertEqual(pacer.in_flight, 1)
+
+    def test_on_release(self):
+        released = []
+        pacer = self.mk_pacer(on_release=lambda: released.append(
+            pacer.in_flight))
+        self.dial(pacer, 'uuid-0')
+        self.dial(pacer, 'uuid-1')
+        self.assertEqual(released, [])
+        pacer.call_ended('uuid-0')
+        pacer.call_ended('uuid-0')
+        self.assertEqual(released, [1])
+
+    def test_call_answered(self):
+        pacer = self.mk_pacer()
+        self.dial(pacer, 'uuid-1')
+        self.clock.advance(5)
+        pacer.call_answered('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), 1.0)
+        self.assertEqual(pacer.answer_time(), 5)
+
+    def test_answer_time_from_dial_start(self):
+        pacer = self.mk_pacer()
+        pacer.dial_started('uuid-1', self.clock.seconds())
+        self.clock.advance(5)
+        pacer.call_renamed('uuid-1', 'uuid-2')
+        pacer.call_answered('uuid-2')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_time(), 5)
+
+    def test_call_answered_unknown_call(self):
+        pacer = self.mk_pacer()
+        pacer.call_answered('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), None)
+
+    def test_call_ended_after_answer_ignored(self):
+        pacer = self.mk_pacer()
+        self.dial(pacer, 'uuid-1')
+        pacer.call_answered('uuid-1')
+        pacer.call_ended('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), 1.0)
+
+    def test_call_ended_unanswered(self):
+        pacer = self.mk_pacer()
+        self.dial(pacer, 'uuid-1')
+        pacer.call_ended('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), 0.0)
+
+    def test_call_adopted(self):
+        pacer = self.mk_pacer()
+        self.dial(pacer, 'uuid-1')
+        pacer.call_adopted('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), None)
+        pacer.call_ended('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+
+    def test_dial_cancelled(self):
+        pacer = self.mk_pacer()
+        self.dial(pacer, 'uuid-1')
+        pacer.dial_cancelled('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), None)
+        pacer.dial_cancelled('uuid-1')
+        self.assertEqual(pacer.in_flight, 0)
+
+    def test_additive_increase(self):
+        pacer = self.mk_pacer(max_limit=10)
+        pacer.limit = 2.0
+        for i in range(2):
+            self.dial(pacer, 'uuid-%d' % (i,))
+        pacer.call_answered('uuid-0')
+        self.assertEqual(pacer.limit, 2.5)
+        pacer.call_answered('uuid-1')
+        self.assertEqual(pacer.limit, 2.9)
+        self.assertEqual(pacer.current_limit(), 2)
+
+    def test_increase_capped_at_max_limit(self):
+        pacer = self.mk_pacer(max_limit=2)
+        self.dial(pacer, 'uuid-1')
+        pacer.call_answered('uuid-1')
+        self.assertEqual(pacer.limit, 2)
+
+    def test_no_increase_below_target_answer_rate(self):
+        pacer = self.mk_pacer(max_limit=10, target_answer_rate=0.75)
+        pacer.limit = 2.0
+        self.dial(pacer, 'uuid-0')
+        self.dial(pacer, 'uuid-1')
+        pacer.call_ended('uuid-0')
+        pacer.call_answered('uuid-1')
+        self.assertEqual(pacer.limit, 2.0)
+
+    def test_no_increase_when_answer_slow(self):
+        pacer = self.mk_pacer(max_limit=10, max_answer_time=10)
+        pacer.limit = 2.0
+        self.dial(pacer, 'uuid-0')
+        self.clock.advance(20)
+        pacer.call_answered('uuid-0')
+        self.assertEqual(pacer.limit, 2.0)
+
+    def test_dial_failed_unknown_call(self):
+        pacer = self.mk_pacer()
+        pacer.dial_failed('uuid-1', None)
+        self.assertEqual(pacer.in_flight, 0)
+        self.assertEqual(pacer.answer_rate(), None)
+
+    def test_congestion_decrease(self):
+        pacer = self.mk_pacer(
+            max_limit=8, congestion_causes=['SWITCH_CONGESTION'])
+        self.dial(pacer, 'uuid-0')
+        pacer.dial_failed('uuid-0', 'SWITCH_CONGESTION')
+        self.assertEqual(pacer.current_limit(), 4)
+        self.assertEqual(pacer.in_flight, 0)
+        self.dial(pacer, 'uuid-1')
+        pacer.dial_failed('uuid-1', 'USER_BUSY')
+        self.assertEqual(pacer.current_limit(), 4)
+
+    def test_decrease_capped_at_min_limit(self):
+        pacer = self.mk_pacer(
+            min_limit=3, max_limit=4, congestion_causes=['SWITCH_CONGESTION'])
+        self.dial(pacer, 'uuid-0')
+        pacer.dial_failed('uuid-0', 'SWITCH_CONGESTION')
+        self.assertEqual(pacer.current_limit(), 3)
+
+    def test_low_answer_rate_decrease_once_per_window(self):
+        pacer = self.mk_pacer(max_limit=8, window=2)
+        for i in range(4):
+            self.dial(pacer, 'uuid-%d' % (i,))
+            pacer.dial_failed('uuid-%d' % (i,), None)
+            self.assertEqual(pacer.current_limit(), [8, 4, 4, 2][i])
+
+    def test_decrease_while_full(self):
+        pacer = self.mk_pacer(
+            max_limit=2, congestion_causes=['SWITCH_CONGESTION'])
+        self.dial(pacer, 'uuid-0')
+        self.dial(pacer, 'uuid-1')
+        pacer.dial_failed('uuid-0', 'SWITCH_CONGESTION')
+        self.assertFalse(pacer.has_slot())
+        self.assertEqual(pacer.in_flight, 1)
+
+    def test_metrics(self):
+        metrics = dict(
+            (name, Metric(name))
+            for name in ('limit', 'in_flight', 'answer_rate', 'answer_time'))
+        pacer = self.mk_pacer(max_limit=4, metrics=metrics)
+        self.dial(pacer, 'uuid-1')
+        self.clock.advance(2)
+        pacer.call_answered('uuid-1')
+        self.assertEqual(
+            dict((name, [v for _, v in metric.poll()])
+                 for name, metric in metrics.items()),
+            {
+                'limit': [4, 4],
+                'in_flight': [1, 0],
+                'answer_rate': [1.0],
+                'answer_time': [2],
+            })
@@ -0,0 +1,80 @@
+""" Tests for vxfreeswitch.reuseport. """
+
+import socket
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import ServerFactory, ClientFactory, Protocol
+from twisted.trial.unittest import SkipTest, TestCase
+
+from vxfreeswitch.reuseport import (
+    TCPAddress, listen_reuse_port, parse_tcp_address, reuse_port_supported)
+
+
+class TestParseTcpAddress(TestCase):
+    def test_tcp(self):
+        self.assertEqual(
+            parse_tcp_address('tcp:port=8084'),
+            TCPAddress(socket.AF_INET, '0.0.0.0', 8084, 50))
+
+    def test_tcp_positional(self):
+        self.assertEqual(
+            parse_tcp_address('tcp:8084:127.0.0.1:10'),
+            TCPAddress(socket.AF_INET, '127.0.0.1', 8084, 10))
+
+    def test_tcp_keywords(self):
+        self.assertEqual(
+            parse_tcp_address('tcp:backlog=10:interface=127.0.0.1:port=8084'),
+            TCPAddress(socket.AF_INET, '127.0.0.1', 8084, 10))
+
+    def test_tcp6(self):
+        self.assertEqual(
+            parse_tcp_address('tcp6:8084:10'),
+            TCPAddress(socket.AF_INET6, '::', 8084, 10))
+
+    def test_escaped_interface(self):
+        self.assertEqual(
+            parse_tcp_address(r'tcp6:port=8084:interface=\:\:1'),
+            TCPAddress(socket.AF_INET6, '::1', 8084, 50))
+
+    def test_other_endpoint(self):
+        self.assertEqual(parse_tcp_address('unix:/tmp/sock'), None)
+
+
+class TestListenReusePort(TestCase):
+    def setUp(self):
+        if not reuse_port_supported():
+            raise SkipTest("SO_REUSEPORT not supported.")
+
+    @inlineCallbacks
+    def listen(self, port=0, factory=None):
+        if factory is None:
+            factory = ServerFactory.forProtocol(Protocol)
+        address = TCPAddress(socket.AF_INET, '127.0.0.1', port, 50)
+        listening_port = yield listen_reuse_port(address, factory)
+        self.addCleanup(listening_port.stopListening)
+        returnValue(listening_port)
+
+    @inlineCallbacks
+    def test_shared_port(self):
+        port_a = yield self.listen()
+        port_number = port_a.getHost().port
+        port_b = yield self.listen(port_number)
+        self.assertEqual(port_b.getHost().port, port_number)
+
+    @inlineCallbacks
+    def test_accepts_connections(self):
+        disconnected = Deferred()
+
+        class ServerProtocol(Protocol):
+            def connectionLost(self, reason):
+                disconnected.callback(None)
+
+        port = yield self.listen(
+            factory=ServerFactory.forProtocol(ServerProtocol))
+        endpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', port.getHost().port)
+        client = yield endpoint.connect(ClientFactory.forProtocol(Protocol))
+        client.transport.loseConnection()
+        yield disconnected
@@ -0,0 +1,92 @@
+""" Tests for vxfreeswitch.routing. """
+
+from twisted.trial.unittest import TestCase
+
+from vxfreeswitch.originate import OriginateMissingParameter
+from vxfreeswitch.routing import OriginateRouter, PrefixTrie
+
+
+class TestPrefixTrie(TestCase):
+    def test_empty(self):
+        trie = PrefixTrie()
+        self.assertEqual(len(trie), 0)
+        self.assertEqual(trie.longest_match("27831234567"), None)
+        self.assertEqual(trie.longest_match("27831234567", "dflt"), "dflt")
+
+    def test_longest_match(self):
+        trie = PrefixTrie()
+        trie.insert("27", "za")
+        trie.insert("2783", "za-mobile")
+        trie.insert("1", "us")
+        self.assertEqual(len(trie), 3)
+        self.assertEqual(trie.longest_match("27831234567"), "za-mobile")
+        self.assertEqual(trie.longest_match("27211234567"), "za")
+        self.assertEqual(trie.longest_match("15551234567"), "us")
+        self.assertEqual(trie.longest_match("44201234567"), None)
+
+    def test_prefix_longer_than_address(self):
+        trie = PrefixTrie()
+        trie.insert("2783", "za-mobile")
+        self.assertEqual(trie.longest_match("278"), None)
+
+    def test_empty_prefix(self):
+        trie = PrefixTrie()
+        trie.insert("", "any")
+        self.assertEqual(trie.longest_match("27"), "any")
+
+    def test_replace(self):
+        trie = PrefixTrie()
+        trie.insert("27", "a")
+        trie.insert("27", "b")
+        self.assertEqual(len(trie), 1)
+        self.assertEqual(trie.longest_match("27"), "b")
+
+
+class TestOriginateRouter(TestCase):
+    DEFAULTS = {
+        'call_url': 'sofia/gateway/default/{to_addr}',
+        'exten': '100',
+        'cid_name': 'elcid',
+        'cid_num': '+1234',
+    }
+
+    def test_default(self):
+        router = OriginateRouter(self.DEFAULTS)
+        self.assertEqual(
+            router.format_call('+100', '27831234567', 'uuid'),
+            "originate sofia/gateway/default/27831234567 100 XML default"
+            " elcid +1234 60")
+
+    def test_route(self):
+        router = OriginateRouter(self.DEFAULTS, {
+            '27': {'call_url': 'sofia/gateway/za/{to_addr}'},
+            '2783': {
+                'call_url': 'sofia/gateway/za-mobile/{to_addr}',
+                'timeout': 30,
+            },
+        })
+        self.assertEqual(
+            router.format_call('+100', '27831234567', 'uuid'),
+            "originate sofia/gateway/za-mobile/27831234567 100 XML default"
+            " elcid +1234 30")
+        self.assertEqual(
+            router.format_call('+100', '27211234567', 'uuid'),
+            "originate sofia/gateway/za/27211234567 100 XML default"
+            " elcid +1234 60")
+        self.assertEqual(
+            router.format_call('+100', '15551234567', 'uuid'),
+            "originate sofia/gateway/default/15551234567 100 XML default"
+            " elcid +1234 60")
+
+    def test_max_timeout(self):
+        router = OriginateRouter(self.DEFAULTS, {
+            '27': {'timeout': '90'},
+            '1': {'timeout': 30},
+        })
+        self.assertEqual(router.max_timeout(), 90)
+
+    def test_missing_parameter(self):
+        defaults = dict(self.DEFAULTS)
+        del defaults['exten']
+        self.assertRaises(
+            OriginateMissingParameter, OriginateRouter, defaults)
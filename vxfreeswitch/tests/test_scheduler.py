@@ -0,0 +1,101 @@
+""" Tests for vxfreeswitch.scheduler. """
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxfreeswitch.scheduler import Scheduler
+
+
+class TestScheduler(TestCase):
+    def mk_scheduler(self):
+        self.clock = Clock()
+        self.calls = []
+        scheduler = Scheduler(clock=self.clock)
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def record(self, *args, **kw):
+        self.calls.append((args, kw))
+
+    def test_schedule(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('a', 5, self.record, 1, b=2)
+        self.assertTrue('a' in scheduler)
+        self.assertEqual(len(scheduler), 1)
+        self.clock.advance(4.9)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.calls, [((1,), {'b': 2})])
+        self.assertFalse('a' in scheduler)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_single_delayed_call(self):
+        scheduler = self.mk_scheduler()
+        for i in range(100):
+            scheduler.schedule(i, 100 - i, self.record, i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.pump([1] * 100)
+        self.assertEqual(
+            [args for args, kw in self.calls],
+            [(i,) for i in reversed(range(100))])
+
+    def test_earlier_schedule_resets_delayed_call(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('a', 10, self.record, 'a')
+        scheduler.schedule('b', 1, self.record, 'b')
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [(('b',), {})])
+
+    def test_reschedule_replaces_key(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('a', 1, self.record, 'first')
+        scheduler.schedule('a', 2, self.record, 'second')
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [(('second',), {})])
+
+    def test_cancel(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('a', 1, self.record, 'a')
+        scheduler.cancel('a')
+        self.assertEqual(len(scheduler), 0)
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancelled_entries_compacted(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('b', 1000, self.record, 'b')
+        for i in range(1000):
+            scheduler.schedule('a', 10 + i, self.record, i)
+            self.assertTrue(len(scheduler._heap) <= Scheduler.MIN_COMPACT + 3)
+        self.clock.advance(1009)
+        self.assertEqual(self.calls, [(('b',), {}), ((999,), {})])
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler._cancelled, 0)
+
+    def test_cancel_unknown_key(self):
+        scheduler = self.mk_scheduler()
+        scheduler.cancel('a')
+        self.assertEqual(len(scheduler), 0)
+
+    def test_stop(self):
+        scheduler = self.mk_scheduler()
+        scheduler.schedule('a', 1, self.record, 'a')
+        scheduler.stop()
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_error_in_callback(self):
+        scheduler = self.mk_scheduler()
+
+        def fail():
+            raise ValueError("boom")
+
+        scheduler.schedule('a', 1, fail)
+        scheduler.schedule('b', 1, self.record, 'b')
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [(('b',), {})])
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(str(err.value), "boom")
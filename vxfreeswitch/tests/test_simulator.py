@@ -0,0 +1,206 @@
+""" Tests for vxfreeswitch.simulator. """
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.tests.helpers import TransportHelper
+
+from vxfreeswitch import VoiceServerTransport
+from vxfreeswitch.eslparser import EventParser
+from vxfreeswitch.simulator import (
+    EslCommand, FreeSwitchSimulator, SimulatedCall, originate_uuid)
+
+
+def parse(data):
+    # SimulatedCall follows each message with blank lines, which parse as
+    # empty messages.
+    return [ev for ev in EventParser().feed(data) if ev.get("Content_Type")]
+
+
+class TestOriginateUuid(TestCase):
+    def test_origination_uuid(self):
+        self.assertEqual(originate_uuid(
+            "originate {origination_uuid=abc-1234,ignore_early_media=true}"
+            "sofia/gateway/yogisip/100 &park()"), "abc-1234")
+        self.assertEqual(originate_uuid(
+            "originate {origination_uuid=abc-1234}sofia/gateway/yogisip"),
+            "abc-1234")
+
+    def test_no_origination_uuid(self):
+        self.assertEqual(
+            originate_uuid("originate sofia/gateway/yogisip 100"), None)
+
+
+class TestSimulatedCall(TestCase):
+    def mk_call(self, **kw):
+        self.clock = Clock()
+        call = SimulatedCall("abc-1234", "27831234567", clock=self.clock, **kw)
+        call.makeConnection(StringTransport())
+        return call
+
+    def send(self, call, cmd):
+        call.transport.clear()
+        call.dataReceived(cmd)
+        return parse(call.transport.value())
+
+    def test_connect(self):
+        call = self.mk_call()
+        [reply] = self.send(call, "connect\n\n")
+        self.assertEqual(reply.Reply_Text, "+OK")
+        self.assertEqual(reply.variable_call_uuid, "abc-1234")
+        self.assertEqual(reply.variable_caller_id_number, "27831234567")
+
+    def test_media(self):
+        call = self.mk_call(events=True, media_time=2)
+        [reply, execute] = self.send(
+            call, "sendmsg\ncall-command: execute\n"
+            "execute-app-name: playback\nexecute-app-arg: foo.wav\n\n")
+        self.assertEqual(reply.Reply_Text, "+OK")
+        self.assertEqual(execute.data.Event_Name, "CHANNEL_EXECUTE")
+        self.assertEqual(
+            call.queue.pending[0]["execute-app-name"], "playback")
+        call.transport.clear()
+        self.clock.advance(2)
+        [complete] = parse(call.transport.value())
+        self.assertEqual(complete.data.Event_Name, "CHANNEL_EXECUTE_COMPLETE")
+        self.assertEqual(complete.data.Application, "playback")
+
+    def test_media_without_events(self):
+        call = self.mk_call(media_time=2)
+        [reply] = self.send(
+            call, "sendmsg\ncall-command: execute\n"
+            "execute-app-name: speak\n\n")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_answer(self):
+        msg = "sendmsg\ncall-command: execute\nexecute-app-name: answer\n\n"
+        [reply] = self.send(self.mk_call(), msg)
+        [reply, answer] = self.send(self.mk_call(originated=True), msg)
+        self.assertEqual(answer.data.Event_Name, "Channel_Answer")
+
+    def test_transport_hangup(self):
+        call = self.mk_call(events=True)
+        [reply, hangup, disconnect] = self.send(
+            call, "sendmsg\ncall-command: execute\n"
+            "execute-app-name: hangup\nexecute-app-arg: USER_BUSY\n\n")
+        self.assertEqual(hangup.data.Event_Name, "Channel_Hangup_Complete")
+        self.assertEqual(hangup.data.Hangup_Cause, "USER_BUSY")
+        self.assertEqual(disconnect.Content_Type, "text/disconnect-notice")
+        self.assertTrue(call.transport.disconnecting)
+
+    def test_send_dtmf(self):
+        call = self.mk_call()
+        call.send_dtmf("12")
+        events = parse(call.transport.value())
+        self.assertEqual(
+            [ev.data.DTMF_Digit for ev in events], ["1", "2"])
+
+
+class TestFreeSwitchSimulator(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
+        self.simulator = FreeSwitchSimulator(None)
+        server = yield TCP4ServerEndpoint(
+            reactor, 0, interface='127.0.0.1').listen(self.simulator)
+        self.add_cleanup(server.stopListening)
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'freeswitch_endpoint': 'tcp:127.0.0.1:port=%d' % (
+                server.getHost().port,),
+            'originate_parameters': {
+                'call_url': '/sofia/gateway/yogisip',
+                'exten': '100',
+                'cid_name': 'elcid',
+                'cid_num': '+1234'
+            },
+        })
+        self.simulator.call_endpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.worker.voice_server.getHost().port)
+        self.add_cleanup(self.simulator.stop)
+
+    def test_api(self):
+        d = self.simulator.api("status")
+        self.assertEqual(self.successResultOf(d), (
+            "UP 0 years, 0 days\n"
+            "0 session(s) - peak 0, last 5min 0\n"
+            "10000 session(s) max\n"))
+        d = self.simulator.api("uuid_kill abc-1234")
+        self.assertEqual(self.successResultOf(d), "+OK")
+
+    @inlineCallbacks
+    def test_stop(self):
+        self.simulator.script = [('media',)]
+        d = self.simulator.start_call("abc-1234")
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.simulator.stop()
+        call = yield d
+        self.assertFalse(call.connected)
+        self.assertEqual(self.simulator.setup_latencies, [])
+        self.assertEqual(self.simulator.completed_calls, 1)
+
+    @inlineCallbacks
+    def test_inbound_call(self):
+        self.simulator.script = [
+            ('media',), ('dtmf', '5#'), ('media',), ('hangup', 'USER_BUSY')]
+        d = self.simulator.start_call("abc-1234")
+        [new] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            new['session_event'], TransportUserMessage.SESSION_NEW)
+        self.assertEqual(new['from_addr'], "abc-1234")
+        yield self.tx_helper.make_dispatch_reply(
+            new, "Pick one", helper_metadata={'voice': {'wait_for': '#'}})
+        [_, msg] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.assertEqual(msg['content'], '5')
+        yield self.tx_helper.make_dispatch_reply(msg, "Bye")
+        call = yield d
+        self.assertFalse(call.connected)
+        [_, _, close] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(self.simulator.completed_calls, 1)
+        self.assertEqual(len(self.simulator.setup_latencies), 1)
+        self.assertEqual(self.simulator.calls, {})
+
+    @inlineCallbacks
+    def test_originate(self):
+        self.simulator.script = [('media',)]
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['sent_message_id'], msg['message_id'])
+        yield self.simulator.wait_for_calls()
+        self.assertEqual(self.simulator.originates, 1)
+        self.assertEqual(self.simulator.completed_calls, 1)
+        self.assertEqual(len(self.simulator.setup_latencies), 1)
+
+    @inlineCallbacks
+    def test_failed_originate(self):
+        self.simulator.failure_rate = 1
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': -ERR NO_ANSWER")
+        self.assertEqual(self.simulator.failed_originates, 1)
+        self.assertEqual(self.simulator.completed_calls, 0)
+
+
+class TestEslCommand(TestCase):
+    def test_from_dict(self):
+        cmd = EslCommand.from_dict({'type': 'sendmsg', 'name': 'hangup'})
+        self.assertEqual(cmd['execute-app-name'], 'hangup')
+        self.assertEqual(cmd['call-command'], 'execute')
@@ -0,0 +1,59 @@
+""" Tests for vxfreeswitch.timeline. """
+
+from twisted.trial.unittest import TestCase
+
+from vxfreeswitch.timeline import CallTimeline
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCallTimeline(TestCase):
+    def mk_timeline(self, size=10):
+        self.clock = FakeClock()
+        return CallTimeline(size, clock=self.clock)
+
+    def test_record(self):
+        timeline = self.mk_timeline()
+        timeline.record('command', 'answer')
+        self.clock.now += 0.25
+        timeline.record('event', 'CHANNEL_ANSWER')
+        self.assertEqual(len(timeline), 2)
+        self.assertEqual(timeline.entries(), [
+            (100.0, 'command', 'answer', None),
+            (100.25, 'event', 'CHANNEL_ANSWER', None),
+        ])
+
+    def test_format(self):
+        timeline = self.mk_timeline()
+        timeline.record('command', 'playback', 'foo.wav')
+        self.clock.now += 1.5
+        timeline.record('reply', 'playback', 'failed: -ERR')
+        self.assertEqual(timeline.format(), [
+            "+0.000s command playback foo.wav",
+            "+1.500s reply playback failed: -ERR",
+        ])
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.mk_timeline(), '__dict__'))
+
+    def test_format_empty(self):
+        self.assertEqual(self.mk_timeline().format(), [])
+
+    def test_ring_buffer(self):
+        timeline = self.mk_timeline(size=2)
+        for i in range(5):
+            self.clock.now += 1
+            timeline.record('event', 'DTMF', str(i))
+        self.assertEqual(len(timeline), 2)
+        self.assertEqual(timeline.dropped, 3)
+        self.assertEqual(timeline.format(), [
+            "(3 earlier entries dropped)",
+            "+0.000s event DTMF 3",
+            "+1.000s event DTMF 4",
+        ])
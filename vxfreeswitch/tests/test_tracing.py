@@ -0,0 +1,112 @@
+""" Tests for vxfreeswitch.tracing. """
+
+import json
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from vumi.blinkenlights.metrics import MetricManager
+
+from vxfreeswitch.tracing import FirstAudioTracer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TestFirstAudioTracer(TestCase):
+    def mk_tracer(self, **kw):
+        self.clock = FakeClock()
+        return FirstAudioTracer(clock=self.clock, **kw)
+
+    def run_trace(self, tracer, message_id='msg-1', reply_id='reply-1'):
+        tracer.start(message_id, 'uuid-1')
+        self.clock.advance(0.01)
+        tracer.mark(message_id, 'published')
+        self.clock.advance(0.2)
+        tracer.reply(reply_id, message_id)
+        self.clock.advance(0.5)
+        tracer.mark_reply(reply_id, 'media_sent')
+        self.clock.advance(0.05)
+        tracer.finish_reply(reply_id)
+
+    def spans(self, tracer):
+        return dict(
+            (name, sum(histogram.totals))
+            for name, histogram in tracer.histograms.items())
+
+    def test_trace(self):
+        trace_file = StringIO()
+        tracer = self.mk_tracer(sample_rate=1.0, trace_file=trace_file)
+        self.run_trace(tracer)
+        [trace] = [json.loads(line) for line in trace_file.getvalue().split(
+            "\n") if line]
+        self.assertEqual(trace['call_uuid'], 'uuid-1')
+        self.assertEqual(trace['message_id'], 'msg-1')
+        self.assertEqual(trace['reply_id'], 'reply-1')
+        spans = dict(
+            (name, round(value, 6)) for name, value in trace['spans'].items())
+        self.assertEqual(spans, {
+            'transport': 0.01,
+            'application': 0.2,
+            'media_prep': 0.5,
+            'media_start': 0.05,
+            'total': 0.76,
+        })
+        self.assertEqual(self.spans(tracer), {
+            'transport': 1, 'application': 1, 'media_prep': 1,
+            'media_start': 1, 'total': 1})
+
+    def test_percentiles(self):
+        tracer = self.mk_tracer()
+        self.run_trace(tracer)
+        percentiles = tracer.percentiles(qs=(50,))
+        self.assertEqual(percentiles['total'], {50: 1})
+        self.assertEqual(percentiles['transport'], {50: 0.01})
+
+    def test_not_sampled(self):
+        trace_file = StringIO()
+        tracer = self.mk_tracer(
+            sample_rate=0.5, trace_file=trace_file, rand=lambda: 0.5)
+        self.run_trace(tracer)
+        self.assertEqual(trace_file.getvalue(), "")
+        self.assertEqual(self.spans(tracer)['total'], 1)
+
+    def test_reply_to_unknown_message(self):
+        tracer = self.mk_tracer()
+        tracer.reply('reply-1', 'msg-1')
+        tracer.mark_reply('reply-1', 'media_sent')
+        tracer.finish_reply('reply-1')
+        self.assertEqual(self.spans(tracer)['total'], 0)
+
+    def test_discard_reply(self):
+        tracer = self.mk_tracer()
+        tracer.start('msg-1', 'uuid-1')
+        tracer.reply('reply-1', 'msg-1')
+        tracer.discard_reply('reply-1')
+        tracer.finish_reply('reply-1')
+        self.assertEqual(self.spans(tracer)['total'], 0)
+        self.assertEqual(tracer._pending, {})
+
+    def test_max_pending(self):
+        tracer = self.mk_tracer(max_pending=2)
+        tracer.start('msg-1', 'uuid-1')
+        tracer.reply('reply-1', 'msg-1')
+        tracer.start('msg-2', 'uuid-1')
+        tracer.start('msg-3', 'uuid-1')
+        self.assertEqual(tracer._pending.keys(), ['msg-2', 'msg-3'])
+        self.assertEqual(tracer._replies, {})
+
+    def test_register(self):
+        manager = MetricManager('vumi.test.')
+        tracer = self.mk_tracer().register(manager)
+        self.assertTrue(isinstance(tracer, FirstAudioTracer))
+        self.assertTrue('trace.total.count' in manager)
+        self.assertTrue('trace.application.le_inf' in manager)
@@ -2,12 +2,18 @@
 
 """Tests for vxfreeswitch.voice."""
 
+import json
 import logging
 import md5
 import os
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet import defer, reactor
+from twisted.internet.task import Clock, deferLater
+from twisted.trial.unittest import SkipTest
+
+from confmodel.errors import ConfigError
+from eventsocket import _O
 
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
@@ -15,9 +21,26 @@ from vumi.tests.utils import LogCatcher
 from vumi.transports.tests.helpers import TransportHelper
 
 from vxfreeswitch import VoiceServerTransport
-from vxfreeswitch.voice import FreeSwitchESLProtocol
-from vxfreeswitch.tests.helpers import (
-    EslCommand, EslHelper, EslTransport, FixtureApiResponse)
+from vxfreeswitch.calllog import CallLogger
+from vxfreeswitch.client import FreeSwitchClientReply
+from vxfreeswitch.eslparser import EventParser
+from vxfreeswitch.reuseport import reuse_port_supported
+from vxfreeswitch.scheduler import Scheduler
+from vxfreeswitch.simulator import EslCommand, FixtureApiResponse
+from vxfreeswitch.tracing import FirstAudioTracer
+from vxfreeswitch.voice import CallState, FreeSwitchESLProtocol
+from vxfreeswitch.tests.helpers import EslHelper, EslTransport
+
+
+def publish_metric_values(worker, tx_helper):
+    """ Publish ``worker``'s metrics and return the values dispatched for
+    each metric, keyed by metric name.
+    """
+    worker.metrics.publish_metrics()
+    return dict(
+        (metric_name, [value for _, value in values])
+        for datapoints in tx_helper.get_dispatched_metrics()
+        for metric_name, aggs, values in datapoints)
 
 
 class TestFreeSwitchESLProtocol(VumiTestCase):
@@ -137,6 +160,8 @@ class TestFreeSwitchESLProtocol(VumiTestCase):
 
         with open(voice_filename) as f:
             self.assertEqual(f.read(), "Dummy voice file")
+        self.assertEqual(
+            sum(self.worker.latencies['tts_generation'].totals), 0)
 
     @inlineCallbacks
     def test_create_and_stream_text_as_speech_file_not_found(self):
@@ -158,6 +183,8 @@ class TestFreeSwitchESLProtocol(VumiTestCase):
 
         with open(voice_filename) as f:
             self.assertEqual(f.read(), "Hello!")
+        self.assertEqual(
+            sum(self.worker.latencies['tts_generation'].totals), 1)
 
     @inlineCallbacks
     def test_send_text_as_speech(self):
@@ -166,6 +193,31 @@ class TestFreeSwitchESLProtocol(VumiTestCase):
         yield self.assert_and_reply_tts("thomas", "his_masters_voice", "hi!")
         yield d
 
+    @inlineCallbacks
+    def test_command_round_trip_times(self):
+        d = self.proto.send_text_as_speech(
+            "thomas", "his_masters_voice", "hi!")
+        yield self.assert_and_reply_tts("thomas", "his_masters_voice", "hi!")
+        yield d
+        histograms = self.worker.command_timer.histograms
+        self.assertEqual(sorted(histograms), ['playback', 'set'])
+        self.assertEqual(sum(histograms['set'].totals), 3)
+        self.assertEqual(sum(histograms['playback'].totals), 1)
+
+    @inlineCallbacks
+    def test_slow_command_logged(self):
+        self.proto.uniquecallid = "abc-1234"
+        self.worker.command_timer.slow_threshold = -1
+        with LogCatcher(message='Slow ESL command') as lc:
+            d = self.proto.output_stream("http://example.com/foo.mp3")
+            yield self.assert_and_reply_playback("http://example.com/foo.mp3")
+            yield d
+        self.assertEqual(
+            [log_msg.rsplit(':', 1)[0] for log_msg in lc.messages()], [
+                "Slow ESL command 'set' on abc-1234",
+                "Slow ESL command 'playback' on abc-1234",
+            ])
+
     @inlineCallbacks
     def test_output_message(self):
         self.proto.uniquecallid = "abc-1234"
@@ -197,6 +249,24 @@ class TestFreeSwitchESLProtocol(VumiTestCase):
                 "[abc-1234] Unbound event 'custom_event'",
             ])
 
+    def test_call_log_level(self):
+        self.worker.call_logger = CallLogger(self.worker.log, logging.INFO)
+        self.proto.uniquecallid = "abc-1234"
+        with LogCatcher(message=r'^\[abc-1234\]') as lc:
+            self.proto.unboundEvent({"some": "data"}, "custom_event")
+            self.proto.onChannelAnswer({})
+            self.assertEqual(lc.messages(), [
+                "[abc-1234] Channel answered",
+            ])
+        self.assertEqual(lc.logs[0]['call_uuid'], "abc-1234")
+
+    def test_invalid_call_log_level(self):
+        self.assertRaises(
+            ConfigError, self.tx_helper.get_transport, {
+                'twisted_endpoint': 'tcp:port=0',
+                'call_log_level': 'CHATTY',
+            })
+
     @inlineCallbacks
     def test_output_stream_barge_in_defaults(self):
         self.proto.output_stream('foo', {'barge_in': True})
@@ -221,17 +291,318 @@ class TestFreeSwitchESLProtocol(VumiTestCase):
             "thomas", "his_masters_voice", "text with single quote\\'s")
         yield d
 
+    def test_output_stream_reaches_sent_stage(self):
+        sent_d = self.proto.wait_for_media('sent')
+        started_d = self.proto.wait_for_media('started')
+        self.proto.output_stream('foo')
+        self.assertEqual(sent_d.result, True)
+        self.assertEqual(started_d.called, False)
+
+    def test_onChannelExecute_media_app(self):
+        sent_d = self.proto.wait_for_media('sent')
+        started_d = self.proto.wait_for_media('started')
+        self.proto.onChannelExecute({'Application': 'playback'})
+        self.assertEqual(sent_d.result, True)
+        self.assertEqual(started_d.result, True)
+
+    def test_onChannelExecute_other_app(self):
+        started_d = self.proto.wait_for_media('started')
+        self.proto.onChannelExecute({'Application': 'set'})
+        self.assertEqual(started_d.called, False)
+
+    def test_call_state(self):
+        self.assertEqual(self.proto.command_timer, self.worker.command_timer)
+        self.assertEqual(self.proto.input_type, None)
+        self.assertEqual(self.proto.current_input, '')
+        self.assertFalse(hasattr(self.proto.call, '__dict__'))
+        for name in CallState.__slots__:
+            self.assertFalse(name in self.proto.__dict__, name)
+        self.proto.set_input_type('#')
+        self.assertEqual(self.proto.call.input_type, '#')
+
+    def test_unknown_content_type(self):
+        with LogCatcher() as lc:
+            self.proto.eventReceived(_O(Content_Type='text/rude-rejection'))
+            self.assertEqual(lc.messages(), [
+                "[eventsocket] unknown Content-Type: text/rude-rejection",
+            ])
+
+    def test_release_media_waiters(self):
+        started_d = self.proto.wait_for_media('started')
+        self.assertEqual(
+            self.proto.release_media_waiters("result"), "result")
+        self.assertEqual(started_d.result, False)
+
+
+class TestVoiceServerTransportAckMode(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    def setUp(self):
+        self.tx_helper = self.add_helper(
+            TransportHelper(self.transport_class))
+
+    @inlineCallbacks
+    def mk_proto(self, ack_mode):
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'ack_mode': ack_mode,
+        })
+        self.tr = EslTransport()
+        self.proto = FreeSwitchESLProtocol(self.worker)
+        self.proto.transport = self.tr
+        self.proto.uniquecallid = "abc-1234"
+        self.proto.caller_id_number = "1234"
+
+    def send_event(self, params):
+        for key, value in params:
+            self.proto.dataReceived("%s:%s\n" % (key, value))
+        self.proto.dataReceived("\n")
+
+    def send_command_reply(self, response):
+        self.send_event([
+            ("Content_Type", "command/reply"),
+            ("Reply_Text", response),
+        ])
+
+    def send_execute_event(self, application):
+        body = "Event-Name: CHANNEL_EXECUTE\nApplication: %s\n\n" % (
+            application,)
+        self.proto.dataReceived(
+            "Content-Type: text/event-plain\nContent-Length: %d\n\n%s" % (
+                len(body), body))
+
+    @inlineCallbacks
+    def reply_playback(self):
+        yield self.tr.cmds.get()
+        self.send_command_reply("+OK")
+        yield self.tr.cmds.get()
+        self.send_command_reply("+OK")
+
+    def send_outbound(self, url='http://example.com/foo.mp3'):
+        msg = self.tx_helper.make_outbound(
+            'hello', to_addr='abc-1234', helper_metadata={
+                'voice': {'speech_url': url},
+            })
+        return msg, self.worker.send_outbound_message(self.proto, msg)
+
+    def test_invalid_ack_mode(self):
+        return self.assertFailure(self.mk_proto('eventually'), ConfigError)
+
+    @inlineCallbacks
+    def test_ack_mode_sent(self):
+        yield self.mk_proto('sent')
+        msg, d = self.send_outbound()
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(d.called, False)
+
+        yield self.reply_playback()
+        yield d
+        self.assertEqual(len(self.tx_helper.get_dispatched_events()), 1)
+
+    @inlineCallbacks
+    def test_ack_mode_started(self):
+        yield self.mk_proto('started')
+        msg, d = self.send_outbound()
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+        self.send_execute_event('playback')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(d.called, False)
+
+        yield self.reply_playback()
+        yield d
+        self.assertEqual(len(self.tx_helper.get_dispatched_events()), 1)
+
+    @inlineCallbacks
+    def test_ack_mode_started_without_execute_event(self):
+        yield self.mk_proto('started')
+        msg, d = self.send_outbound()
+        yield self.reply_playback()
+        yield d
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_overlapping_messages(self):
+        yield self.mk_proto('started')
+        msg1, d1 = self.send_outbound('http://example.com/1.mp3')
+        msg2, d2 = self.send_outbound('http://example.com/2.mp3')
+        self.send_execute_event('playback')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg1['message_id'])
+
+        # The second message is only output once the first has finished.
+        yield self.reply_playback()
+        yield d1
+        self.assertEqual(d2.called, False)
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual(len(self.tx_helper.get_dispatched_events()), 1)
+
+        self.send_execute_event('playback')
+        [_, ack] = yield self.tx_helper.wait_for_dispatched_events(2)
+        self.assertEqual(ack['user_message_id'], msg2['message_id'])
+        yield self.reply_playback()
+        yield d2
+
+    @inlineCallbacks
+    def test_ack_mode_finished(self):
+        yield self.mk_proto('finished')
+        msg, d = self.send_outbound()
+        self.send_execute_event('playback')
+        yield self.tx_helper.kick_delivery()
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+        yield self.reply_playback()
+        yield d
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_media_stage_metrics(self):
+        yield self.mk_proto('finished')
+        msg, d = self.send_outbound()
+        self.send_execute_event('playback')
+        yield self.reply_playback()
+        yield d
+
+        values = publish_metric_values(self.worker, self.tx_helper)
+        names = sorted(
+            name for name, name_values in values.iteritems()
+            if name_values and name.startswith('sphex.outbound.'))
+        self.assertEqual(names, [
+            'sphex.outbound.media_finished',
+            'sphex.outbound.media_sent',
+            'sphex.outbound.media_started',
+        ])
+
+
+class TestVoiceServerTransportTracing(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(
+            TransportHelper(self.transport_class))
+        self.trace_file = self.mktemp()
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'trace_file': self.trace_file,
+            'trace_sample_rate': 1.0,
+        })
+        self.tr = EslTransport()
+        self.proto = FreeSwitchESLProtocol(self.worker)
+        self.proto.transport = self.tr
+        self.proto.uniquecallid = "abc-1234"
+        self.proto.caller_id_number = "1234"
+
+    def send_command_reply(self, response):
+        for key, value in [
+                ("Content_Type", "command/reply"), ("Reply_Text", response)]:
+            self.proto.dataReceived("%s:%s\n" % (key, value))
+        self.proto.dataReceived("\n")
+
+    def send_execute_event(self, application):
+        body = "Event-Name: CHANNEL_EXECUTE\nApplication: %s\n\n" % (
+            application,)
+        self.proto.dataReceived(
+            "Content-Type: text/event-plain\nContent-Length: %d\n\n%s" % (
+                len(body), body))
+
+    @inlineCallbacks
+    def reply_playback(self):
+        yield self.tr.cmds.get()
+        self.send_command_reply("+OK")
+        yield self.tr.cmds.get()
+        self.send_command_reply("+OK")
+
+    @inlineCallbacks
+    def send_reply(self, inbound):
+        reply = self.tx_helper.make_reply(
+            inbound, 'hello', helper_metadata={
+                'voice': {'speech_url': 'http://example.com/foo.mp3'},
+            })
+        self.worker._clients['abc-1234'] = self.proto
+        try:
+            d = self.worker.handle_outbound_message(reply)
+            self.send_execute_event('playback')
+            yield self.reply_playback()
+            yield d
+        finally:
+            del self.worker._clients['abc-1234']
+        returnValue(reply)
+
+    def read_traces(self):
+        self.worker._trace_file.flush()
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    @inlineCallbacks
+    def test_trace_input_to_playback(self):
+        self.worker.send_inbound_message(
+            self.proto, '5', TransportUserMessage.SESSION_RESUME)
+        [inbound] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = yield self.send_reply(inbound)
+
+        [trace] = self.read_traces()
+        self.assertEqual(trace['call_uuid'], 'abc-1234')
+        self.assertEqual(trace['message_id'], inbound['message_id'])
+        self.assertEqual(trace['reply_id'], reply['message_id'])
+        self.assertEqual(
+            sorted(trace['points']), sorted(FirstAudioTracer.POINTS))
+        self.assertEqual(
+            sorted(trace['spans']),
+            sorted(name for name, _, _ in FirstAudioTracer.SPANS))
+        for histogram in self.worker.tracer.histograms.values():
+            self.assertEqual(sum(histogram.totals), 1)
+        self.assertEqual(self.worker.tracer._pending, {})
+
+    @inlineCallbacks
+    def test_session_close_not_traced(self):
+        self.worker.send_inbound_message(
+            self.proto, None, TransportUserMessage.SESSION_CLOSE)
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(self.worker.tracer._pending, {})
+
+    @inlineCallbacks
+    def test_reply_to_untraced_message(self):
+        inbound = self.tx_helper.make_inbound('5', from_addr='abc-1234')
+        yield self.send_reply(inbound)
+        self.assertEqual(self.read_traces(), [])
+        self.assertEqual(
+            sum(self.worker.tracer.histograms['total'].totals), 0)
+
+    @inlineCallbacks
+    def test_trace_metrics(self):
+        self.worker.send_inbound_message(
+            self.proto, '5', TransportUserMessage.SESSION_RESUME)
+        [inbound] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.send_reply(inbound)
+
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.trace.total.count'], [1])
+        self.assertEqual(values['sphex.trace.application.count'], [1])
+
 
 class TestVoiceServerTransportInboundCalls(VumiTestCase):
 
     transport_class = VoiceServerTransport
     transport_type = 'voice'
+    extra_config = {}
 
     @inlineCallbacks
     def setUp(self):
         self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
         self.esl_helper = self.add_helper(EslHelper())
-        self.worker = yield self.tx_helper.get_transport({
+        self.worker = yield self.tx_helper.get_transport(dict({
             'twisted_endpoint': 'tcp:port=0',
             'freeswitch_endpoint': 'tcp:127.0.0.1:1337',
             'originate_parameters': {
@@ -240,7 +611,7 @@ class TestVoiceServerTransportInboundCalls(VumiTestCase):
                 'cid_name': 'elcid',
                 'cid_num': '+1234'
             },
-        })
+        }, **self.extra_config))
         self.client = yield self.esl_helper.mk_client(self.worker)
 
     def assert_get_digits_command(self, cmd, msg, **kwargs):
@@ -289,6 +660,85 @@ class TestVoiceServerTransportInboundCalls(VumiTestCase):
         self.assertEqual(
             msg['helper_metadata']['voice']['call_duration'], duration)
 
+    @inlineCallbacks
+    def test_call_gauges(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.calls.active'], [1])
+        self.assertEqual(values['sphex.calls.unanswered'], [0])
+        self.assertEqual(values['sphex.calls.pending_originate'], [0])
+
+    @inlineCallbacks
+    def test_hangup_metrics(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+        self.client.sendChannelHangupCompleteEvent(
+            2000000, hangup_cause='USER_BUSY')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.calls.hangup.USER_BUSY'], [1.0])
+        self.assertEqual(values['sphex.calls.duration.count'], [1])
+        self.assertEqual(values['sphex.calls.duration.avg'], [2.0])
+        self.assertEqual(values['sphex.calls.duration.le_5'], [1])
+        self.assertEqual(values['sphex.calls.active'], [0])
+
+    @inlineCallbacks
+    def test_abnormal_hangup_logs_timeline(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+        with LogCatcher(message='Timeline') as lc:
+            self.client.sendChannelHangupCompleteEvent(
+                20, hangup_cause='MEDIA_TIMEOUT')
+            yield self.tx_helper.wait_for_dispatched_inbound(1)
+        [timeline_log] = lc.messages()
+        lines = timeline_log.split("\n")
+        self.assertEqual(
+            lines[0],
+            "Timeline for call 'test-uuid' (hangup cause MEDIA_TIMEOUT):")
+        self.assertEqual(
+            [line.split(None, 1)[1] for line in lines[1:]], [
+                'command connect',
+                'reply connect',
+                'command myevents',
+                'reply myevents',
+                'command answer',
+                'reply answer',
+                'event Channel_Hangup_Complete MEDIA_TIMEOUT',
+            ])
+
+    @inlineCallbacks
+    def test_normal_hangup_does_not_log_timeline(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+        with LogCatcher(message='Timeline') as lc:
+            self.client.sendChannelHangupCompleteEvent(20)
+            yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(lc.messages(), [])
+
+    @inlineCallbacks
+    def test_call_timeline(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        lines = self.worker.call_timeline('test-uuid')
+        self.assertEqual(
+            [line.split(None, 1)[1] for line in lines], [
+                'command connect',
+                'reply connect',
+                'command myevents',
+                'reply myevents',
+                'command answer',
+                'reply answer',
+            ])
+        self.assertEqual(self.worker.call_timeline('unknown-uuid'), None)
+
+    @inlineCallbacks
+    def test_get_client(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        client = self.worker.get_client('test-uuid')
+        self.assertEqual(client.get_address(), 'test-uuid')
+        self.worker._msisdn_mapping['test-uuid'] = '54321'
+        self.assertIdentical(self.worker.get_client('54321'), client)
+        self.assertEqual(self.worker.get_client('unknown-uuid'), None)
+
     @inlineCallbacks
     def test_client_hangup_invalid_freeswitch_duration(self):
         yield self.tx_helper.wait_for_dispatched_inbound(1)
@@ -418,8 +868,10 @@ class TestVoiceServerTransportInboundCalls(VumiTestCase):
                         'speech_url': url
                     }
                 })
-        [warn_log] = lc.messages()
+        [warn_log, timeline_log] = lc.messages()
         self.assertEqual(warn_log, "Invalid URL %r" % url)
+        self.assertTrue(timeline_log.startswith(
+            "Timeline for call 'test-uuid' (Invalid URL 7):\n"))
 
         [nack] = yield self.tx_helper.get_dispatched_events()
         self.assertEqual(nack['user_message_id'], msg['message_id'])
@@ -446,9 +898,10 @@ class TestVoiceServerTransportInboundCalls(VumiTestCase):
                     }
                 })
 
-        [log] = lc.messages()
+        [log, timeline_log] = lc.messages()
         self.assertEqual(log, 'Invalid URL list %r' % (
             [invalid_url1, valid_url, invalid_url2], ))
+        self.assertTrue(timeline_log.startswith("Timeline for call"))
         [nack] = yield self.tx_helper.get_dispatched_events()
         self.assertEqual(nack['user_message_id'], msg['message_id'])
         self.assertEqual(nack['event_type'], 'nack')
@@ -536,6 +989,19 @@ class TestVoiceServerTransportInboundCalls(VumiTestCase):
         self.assertEqual(msg['content'], '56')
 
 
+class TestVoiceServerTransportInboundCallsFastParser(
+        TestVoiceServerTransportInboundCalls):
+    """ The inbound call tests, with calls parsed by EventParser. """
+
+    extra_config = {'esl_fast_parser': True}
+
+    @inlineCallbacks
+    def test_fast_parser(self):
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertTrue(isinstance(
+            self.worker._clients['test-uuid'].event_parser, EventParser))
+
+
 class TestVoiceServerTransportOutboundCalls(VumiTestCase):
 
     transport_class = VoiceServerTransport
@@ -659,6 +1125,8 @@ class TestVoiceServerTransportOutboundCalls(VumiTestCase):
 
         # Make sure that we don't keep the mapping after hangup
         self.assertEqual(len(self.worker._msisdn_mapping), 0)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
 
     @inlineCallbacks
     def test_create_call_outbound_using_msisdn(self):
@@ -721,8 +1189,15 @@ class TestVoiceServerTransportOutboundCalls(VumiTestCase):
             "Could not make call to client u'54321': +ERROR Bad horse.")
 
     @inlineCallbacks
-    def test_client_disconnect_without_answer(self):
-        self.worker = yield self.create_worker()
+    def test_create_call_fails_over_between_nodes(self):
+        self.worker = yield self.create_worker({
+            'freeswitch_endpoint': None,
+            'freeswitch_nodes': [
+                {'name': 'down', 'endpoint': 'tcp:127.0.0.1:port=1338'},
+                {'name': 'up', 'endpoint': 'tcp:127.0.0.1:port=1337'},
+            ],
+        })
+        [down, up] = self.worker.freeswitch_nodes.nodes
         factory = yield self.esl_helper.mk_server()
         factory.add_fixture(
             EslCommand("api originate /sofia/gateway/yogisip"
@@ -731,99 +1206,1434 @@ class TestVoiceServerTransportOutboundCalls(VumiTestCase):
 
         msg = self.tx_helper.make_outbound(
             'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+        self.assertEqual(down.client.breaker.failures, 1)
+        self.assertEqual(up.active_channels, 1)
 
         client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        client.sendChannelHangupCompleteEvent(7)
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(up.active_channels, 0)
 
-        with LogCatcher(log_level=logging.WARN) as lc:
+    @inlineCallbacks
+    def test_create_call_no_node_available(self):
+        self.worker = yield self.create_worker({
+            'freeswitch_endpoint': None,
+            'freeswitch_nodes': [
+                {'name': 'full', 'endpoint': 'tcp:127.0.0.1:port=1337',
+                 'max_channels': 0},
+            ],
+        })
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
             yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': No FreeSwitch node"
+            " available (full: 0/0 channels)")
 
-        self.assertEqual(lc.messages(), [])
+    @inlineCallbacks
+    def test_create_call_held_without_headroom(self):
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("1 session(s) - peak 1\n1 session(s) max\n"))
+        self.worker = yield self.create_worker({
+            'freeswitch_poll_interval': 60,
+        })
+        [node] = self.worker.freeswitch_nodes.nodes
+        while node.max_sessions is None:
+            yield self.sleep()
+        self.assertEqual(node.headroom(), 0)
 
-        events = yield self.tx_helper.get_dispatched_events()
-        self.assertEqual(events, [])
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Holding call') as lc:
+            yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(lc.messages(), [
+            "Holding call to u'54321': no free FreeSwitch sessions"])
+        self.assertEqual(self.worker._originated_calls, {})
+        self.assertEqual(len(self.worker._held_dials), 1)
 
-        client.sendDisconnectEvent()
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("0 session(s) - peak 1\n1 session(s) max\n"))
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+        yield self.worker.poll_freeswitch_nodes()
+        while not self.worker._originated_calls:
+            yield self.sleep()
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+        self.assertEqual(len(self.worker._held_dials), 0)
+        self.assertEqual(node.headroom(), 0)
 
-        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
-        self.assertEqual(nack['event_type'], 'nack')
-        self.assertEqual(nack['nack_reason'], 'Unanswered Call')
-        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(
+            values['sphex.freeswitch.default.sessions'], [1, 0])
+        self.assertEqual(
+            values['sphex.freeswitch.default.max_sessions'], [1, 1])
+        self.assertEqual(
+            values['sphex.freeswitch.default.headroom'], [0, 1])
 
     @inlineCallbacks
-    def test_wait_for_answer_false(self):
-        '''If the wait_for_answer config field is False, then we shouldn't wait
-        for a ChannelAnswer event before playing media.'''
-        self.worker = yield self.create_worker({'wait_for_answer': False})
+    def test_held_dials_released_up_to_headroom(self):
         factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("2 session(s) - peak 2\n2 session(s) max\n"))
+        self.worker = yield self.create_worker({
+            'freeswitch_poll_interval': 60,
+        })
+        [node] = self.worker.freeswitch_nodes.nodes
+        while node.max_sessions is None:
+            yield self.sleep()
+
+        for i in range(3):
+            msg = self.tx_helper.make_outbound(
+                'foobar', '12345', '5432%d' % (i,), session_event='new')
+            with LogCatcher(message='Holding call'):
+                yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(self.worker._held_dials), 3)
+
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("1 session(s) - peak 2\n2 session(s) max\n"))
         factory.add_fixture(
             EslCommand("api originate /sofia/gateway/yogisip"
                        " 100 XML default elcid +1234 60"),
             FixtureApiResponse("+OK uuid-1234"))
+        yield self.worker.poll_freeswitch_nodes()
+        self.assertEqual(len(self.worker._held_dials), 2)
+        self.assertEqual(node.headroom(), 0)
+        while not self.worker._originated_calls:
+            yield self.sleep()
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+        self.assertEqual(len(self.worker._held_dials), 2)
+
+    @inlineCallbacks
+    def test_held_dials_pause_outbound(self):
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("1 session(s) - peak 1\n1 session(s) max\n"))
+        self.worker = yield self.create_worker({
+            'freeswitch_poll_interval': 60,
+            'max_held_dials': 1,
+        })
+        [node] = self.worker.freeswitch_nodes.nodes
+        while node.max_sessions is None:
+            yield self.sleep()
 
         msg = self.tx_helper.make_outbound(
             'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(log_level=logging.WARN) as lc:
+            yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(lc.messages(), [
+            "Holding call to u'54321': no free FreeSwitch sessions",
+            "Pausing outbound messages: 1 calls held (max 1)",
+        ])
 
-        yield self.tx_helper.dispatch_outbound(msg)
-
-        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
-
-        # We are not sending a ChannelAnswer event, but we expect a sendmsg
-        # command to be sent anyway, because wait_for_answer is False
+        factory.add_fixture(
+            EslCommand("api status"),
+            FixtureApiResponse("0 session(s) - peak 1\n1 session(s) max\n"))
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+        with LogCatcher(message='Resuming outbound messages') as lc:
+            yield self.worker.poll_freeswitch_nodes()
+        self.assertEqual(len(lc.messages()), 1)
+        while not self.worker._originated_calls:
+            yield self.sleep()
+
+    @inlineCallbacks
+    def test_create_call_circuit_open(self):
+        self.worker = yield self.create_worker({
+            'freeswitch_endpoint': 'tcp:127.0.0.1:port=1338',
+            'freeswitch_failure_threshold': 1,
+        })
+        [node] = self.worker.freeswitch_nodes.nodes
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(node.client.breaker.state, 'open')
+
+        self.tx_helper.clear_dispatched_events()
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': No FreeSwitch node"
+            " available (default: circuit open)")
+
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.freeswitch.default.circuit'], [2])
+
+    @inlineCallbacks
+    def test_create_call_retried(self):
+        self.worker = yield self.create_worker({
+            'originate_retry_delay': 10,
+        })
+        clock = Clock()
+        self.worker.originate_retries = Scheduler(clock=clock)
+        factory = yield self.esl_helper.mk_server()
+        for reply in ["-ERR NORMAL_TEMPORARY_FAILURE", "+OK uuid-1234"]:
+            factory.add_fixture(
+                EslCommand("api originate /sofia/gateway/yogisip"
+                           " 100 XML default elcid +1234 60"),
+                FixtureApiResponse(reply))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Retrying call') as lc:
+            yield self.tx_helper.dispatch_outbound(msg)
+        [log_msg] = lc.messages()
+        self.assertTrue(log_msg.startswith("Retrying call to u'54321' in "))
+        self.assertTrue(log_msg.endswith(
+            "(attempt 1 of 3): NORMAL_TEMPORARY_FAILURE"))
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(self.worker._originated_calls, {})
+
+        clock.advance(10)
+        while not self.worker._originated_calls:
+            yield self.sleep()
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+        self.assertEqual(self.worker._retrying_messages, {})
+
+    @inlineCallbacks
+    def test_create_call_retries_exhausted(self):
+        self.worker = yield self.create_worker({
+            'originate_max_retries': 1,
+        })
+        clock = Clock()
+        self.worker.originate_retries = Scheduler(clock=clock)
+        factory = yield self.esl_helper.mk_server()
+        for _ in range(2):
+            factory.add_fixture(
+                EslCommand("api originate /sofia/gateway/yogisip"
+                           " 100 XML default elcid +1234 60"),
+                FixtureApiResponse("-ERR SWITCH_CONGESTION"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+        with LogCatcher(message='Could not make call'):
+            clock.advance(self.worker.config.originate_retry_max_delay)
+            [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': -ERR SWITCH_CONGESTION")
+
+    @inlineCallbacks
+    def test_create_call_permanent_failure_not_retried(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("-ERR UNALLOCATED_NUMBER"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': -ERR UNALLOCATED_NUMBER")
+        self.assertEqual(len(self.worker.originate_retries), 0)
+
+    @inlineCallbacks
+    def test_pending_retries_nacked_on_stop(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("-ERR NORMAL_TEMPORARY_FAILURE"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(len(self.worker.originate_retries), 1)
+
+        yield self.worker.stopWorker()
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Transport stopped before retrying call to u'54321'")
+
+    def mk_bulk_message(self, recipients):
+        return self.tx_helper.make_outbound(
+            'foobar', None, '12345', session_event='new',
+            helper_metadata={'voice': {'bulk_recipients': recipients}})
+
+    @inlineCallbacks
+    def wait_for_bulk_dials(self, worker):
+        while worker._bulk_dials:
+            yield self.sleep()
+
+    @inlineCallbacks
+    def test_bulk_dial(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        for i in range(3):
+            factory.add_fixture(
+                EslCommand("api originate /sofia/gateway/yogisip"
+                           " 100 XML default elcid +1234 60"),
+                FixtureApiResponse("+OK uuid-%d" % (i,)))
+
+        msg = self.mk_bulk_message(['1001', '1002', '1003'])
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.wait_for_bulk_dials(self.worker)
+
+        [ack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        calls = sorted(
+            (m['message_id'], m['to_addr'],
+             m['helper_metadata']['voice']['bulk_recipient'],
+             m['helper_metadata']['voice']['bulk_index'])
+            for m in self.worker._originated_calls.values())
+        self.assertEqual(calls, [
+            (msg['message_id'], '1001', '1001', 0),
+            (msg['message_id'], '1002', '1002', 1),
+            (msg['message_id'], '1003', '1003', 2),
+        ])
+
+    @inlineCallbacks
+    def test_bulk_dial_recipient_events(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("-ERR NO_ROUTE_DESTINATION"))
+
+        msg = self.mk_bulk_message(['1001'])
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+            yield self.wait_for_bulk_dials(self.worker)
+
+        [ack, nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(ack['helper_metadata'], {})
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(nack['helper_metadata'], {
+            'voice': {'bulk_recipient': '1001', 'bulk_index': 0}})
+
+    @inlineCallbacks
+    def test_bulk_dial_outbound_not_supported(self):
+        self.worker = yield self.create_worker({
+            'freeswitch_endpoint': None,
+            'originate_parameters': None,
+        })
+        msg = self.mk_bulk_message(['1001'])
+        with LogCatcher(message='Bulk dial not supported'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Bulk dial not supported: no FreeSwitch endpoint or nodes are"
+            " configured for outbound calls")
+        self.assertEqual(self.worker._bulk_dials, {})
+
+    @inlineCallbacks
+    def test_bulk_dial_not_new_session(self):
+        self.worker = yield self.create_worker()
+        msg = self.tx_helper.make_outbound(
+            'foobar', None, '12345', session_event='resume',
+            helper_metadata={'voice': {'bulk_recipients': ['1001']}})
+        with LogCatcher(message='Invalid session_event'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Invalid session_event u'resume' for bulk dial: expected 'new'")
+        self.assertEqual(self.worker._originated_calls, {})
+
+    @inlineCallbacks
+    def test_bulk_dial_invalid_recipients(self):
+        self.worker = yield self.create_worker()
+        msg = self.mk_bulk_message('1001')
+        with LogCatcher(message='Invalid bulk_recipients'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Invalid bulk_recipients u'1001': expected a list of addresses")
+        self.assertEqual(self.worker._bulk_dials, {})
+
+    @inlineCallbacks
+    def test_bulk_dial_waits_for_call_capacity(self):
+        self.worker = yield self.create_worker({'max_concurrent_calls': 1})
+        factory = yield self.esl_helper.mk_server()
+        for i in range(2):
+            factory.add_fixture(
+                EslCommand("api originate /sofia/gateway/yogisip"
+                           " 100 XML default elcid +1234 60"),
+                FixtureApiResponse("+OK uuid-%d" % (i,)))
+
+        msg = self.mk_bulk_message(['1001', '1002'])
+        yield self.tx_helper.dispatch_outbound(msg)
+        while not self.worker._originated_calls:
+            yield self.sleep()
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-0'])
+        self.assertEqual(self.worker._bulk_dials.keys(), [msg['message_id']])
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-0')
+        yield self.wait_for_client_registration(self.worker, 'uuid-0')
+        client.sendDisconnectEvent()
+        yield self.wait_for_bulk_dials(self.worker)
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1'])
+        self.assertEqual(
+            self.worker._originated_calls['uuid-1']['to_addr'], '1002')
+
+    @inlineCallbacks
+    def test_bulk_dial_nacked_on_stop(self):
+        self.worker = yield self.create_worker({'max_concurrent_calls': 1})
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-0"))
+
+        msg = self.mk_bulk_message(['1001', '1002', '1003'])
+        yield self.tx_helper.dispatch_outbound(msg)
+        while not self.worker._originated_calls:
+            yield self.sleep()
+
+        yield self.worker.stopWorker()
+        [ack, nack1, nack2] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            [(nack['user_message_id'], nack['nack_reason'],
+              nack['helper_metadata'])
+             for nack in [nack1, nack2]],
+            [(msg['message_id'],
+              "Transport stopped before dialing u'1002'",
+              {'voice': {'bulk_recipient': '1002', 'bulk_index': 1}}),
+             (msg['message_id'],
+              "Transport stopped before dialing u'1003'",
+              {'voice': {'bulk_recipient': '1003', 'bulk_index': 2}})])
+        self.assertEqual(self.worker._bulk_dials, {})
+
+    @inlineCallbacks
+    def test_create_call_latency_metrics(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.worker._dial_times.keys(), ['uuid-1234'])
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        client.sendChannelAnswerEvent()
+        yield self.wait_for_call_answer(self.worker, 'uuid-1234')
+        self.assertEqual(self.worker._dial_times, {})
+
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.calls.originate_time.count'], [1])
+        self.assertEqual(values['sphex.esl.rtt.api.count'], [1])
+        self.assertEqual(values['sphex.calls.answer_time.count'], [1])
+        self.assertEqual(values['sphex.calls.answer_time.le_1'], [1])
+
+    @inlineCallbacks
+    def test_dial_pacing_waits_for_answer(self):
+        self.worker = yield self.create_worker({
+            'dial_pacing_max_concurrency': 1,
+        })
+        factory = yield self.esl_helper.mk_server()
+        for i in range(2):
+            factory.add_fixture(
+                EslCommand("api originate /sofia/gateway/yogisip"
+                           " 100 XML default elcid +1234 60"),
+                FixtureApiResponse("+OK uuid-%d" % (i,)))
+
+        with LogCatcher(message='Holding call') as lc:
+            for to_addr in ['1001', '1002']:
+                yield self.tx_helper.dispatch_outbound(
+                    self.tx_helper.make_outbound(
+                        'foobar', '12345', to_addr, session_event='new'))
+        self.assertEqual(lc.messages(), [
+            "Holding call to u'1002': dial pacing limit of 1 reached"])
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-0'])
+        self.assertEqual(len(self.worker._held_dials), 1)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 1)
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-0')
+        yield self.wait_for_client_registration(self.worker, 'uuid-0')
+        client.sendChannelAnswerEvent()
+        while 'uuid-1' not in self.worker._originated_calls:
+            yield self.sleep()
+        self.assertEqual(len(self.worker._held_dials), 0)
+        self.assertEqual(self.worker.dial_pacer.answer_rate(), 1.0)
+
+    @inlineCallbacks
+    def test_dial_pacing_answered_before_originate_reply(self):
+        self.worker = yield self.create_uuid_worker({
+            'dial_pacing_max_concurrency': 1,
+        })
+        dialing = defer.Deferred()
+        self.patch(
+            self.worker.freeswitch_nodes, 'api', lambda command: dialing)
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        d = self.worker.handle_outbound_message(msg)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 1)
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        client.sendChannelAnswerEvent()
+        yield client.queue.get()
+        self.assertEqual(self.worker.dial_pacer.in_flight, 0)
+        self.assertEqual(self.worker.dial_pacer.answer_rate(), 1.0)
+
+        [node] = self.worker.freeswitch_nodes.nodes
+        dialing.callback((node, None))
+        yield d
+        self.assertEqual(self.worker.dial_pacer.in_flight, 0)
+
+    @inlineCallbacks
+    def test_dial_pacing_slot_taken_before_recording(self):
+        self.worker = yield self.create_uuid_worker({
+            'dial_pacing_max_concurrency': 2,
+        })
+        uuids = iter('uuid-%d' % (i,) for i in range(4))
+        self.worker.generate_message_id = lambda: next(uuids)
+        recording = []
+
+        def add_originated_call(*args):
+            d = defer.Deferred()
+            recording.append(d)
+            return d
+        self.patch(
+            self.worker.call_state, 'add_originated_call',
+            add_originated_call)
+
+        with LogCatcher(message='Holding call') as lc:
+            ds = [
+                self.worker.handle_outbound_message(
+                    self.tx_helper.make_outbound(
+                        'foobar', '12345', to_addr, session_event='new'))
+                for to_addr in ['1001', '1002', '1003', '1004']]
+        self.assertEqual(lc.messages(), [
+            "Holding call to '1003': dial pacing limit of 2 reached",
+            "Holding call to '1004': dial pacing limit of 2 reached",
+        ])
+        self.assertEqual(len(recording), 2)
+        self.assertEqual(len(self.worker._held_dials), 2)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 2)
+
+        # Failing to record a call releases its slot for a held dial.
+        for d in recording[:2]:
+            d.errback(ValueError("Bad call state"))
+        for d in ds[:2]:
+            yield self.assertFailure(d, ValueError)
+        self.assertEqual(len(recording), 4)
+        self.assertEqual(len(self.worker._held_dials), 0)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 2)
+
+        for d in recording[2:]:
+            d.errback(ValueError("Bad call state"))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 0)
+        self.assertEqual(self.worker._originated_calls, {})
+        self.assertEqual(self.worker._msisdn_mapping, {})
+
+    @inlineCallbacks
+    def test_dial_pacing_slot_released_on_error(self):
+        self.worker = yield self.create_worker({
+            'dial_pacing_max_concurrency': 1,
+        })
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+        self.patch(
+            self.worker.call_state, 'add_originated_call',
+            lambda *args: defer.fail(ValueError("Bad call state")))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.assertFailure(self.worker.dial_message(msg), ValueError)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 0)
+        self.assertTrue(self.worker.dial_pacer.has_slot())
+
+    @inlineCallbacks
+    def test_dial_pacing_backs_off_on_congestion(self):
+        self.worker = yield self.create_worker({
+            'dial_pacing_max_concurrency': 8,
+            'originate_max_retries': 0,
+        })
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("-ERR SWITCH_CONGESTION"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.worker.dial_pacer.state(), {
+            'limit': 4, 'in_flight': 0, 'answer_rate': 0.0,
+            'answer_time': None})
+
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.dial_pacing.limit'], [8, 4])
+        self.assertEqual(values['sphex.dial_pacing.in_flight'], [1, 0])
+
+    @inlineCallbacks
+    def test_dial_pacing_slot_released_on_sweep(self):
+        self.worker = yield self.create_worker({
+            'dial_pacing_max_concurrency': 1,
+        })
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.worker.dial_pacer.in_flight, 1)
+
+        self.worker._call_expiry['uuid-1234'] = 0
+        with LogCatcher(message='was not connected'):
+            yield self.worker.sweep_stale_calls()
+        self.assertEqual(self.worker.dial_pacer.in_flight, 0)
+        self.assertEqual(self.worker.dial_pacer.answer_rate(), 0.0)
+
+    def test_invalid_dial_pacing_limits(self):
+        self.assertRaises(ConfigError, self.create_worker, {
+            'dial_pacing_max_concurrency': 2,
+            'dial_pacing_min_concurrency': 3,
+        })
+
+    @inlineCallbacks
+    def test_create_call_routed_by_prefix(self):
+        self.worker = yield self.create_worker({
+            'originate_routes': {
+                '543': {'call_url': '/sofia/gateway/other', 'timeout': 90},
+            },
+        })
+        self.assertEqual(
+            self.worker.stale_call_ttl,
+            90 + self.worker.config.stale_call_grace)
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/other"
+                       " 100 XML default elcid +1234 90"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+
+    def test_invalid_originate_route(self):
+        self.assertRaises(ConfigError, self.create_worker, {
+            'originate_routes': {'27': 'sofia/gateway/za'},
+        })
+
+    def test_originate_route_missing_parameter(self):
+        self.assertRaises(ConfigError, self.create_worker, {
+            'originate_parameters': {'call_url': '/sofia/gateway/yogisip'},
+            'originate_routes': {'27': {'exten': '100'}},
+        })
+
+    def test_invalid_freeswitch_node(self):
+        self.assertRaises(ConfigError, self.create_worker, {
+            'freeswitch_nodes': [{'name': 'no-endpoint'}],
+        })
+
+    def test_empty_freeswitch_nodes(self):
+        self.assertRaises(ConfigError, self.create_worker, {
+            'freeswitch_nodes': [],
+        })
+
+    @inlineCallbacks
+    def test_client_disconnect_without_answer(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+
+        with LogCatcher(log_level=logging.WARN) as lc:
+            yield self.tx_helper.dispatch_outbound(msg)
+
+        self.assertEqual(lc.messages(), [])
+
+        events = yield self.tx_helper.get_dispatched_events()
+        self.assertEqual(events, [])
+
+        client.sendDisconnectEvent()
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['nack_reason'], 'Unanswered Call')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_wait_for_answer_false(self):
+        '''If the wait_for_answer config field is False, then we shouldn't wait
+        for a ChannelAnswer event before playing media.'''
+        self.worker = yield self.create_worker({'wait_for_answer': False})
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+
+        yield self.tx_helper.dispatch_outbound(msg)
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+
+        # We are not sending a ChannelAnswer event, but we expect a sendmsg
+        # command to be sent anyway, because wait_for_answer is False
+
+        cmd = yield client.queue.get()
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'playback', 'arg': "say:'foobar . '",
+        }))
+
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['sent_message_id'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_sweep_call_never_connected(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.worker._call_expiry.keys(), ['uuid-1234'])
+
+        self.worker.sweep_stale_calls()
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+
+        self.worker._call_expiry['uuid-1234'] = 0
+        self.worker.sweep_stale_calls()
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Call 'uuid-1234' to u'54321' was not connected within 90s")
+        self.assertEqual(self.worker._originated_calls, {})
+        self.assertEqual(self.worker._unanswered_channels, {})
+        self.assertEqual(self.worker._msisdn_mapping, {})
+        self.assertEqual(self.worker._call_expiry, {})
+
+    @inlineCallbacks
+    def test_sweep_call_never_answered(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        r = yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        self.assertTrue(r)
+
+        self.worker._call_expiry['uuid-1234'] = 0
+        self.worker.sweep_stale_calls()
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['nack_reason'], 'Unanswered Call')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(self.worker._unanswered_channels, {})
+        self.assertEqual(self.worker._call_expiry, {})
+
+    @inlineCallbacks
+    def test_sweep_forgets_answered_calls(self):
+        self.worker = yield self.create_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        client.sendChannelAnswerEvent()
+        yield self.wait_for_call_answer(self.worker, 'uuid-1234')
+
+        self.worker._call_expiry['uuid-1234'] = 0
+        self.worker.sweep_stale_calls()
+        self.assertEqual(self.worker._call_expiry, {})
+        self.assertEqual(self.worker._clients.keys(), ['uuid-1234'])
+        self.assertEqual(self.worker._msisdn_mapping, {'uuid-1234': '54321'})
+
+    @inlineCallbacks
+    def test_sweep_registry_size_metrics(self):
+        self.worker = yield self.create_worker()
+        self.worker._originated_calls['uuid-1234'] = {}
+        self.worker.sweep_stale_calls()
+        values = publish_metric_values(self.worker, self.tx_helper)
+        sizes = dict(
+            (name, name_values) for name, name_values in values.iteritems()
+            if name.startswith('sphex.registry.'))
+        self.assertEqual(sizes, {
+            'sphex.registry.clients': [0],
+            'sphex.registry.originated_calls': [1],
+            'sphex.registry.unanswered_channels': [0],
+            'sphex.registry.msisdn_mapping': [0],
+        })
+
+    @inlineCallbacks
+    def test_originated_call_connected_to_other_worker(self):
+        worker_a = yield self.create_worker({'call_state_backend': 'redis'})
+        worker_b = yield self.create_worker({'call_state_backend': 'redis'})
+        worker_b.call_state = worker_a.call_state
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield worker_a.handle_outbound_message(msg)
+
+        client = yield self.esl_helper.mk_client(worker_b, 'uuid-1234')
+        while 'uuid-1234' not in worker_b._unanswered_channels:
+            yield self.sleep()
+        self.assertEqual(worker_b._msisdn_mapping, {'uuid-1234': '54321'})
+
+        client.sendChannelAnswerEvent()
+        cmd = yield client.queue.get()
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'playback', 'arg': "say:'foobar . '",
+        }))
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+
+        worker_a._call_expiry['uuid-1234'] = 0
+        with LogCatcher() as lc:
+            yield worker_a.sweep_stale_calls()
+        self.assertTrue(
+            "Call 'uuid-1234' was connected to another worker"
+            in lc.messages())
+        self.assertEqual(worker_a._originated_calls, {})
+        self.assertEqual(len(self.tx_helper.get_dispatched_events()), 1)
+
+    @inlineCallbacks
+    def test_use_our_generated_uuid_if_in_originate_command(self):
+        '''If our generated uuid is in the resulting originate command, we
+        should use that uuid instead of the one provided by freeswitch.'''
+        self.worker = yield self.create_worker({
+            'originate_parameters': {
+                'call_url': '{{origination_uuid={uuid}}}sofia/gateway/yogisip',
+                'exten': '100',
+                'cid_name': 'elcid',
+                'cid_num': '+1234',
+            },
+        })
+
+        def static_id():
+            return 'test-uuid-1234'
+
+        self.worker.generate_message_id = static_id
+
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand(
+                "api originate {origination_uuid=test-uuid-1234}sofia/gateway/"
+                "yogisip 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK wrong-uuid-1234"))
+
+        uuid = yield self.worker.dial_outbound("+4321")
+        self.assertEqual(uuid, 'test-uuid-1234')
+
+    @inlineCallbacks
+    def test_use_freeswitch_uuid_if_not_in_originate_command(self):
+        '''If the generated uuid is not in the resulting originate command, we
+        should use the uuid from freeswitch instead.import'''
+        self.worker = yield self.create_worker()
+
+        def static_id():
+            return 'wrong-uuid-1234'
+
+        self.worker.generate_message_id = static_id
+
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand(
+                "api originate /sofia/gateway/"
+                "yogisip 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK correct-uuid-1234"))
+
+        uuid = yield self.worker.dial_outbound("+4321")
+        self.assertEqual(uuid, 'correct-uuid-1234')
+
+    def create_uuid_worker(self, config={}):
+        """ Create a worker whose originate commands set the call's UUID,
+        which is always ``uuid-1234``.
+        """
+        d = self.create_worker(dict(config, originate_parameters={
+            'call_url': '{{origination_uuid={uuid}}}sofia/gateway/yogisip',
+            'exten': '100',
+            'cid_name': 'elcid',
+            'cid_num': '+1234',
+        }))
+
+        def patch_uuid(worker):
+            worker.generate_message_id = lambda: 'uuid-1234'
+            return worker
+        return d.addCallback(patch_uuid)
+
+    @inlineCallbacks
+    def test_call_connected_before_originate_reply(self):
+        self.worker = yield self.create_uuid_worker()
+        dialing = defer.Deferred()
+        self.patch(
+            self.worker.freeswitch_nodes, 'api', lambda command: dialing)
 
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        d = self.worker.handle_outbound_message(msg)
+        self.assertEqual(self.worker._originated_calls, {'uuid-1234': msg})
+
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        r = yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        self.assertTrue(r)
+        client.sendChannelAnswerEvent()
         cmd = yield client.queue.get()
         self.assertEqual(cmd, EslCommand.from_dict({
             'type': 'sendmsg', 'name': 'playback', 'arg': "say:'foobar . '",
         }))
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
 
-        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
-        self.assertEqual(ack['event_type'], 'ack')
-        self.assertEqual(ack['sent_message_id'], msg['message_id'])
+        [node] = self.worker.freeswitch_nodes.nodes
+        # The pool charges the node it picks before the originate is sent.
+        node.active_channels += 1
+        dialing.callback((node, None))
+        yield d
+        self.assertEqual(node.active_channels, 1)
+        self.assertEqual(self.worker.active_call_count(), 1)
 
     @inlineCallbacks
-    def test_use_our_generated_uuid_if_in_originate_command(self):
-        '''If our generated uuid is in the resulting originate command, we
-        should use that uuid instead of the one provided by freeswitch.'''
-        self.worker = yield self.create_worker({
+    def test_call_connected_before_untracked_originate_reply(self):
+        self.worker = yield self.create_worker()
+        dialing = defer.Deferred()
+        self.patch(
+            self.worker.freeswitch_nodes, 'api', lambda command: dialing)
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        d = self.worker.handle_outbound_message(msg)
+        client = yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        yield self.wait_for_client_registration(self.worker, 'uuid-1234')
+        [inbound] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(inbound['session_event'], 'new')
+        client.sendChannelAnswerEvent()
+
+        [node] = self.worker.freeswitch_nodes.nodes
+        dialing.callback((node, FreeSwitchClientReply('+OK', 'uuid-1234')))
+        yield d
+        cmd = yield client.queue.get()
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'playback', 'arg': "say:'foobar . '",
+        }))
+        self.assertEqual(self.worker._originated_calls, {})
+        self.assertEqual(self.worker._unanswered_channels, {})
+        self.assertEqual(self.worker._call_expiry, {})
+        self.assertEqual(self.worker._msisdn_mapping, {'uuid-1234': '54321'})
+        self.assertEqual(self.worker.active_call_count(), 1)
+
+        client.sendChannelHangupCompleteEvent(7)
+        client.sendDisconnectEvent()
+        while self.worker._clients:
+            yield self.sleep()
+        self.assertEqual(self.worker.active_call_count(), 0)
+
+    @inlineCallbacks
+    def test_dial_failure_forgets_recorded_call(self):
+        self.worker = yield self.create_uuid_worker()
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand(
+                "api originate {origination_uuid=uuid-1234}sofia/gateway/"
+                "yogisip 100 XML default elcid +1234 60"),
+            FixtureApiResponse("-ERR UNALLOCATED_NUMBER"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(message='Could not make call'):
+            yield self.tx_helper.dispatch_outbound(msg)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(self.worker._originated_calls, {})
+        self.assertEqual(self.worker._unanswered_channels, {})
+        self.assertEqual(self.worker._msisdn_mapping, {})
+        self.assertEqual(self.worker._call_expiry, {})
+        self.assertEqual(self.worker._dial_times, {})
+        pending = yield self.worker.call_state.originated_call_pending(
+            'uuid-1234')
+        self.assertEqual(pending, False)
+        self.assertEqual(self.worker.active_call_count(), 0)
+        [node] = self.worker.freeswitch_nodes.nodes
+        self.assertEqual(node.active_channels, 0)
+
+    @inlineCallbacks
+    def test_originated_call_adopted_by_other_worker(self):
+        worker_a = yield self.create_worker({
+            'call_state_backend': 'redis',
+            'dial_pacing_max_concurrency': 2,
+        })
+        worker_b = yield self.create_worker({'call_state_backend': 'redis'})
+        worker_b.call_state = worker_a.call_state
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield worker_a.handle_outbound_message(msg)
+        [node] = worker_a.freeswitch_nodes.nodes
+        self.assertEqual(node.active_channels, 1)
+        self.assertEqual(worker_a.dial_pacer.in_flight, 1)
+
+        yield self.esl_helper.mk_client(worker_b, 'uuid-1234')
+        while 'uuid-1234' not in worker_b._unanswered_channels:
+            yield self.sleep()
+
+        with LogCatcher() as lc:
+            yield worker_a.sweep_stale_calls()
+        self.assertTrue(
+            "Call 'uuid-1234' was connected to another worker"
+            in lc.messages())
+        self.assertEqual(worker_a._originated_calls, {})
+        self.assertEqual(worker_a._msisdn_mapping, {})
+        self.assertEqual(worker_a._call_expiry, {})
+        self.assertEqual(worker_a.active_call_count(), 0)
+        self.assertEqual(node.active_channels, 0)
+        self.assertEqual(worker_a.dial_pacer.in_flight, 0)
+        self.assertEqual(worker_a.dial_pacer.answer_rate(), None)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_expired_call_adopted_by_other_worker(self):
+        worker_a = yield self.create_worker({
+            'call_state_backend': 'redis',
+            'dial_pacing_max_concurrency': 2,
+        })
+        worker_b = yield self.create_worker({'call_state_backend': 'redis'})
+        worker_b.call_state = worker_a.call_state
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield worker_a.handle_outbound_message(msg)
+        yield self.esl_helper.mk_client(worker_b, 'uuid-1234')
+        while 'uuid-1234' not in worker_b._unanswered_channels:
+            yield self.sleep()
+
+        worker_a._call_expiry['uuid-1234'] = 0
+        with LogCatcher(message='was connected to another worker'):
+            yield worker_a.sweep_stale_calls()
+        self.assertEqual(worker_a.dial_pacer.in_flight, 0)
+        self.assertEqual(worker_a.dial_pacer.answer_rate(), None)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+
+class TestVoiceServerTransportOutboundCallsFastParser(
+        TestVoiceServerTransportOutboundCalls):
+    """ The outbound call tests, with FreeSwitch's replies and calls parsed
+    by EventParser.
+    """
+
+    def create_worker(self, config={}):
+        return super(
+            TestVoiceServerTransportOutboundCallsFastParser,
+            self).create_worker(dict(config, esl_fast_parser=True))
+
+    @inlineCallbacks
+    def test_fast_parser(self):
+        worker = yield self.create_worker()
+        [node] = worker.freeswitch_nodes.nodes
+        self.assertTrue(node.client.factory.fast_parser)
+
+
+class TestVoiceServerTransportAdmissionControl(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
+        self.esl_helper = self.add_helper(EslHelper())
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'freeswitch_endpoint': 'tcp:127.0.0.1:port=1337',
             'originate_parameters': {
-                'call_url': '{{origination_uuid={uuid}}}sofia/gateway/yogisip',
+                'call_url': '/sofia/gateway/yogisip',
                 'exten': '100',
                 'cid_name': 'elcid',
-                'cid_num': '+1234',
+                'cid_num': '+1234'
             },
+            'max_concurrent_calls': 1,
         })
 
-        def static_id():
-            return 'test-uuid-1234'
+    @inlineCallbacks
+    def test_inbound_call_above_limit_rejected(self):
+        yield self.esl_helper.mk_client(self.worker, 'uuid-1')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
 
-        self.worker.generate_message_id = static_id
+        with LogCatcher(log_level=logging.WARN) as lc:
+            client = yield self.esl_helper.mk_client(self.worker, 'uuid-2')
+            cmd = yield client.queue.get()
+            yield client.disconnect_d
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'hangup', 'arg': 'USER_BUSY',
+        }))
+        self.assertEqual(lc.messages(), [
+            "Rejecting call from 'uuid-2': 1 concurrent calls (max 1)",
+        ])
+
+        self.assertEqual(self.worker._clients.keys(), ['uuid-1'])
+        self.assertEqual(
+            len(self.tx_helper.get_dispatched_inbound()), 1)
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.calls.rejected.inbound'], [1.0])
+
+    @inlineCallbacks
+    def test_outbound_call_above_limit_nacked(self):
+        yield self.esl_helper.mk_client(self.worker, 'uuid-1')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+
+        [nack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(nack['event_type'], 'nack')
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'],
+            "Could not make call to client u'54321': 1 concurrent calls"
+            " (max 1)")
+        values = publish_metric_values(self.worker, self.tx_helper)
+        self.assertEqual(values['sphex.calls.rejected.outbound'], [1.0])
 
+    @inlineCallbacks
+    def test_originated_call_admitted_at_limit(self):
         factory = yield self.esl_helper.mk_server()
         factory.add_fixture(
-            EslCommand(
-                "api originate {origination_uuid=test-uuid-1234}sofia/gateway/"
-                "yogisip 100 XML default elcid +1234 60"),
-            FixtureApiResponse("+OK wrong-uuid-1234"))
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
 
-        uuid = yield self.worker.dial_outbound("+4321")
-        self.assertEqual(uuid, 'test-uuid-1234')
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        yield self.tx_helper.dispatch_outbound(msg)
+        self.assertEqual(self.worker.active_call_count(), 1)
+
+        yield self.esl_helper.mk_client(self.worker, 'uuid-1234')
+        while 'uuid-1234' in self.worker._originated_calls:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(self.worker._clients.keys(), ['uuid-1234'])
+        self.assertEqual(self.worker.active_call_count(), 1)
+
+
+class TestVoiceServerTransportLoadShedding(VumiTestCase):
+
+    transport_class = VoiceServerTransport
 
     @inlineCallbacks
-    def test_use_freeswitch_uuid_if_not_in_originate_command(self):
-        '''If the generated uuid is not in the resulting originate command, we
-        should use the uuid from freeswitch instead.import'''
-        self.worker = yield self.create_worker()
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
+        self.esl_helper = self.add_helper(EslHelper())
+        self.worker = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'freeswitch_endpoint': 'tcp:127.0.0.1:port=1337',
+            'originate_parameters': {
+                'call_url': '/sofia/gateway/yogisip',
+                'exten': '100',
+                'cid_name': 'elcid',
+                'cid_num': '+1234'
+            },
+            'lag_probe_interval': 60,
+            'lag_shed_threshold': 0.5,
+            'lag_shed_samples': 1,
+        })
 
-        def static_id():
-            return 'wrong-uuid-1234'
+    @inlineCallbacks
+    def test_inbound_call_rejected_while_lagging(self):
+        self.worker.lag_monitor.record_lag(1.0)
+        with LogCatcher(log_level=logging.WARN) as lc:
+            client = yield self.esl_helper.mk_client(self.worker, 'uuid-1')
+            cmd = yield client.queue.get()
+            yield client.disconnect_d
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'hangup', 'arg': 'USER_BUSY',
+        }))
+        self.assertEqual(lc.messages(), [
+            "Rejecting call from 'uuid-1': reactor lag 1.000s (max 0.500s)",
+        ])
+        self.assertEqual(self.worker._clients, {})
 
-        self.worker.generate_message_id = static_id
+    @inlineCallbacks
+    def test_outbound_not_paused_while_lagging(self):
+        factory = yield self.esl_helper.mk_server()
+        factory.add_fixture(
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+        with LogCatcher(log_level=logging.WARN) as lc:
+            self.worker.lag_monitor.record_lag(1.0)
+            yield self.tx_helper.dispatch_outbound(
+                self.tx_helper.make_outbound(
+                    'foobar', '12345', '54321', session_event='new'))
+        self.assertEqual(lc.messages(), [
+            "Holding call to u'54321': reactor lag 1.000s (max 0.500s)",
+        ])
+        self.assertEqual(self.worker._outbound_paused, False)
+
+        # Messages for calls in progress are still handled.
+        reply = self.tx_helper.make_outbound(
+            'foobar', '12345', 'uuid-1', session_event='resume')
+        yield self.tx_helper.dispatch_outbound(reply)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], reply['message_id'])
 
+        self.worker.lag_monitor.record_lag(0.0)
+        while not self.worker._originated_calls:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(factory.fixtures, [])
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+
+    @inlineCallbacks
+    def test_originate_held_while_lagging(self):
         factory = yield self.esl_helper.mk_server()
         factory.add_fixture(
-            EslCommand(
-                "api originate /sofia/gateway/"
-                "yogisip 100 XML default elcid +1234 60"),
-            FixtureApiResponse("+OK correct-uuid-1234"))
+            EslCommand("api originate /sofia/gateway/yogisip"
+                       " 100 XML default elcid +1234 60"),
+            FixtureApiResponse("+OK uuid-1234"))
+        with LogCatcher(log_level=logging.WARN):
+            self.worker.lag_monitor.record_lag(1.0)
 
-        uuid = yield self.worker.dial_outbound("+4321")
-        self.assertEqual(uuid, 'correct-uuid-1234')
+        msg = self.tx_helper.make_outbound(
+            'foobar', '12345', '54321', session_event='new')
+        with LogCatcher(log_level=logging.WARN) as lc:
+            d = self.worker.originate(msg)
+        self.assertEqual(lc.messages(), [
+            "Holding call to '54321': reactor lag 1.000s (max 0.500s)",
+        ])
+        self.assertEqual(d.called, False)
+        self.assertEqual(len(self.worker._held_dials), 1)
+
+        self.worker.lag_monitor.record_lag(0.0)
+        yield d
+        self.assertEqual(len(self.worker._held_dials), 0)
+        self.assertEqual(self.worker._originated_calls.keys(), ['uuid-1234'])
+
+    @inlineCallbacks
+    def test_held_dials_nacked_on_stop(self):
+        with LogCatcher(log_level=logging.WARN):
+            self.worker.lag_monitor.record_lag(1.0)
+            msg = self.tx_helper.make_outbound(
+                'foobar', '12345', '54321', session_event='new')
+            d = self.worker.originate(msg)
+
+        yield self.worker.stopWorker()
+        self.assertEqual(d.called, True)
+        [nack] = self.tx_helper.get_dispatched_events()
+        self.assertEqual(nack['user_message_id'], msg['message_id'])
+        self.assertEqual(
+            nack['nack_reason'], "Transport stopped before dialing '54321'")
+
+
+class TestVoiceServerTransportCallLimits(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
+        self.esl_helper = self.add_helper(EslHelper())
+
+    @inlineCallbacks
+    def mk_call(self, **config):
+        config['twisted_endpoint'] = 'tcp:port=0'
+        self.worker = yield self.tx_helper.get_transport(config)
+        self.clock = Clock()
+        self.worker.call_limits = Scheduler(clock=self.clock)
+        self.client = yield self.esl_helper.mk_client(self.worker)
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+
+    @inlineCallbacks
+    def assert_call_reaped(self, reason):
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(msg['helper_metadata']['voice'], {
+            'hangup_reason': reason,
+        })
+        cmd = yield self.client.queue.get()
+        self.assertEqual(cmd, EslCommand.from_dict({
+            'type': 'sendmsg', 'name': 'hangup', 'arg': 'ALLOTTED_TIMEOUT',
+        }))
+        self.assertEqual(self.worker._clients, {})
+        self.assertEqual(len(self.worker.call_limits), 0)
+
+    @inlineCallbacks
+    def test_no_limits(self):
+        yield self.mk_call()
+        self.assertEqual(len(self.worker.call_limits), 0)
+
+    @inlineCallbacks
+    def test_idle_call_reaped(self):
+        yield self.mk_call(max_call_idle=10)
+        with LogCatcher(log_level=logging.WARN) as lc:
+            self.clock.advance(10)
+        [warn_log, timeline_log] = lc.messages()
+        self.assertEqual(warn_log, "Hanging up call 'test-uuid': idle_timeout")
+        self.assertTrue(timeline_log.startswith(
+            "Timeline for call 'test-uuid' (idle_timeout):\n"))
+        yield self.assert_call_reaped('idle_timeout')
+
+    @inlineCallbacks
+    def test_input_resets_idle_timer(self):
+        yield self.mk_call(max_call_idle=10)
+        self.clock.advance(9)
+        self.client.sendDtmfEvent('5')
+        yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.tx_helper.clear_dispatched_inbound()
+
+        self.clock.advance(9)
+        self.assertEqual(self.worker._clients.keys(), ['test-uuid'])
+        self.clock.advance(1)
+        yield self.assert_call_reaped('idle_timeout')
+
+    @inlineCallbacks
+    def test_idle_timer_stopped_during_output(self):
+        yield self.mk_call(max_call_idle=10)
+        client = self.worker.get_client('test-uuid')
+        playing = defer.Deferred()
+        self.patch(client, 'playback', lambda url: playing)
+        msg = self.tx_helper.make_outbound(
+            'hello', to_addr='test-uuid', helper_metadata={
+                'voice': {'speech_url': 'http://example.com/long.mp3'},
+            })
+        d = self.worker.send_outbound_message(client, msg)
+        self.clock.advance(30)
+        self.assertEqual(self.worker._clients.keys(), ['test-uuid'])
+
+        playing.callback(None)
+        yield d
+        self.clock.advance(9)
+        self.assertEqual(self.worker._clients.keys(), ['test-uuid'])
+        self.clock.advance(1)
+        yield self.assert_call_reaped('idle_timeout')
+
+    @inlineCallbacks
+    def test_max_call_duration(self):
+        yield self.mk_call(max_call_duration=30, max_call_idle=10)
+        for _ in range(3):
+            self.clock.advance(9)
+            self.client.sendDtmfEvent('5')
+            yield self.tx_helper.wait_for_dispatched_inbound(1)
+            self.tx_helper.clear_dispatched_inbound()
+        self.clock.advance(3)
+        yield self.assert_call_reaped('max_duration')
+
+    @inlineCallbacks
+    def test_deregister_cancels_limits(self):
+        yield self.mk_call(max_call_duration=30, max_call_idle=10)
+        self.assertEqual(len(self.worker.call_limits), 2)
+        self.client.sendDisconnectEvent()
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['helper_metadata'].get('voice'), None)
+        self.assertEqual(len(self.worker.call_limits), 0)
+
+
+class TestVoiceServerTransportReusePort(VumiTestCase):
+
+    transport_class = VoiceServerTransport
+
+    def setUp(self):
+        if not reuse_port_supported():
+            raise SkipTest("SO_REUSEPORT not supported.")
+        self.tx_helper = self.add_helper(TransportHelper(self.transport_class))
+
+    @inlineCallbacks
+    def test_shared_port(self):
+        worker_a = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=0',
+            'listen_reuse_port': True,
+        })
+        port = worker_a.voice_server.getHost().port
+        worker_b = yield self.tx_helper.get_transport({
+            'twisted_endpoint': 'tcp:port=%d' % (port,),
+            'listen_reuse_port': True,
+        })
+        self.assertEqual(worker_b.voice_server.getHost().port, port)
+
+    def test_unsupported_endpoint(self):
+        self.assertRaises(ConfigError, self.tx_helper.get_transport, {
+            'twisted_endpoint': 'unix:/tmp/vxfreeswitch.sock',
+            'listen_reuse_port': True,
+        })
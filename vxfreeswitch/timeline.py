@@ -0,0 +1,62 @@
+# -*- test-case-name: vxfreeswitch.tests.test_timeline -*-
+
+"""
+Recent events and commands for a call, kept for post-mortem debugging.
+"""
+
+import time
+from collections import deque
+
+
+class CallTimeline(object):
+    """ A fixed-size ring buffer of timestamped events and commands.
+
+    Recording an entry only appends a tuple to a bounded deque; nothing is
+    formatted until the timeline is dumped, so it is cheap enough to keep
+    for every call.
+
+    :param int size:
+        The most recent entries to keep.
+
+    :param clock:
+        A function returning the current time in seconds.
+    """
+
+    __slots__ = ('clock', '_entries', 'dropped')
+
+    def __init__(self, size, clock=time.time):
+        self.clock = clock
+        self._entries = deque(maxlen=size)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, kind, name, detail=None):
+        """ Record an entry. ``kind`` is e.g. ``'event'``, ``'command'`` or
+        ``'reply'``, ``name`` the event or command name and ``detail`` any
+        further information.
+        """
+        if len(self._entries) == self._entries.maxlen:
+            self.dropped += 1
+        self._entries.append((self.clock(), kind, name, detail))
+
+    def entries(self):
+        return list(self._entries)
+
+    def format(self):
+        """ Return the entries as lines of text, with times in seconds
+        relative to the first entry kept.
+        """
+        if not self._entries:
+            return []
+        start = self._entries[0][0]
+        lines = []
+        if self.dropped:
+            lines.append("(%d earlier entries dropped)" % (self.dropped,))
+        for timestamp, kind, name, detail in self._entries:
+            line = "%+.3fs %s %s" % (timestamp - start, kind, name)
+            if detail is not None:
+                line += " %s" % (detail,)
+            lines.append(line)
+        return lines
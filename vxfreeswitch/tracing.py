@@ -0,0 +1,137 @@
+# -*- test-case-name: vxfreeswitch.tests.test_tracing -*-
+
+"""
+Tracing the time from a caller's input to the start of the prompt played in
+reply.
+"""
+
+import json
+import random
+import time
+from collections import OrderedDict
+
+from vxfreeswitch.metrics import Histogram
+
+
+class FirstAudioTracer(object):
+    """ Times the steps between an inbound message (a new call or the
+    caller's input) and the start of playback of the application's reply.
+
+    A trace is started for each inbound message and found again through the
+    reply's ``in_reply_to``. Each trace records the time it reached these
+    points:
+
+    * ``input``: the transport received the call or input.
+    * ``published``: the inbound message was published to the application.
+    * ``reply``: the transport received the application's reply.
+    * ``media_sent``: the playback command was sent to FreeSwitch, after any
+      text-to-speech.
+    * ``media_started``: FreeSwitch started playing the reply.
+
+    When a trace reaches ``media_started`` the time between points is
+    observed in a histogram for each of :attr:`SPANS`, and a sample of traces
+    is written to a file.
+
+    :param int max_pending:
+        The most traces to keep waiting for a reply. The oldest are dropped
+        first, so replies that never come don't use memory for long.
+
+    :param float sample_rate:
+        The fraction (between 0 and 1) of finished traces to write to
+        ``trace_file``.
+
+    :param trace_file:
+        A file-like object to write sampled traces to, one JSON object per
+        line, or ``None``.
+    """
+
+    POINTS = ('input', 'published', 'reply', 'media_sent', 'media_started')
+
+    # (name, from point, to point)
+    SPANS = (
+        ('transport', 'input', 'published'),
+        ('application', 'published', 'reply'),
+        ('media_prep', 'reply', 'media_sent'),
+        ('media_start', 'media_sent', 'media_started'),
+        ('total', 'input', 'media_started'),
+    )
+
+    def __init__(self, max_pending=10000, sample_rate=0.0, trace_file=None,
+                 clock=time.time, rand=random.random):
+        self.max_pending = max_pending
+        self.sample_rate = sample_rate
+        self.trace_file = trace_file
+        self.clock = clock
+        self.rand = rand
+        self.histograms = OrderedDict(
+            (name, Histogram('trace.%s' % (name,)))
+            for name, _, _ in self.SPANS)
+        self._pending = OrderedDict()
+        self._replies = {}
+
+    def register(self, manager):
+        for histogram in self.histograms.values():
+            histogram.register(manager)
+        return self
+
+    def start(self, message_id, call_uuid):
+        """ Start a trace for an inbound message. """
+        if len(self._pending) >= self.max_pending:
+            _, trace = self._pending.popitem(last=False)
+            self._replies.pop(trace.get('reply_id'), None)
+        self._pending[message_id] = {
+            'call_uuid': call_uuid,
+            'message_id': message_id,
+            'points': {'input': self.clock()},
+        }
+
+    def mark(self, message_id, point):
+        trace = self._pending.get(message_id)
+        if trace is not None:
+            trace['points'][point] = self.clock()
+
+    def reply(self, reply_id, in_reply_to):
+        """ Continue the trace for ``in_reply_to`` with its reply, which is
+        then marked with its own ``reply_id``.
+        """
+        trace = self._pending.get(in_reply_to)
+        if trace is None:
+            return
+        trace['reply_id'] = reply_id
+        trace['points']['reply'] = self.clock()
+        self._replies[reply_id] = in_reply_to
+
+    def mark_reply(self, reply_id, point):
+        message_id = self._replies.get(reply_id)
+        if message_id is not None:
+            self.mark(message_id, point)
+
+    def finish_reply(self, reply_id):
+        """ Finish the trace for a reply whose playback started. """
+        message_id = self._replies.pop(reply_id, None)
+        if message_id is None:
+            return
+        trace = self._pending.pop(message_id)
+        points = trace['points']
+        points['media_started'] = self.clock()
+        trace['spans'] = spans = {}
+        for name, start, end in self.SPANS:
+            if start in points and end in points:
+                spans[name] = points[end] - points[start]
+                self.histograms[name].observe(spans[name])
+        if self.trace_file is not None and self.rand() < self.sample_rate:
+            self.trace_file.write(json.dumps(trace) + "\n")
+
+    def discard_reply(self, reply_id):
+        """ Drop the trace for a reply that won't be played. """
+        message_id = self._replies.pop(reply_id, None)
+        if message_id is not None:
+            self._pending.pop(message_id, None)
+
+    def percentiles(self, qs=(50, 90, 99)):
+        """ Return ``{span: {q: seconds}}`` estimated from every finished
+        trace.
+        """
+        return dict(
+            (name, dict((q, histogram.percentile(q)) for q in qs))
+            for name, histogram in self.histograms.iteritems())
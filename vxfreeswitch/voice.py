@@ -15,55 +15,199 @@ sent as inbound messages. Digits may either be sent through individually
 import logging
 import md5
 import os
+import re
+import time
+from collections import deque
 
+from twisted.internet import reactor
+from twisted.internet.endpoints import clientFromString
 from twisted.internet.protocol import ServerFactory
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, gatherResults)
+    inlineCallbacks, returnValue, Deferred, DeferredLock, DeferredSemaphore,
+    gatherResults, succeed)
+from twisted.internet.task import LoopingCall
 from twisted.internet.utils import getProcessOutput
+from twisted.python.failure import Failure
 
 from eventsocket import EventProtocol
 
 from confmodel.errors import ConfigError
-from confmodel.fields import ConfigText, ConfigDict, ConfigBool
+from confmodel.fields import (
+    ConfigText, ConfigDict, ConfigList, ConfigBool, ConfigInt, ConfigFloat)
 
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, Count, Timer, AVG, MAX)
 from vumi.transports import Transport
 from vumi.message import TransportUserMessage
-from vumi.config import ConfigClientEndpoint, ConfigServerEndpoint
+from vumi.config import ConfigClientEndpoint
 from vumi.errors import VumiError
+from vumi.persist.txredis_manager import TxRedisManager
 
 from vxfreeswitch.originate import (
-    OriginateFormatter, OriginateMissingParameter)
-from vxfreeswitch.client import FreeSwitchClient, FreeSwitchClientError
+    OriginateFormatter, OriginateMissingParameter, backoff_delay,
+    originate_failure_cause)
+from vxfreeswitch.calllog import CallLogger, parse_level
+from vxfreeswitch.callstate import MemoryCallStateStore, RedisCallStateStore
+from vxfreeswitch.client import FreeSwitchClientError
+from vxfreeswitch.eslcapture import CaptureWriter, EslCaptureMixin
+from vxfreeswitch.eslparser import EventParser, EventParserMixin
+from vxfreeswitch.esltiming import CommandTimer, TimedCommandsMixin
+from vxfreeswitch.lag import ReactorLagMonitor
+from vxfreeswitch.metrics import Gauge, Histogram
+from vxfreeswitch.nodes import FreeSwitchNode, FreeSwitchNodePool
+from vxfreeswitch.pacing import DialPacer
+from vxfreeswitch.reuseport import (
+    ConfigListenEndpoint, listen_reuse_port, reuse_port_supported)
+from vxfreeswitch.routing import OriginateRouter
+from vxfreeswitch.scheduler import Scheduler
+from vxfreeswitch.timeline import CallTimeline
+from vxfreeswitch.tracing import FirstAudioTracer
 
 
 class VoiceError(VumiError):
     """Raised when errors occur while processing voice messages."""
 
 
-class FreeSwitchESLProtocol(EventProtocol):
+class CallState(object):
+    """ The state of one call, kept by its :class:`FreeSwitchESLProtocol`.
+
+    The protocol's Twisted and eventsocket base classes give it a
+    ``__dict__``, so the per-call fields live here in ``__slots__``
+    instead.
+    """
+
+    __slots__ = (
+        'uniquecallid', 'logger', 'caller_id_number', 'answered',
+        'request_hang_up', 'input_type', 'digits', 'media_waiters',
+        'playing_media', 'output_lock', 'timeline', 'registration_d')
+
+    def __init__(self, timeline=None):
+        self.uniquecallid = None
+        self.logger = None
+        self.caller_id_number = None
+        self.answered = False
+        self.request_hang_up = False
+        self.input_type = None
+        # DTMF digits collected so far, as a bytearray once there are any.
+        self.digits = None
+        self.media_waiters = ()
+        self.playing_media = False
+        # Held while a message's media is output, so that only one message
+        # at a time waits for media stages on the call.
+        self.output_lock = DeferredLock()
+        self.timeline = timeline
+        self.registration_d = None
+
+
+def call_state_property(name):
+    """ A property for the ``name`` field of a protocol's :class:`CallState`.
+    """
+    return property(
+        lambda self: getattr(self.call, name),
+        lambda self, value: setattr(self.call, name, value))
+
+
+class FreeSwitchESLProtocol(
+        TimedCommandsMixin, EslCaptureMixin, EventParserMixin, EventProtocol):
+
+    # The stages a media command passes through, in order. The final stage is
+    # reached when FreeSwitch replies to the command.
+    MEDIA_STAGES = ('sent', 'started', 'finished')
+    MEDIA_APPS = ('playback', 'play_and_get_digits')
+
+    logger = call_state_property('logger')
+    caller_id_number = call_state_property('caller_id_number')
+    answered = call_state_property('answered')
+    request_hang_up = call_state_property('request_hang_up')
+    input_type = call_state_property('input_type')
+    playing_media = call_state_property('playing_media')
+    output_lock = call_state_property('output_lock')
+    timeline = call_state_property('timeline')
+    registration_d = call_state_property('registration_d')
 
     def __init__(self, vumi_transport):
         EventProtocol.__init__(self)
         self.vumi_transport = vumi_transport
-        self.request_hang_up = False
-        self.current_input = ''
-        self.input_type = None
+        timeline_size = vumi_transport.config.call_timeline_size
+        self.call = CallState(
+            CallTimeline(timeline_size) if timeline_size else None)
+        if vumi_transport.config.esl_fast_parser:
+            self.event_parser = EventParser()
         self.uniquecallid = None
 
+    @property
+    def command_timer(self):
+        return self.vumi_transport.command_timer
+
+    @property
+    def esl_capture(self):
+        return self.vumi_transport.esl_capture
+
+    @property
+    def current_input(self):
+        """ The DTMF digits collected so far for the current input. """
+        digits = self.call.digits
+        return '' if digits is None else str(digits)
+
+    @property
+    def uniquecallid(self):
+        return self.call.uniquecallid
+
+    @uniquecallid.setter
+    def uniquecallid(self, call_uuid):
+        # Bind the call's logger once here rather than adding the call UUID
+        # to every message.
+        self.call.uniquecallid = call_uuid
+        self.call.logger = self.vumi_transport.call_logger.bind(
+            call_uuid=call_uuid)
+
     def unknownContentType(self, content_type, ctx):
-        self.vumi_transport.log.debug(
-            "[eventsocket] unknown Content-Type: %s" % content_type)
+        self.vumi_transport.call_logger.debug(
+            "[eventsocket] unknown Content-Type: %s", content_type)
 
     @inlineCallbacks
     def connectionMade(self):
         yield self.connect().addCallback(self.on_connect)
+        if not self.vumi_transport.admit_client(self):
+            yield self.reject_call()
+            return
         yield self.myevents()
         yield self.answer()
         yield self.vumi_transport.register_client(self)
 
+    @inlineCallbacks
+    def reject_call(self):
+        yield self.hangup(self.vumi_transport.config.reject_hangup_cause)
+        self.transport.loseConnection()
+
+    def command_context(self):
+        return self.uniquecallid
+
+    def command_sent(self, name, args):
+        if self.timeline is not None:
+            self.timeline.record('command', name, args or None)
+
+    def command_replied(self, name, args, error):
+        if self.timeline is None:
+            return
+        if error is not None:
+            self.timeline.record('reply', name, "failed: %s" % (error,))
+        else:
+            self.timeline.record('reply', name)
+
+    def eventReceived(self, ctx):
+        content_type = ctx.get('Content_Type')
+        if self.timeline is not None and content_type not in (
+                None, 'command/reply', 'api/response'):
+            data = ctx.get('data', {})
+            self.timeline.record(
+                'event', data.get('Event_Name') or content_type,
+                data.get('Application') or data.get('DTMF_Digit') or
+                data.get('Hangup_Cause'))
+        return super(FreeSwitchESLProtocol, self).eventReceived(ctx)
+
     def log(self, msg, level=logging.INFO):
-        self.vumi_transport.log.msg(
-            '[%s] %s' % (self.uniquecallid, msg), logLevel=level)
+        self.logger.log(level, msg)
 
     def on_connect(self, ctx):
         self.uniquecallid = ctx.variable_call_uuid
@@ -75,10 +219,12 @@ class FreeSwitchESLProtocol(EventProtocol):
         else:
             if ev.DTMF_Digit == self.input_type:
                 ret_value = self.current_input
-                self.current_input = ''
+                self.call.digits = None
                 return self.vumi_transport.handle_input(self, ret_value)
+            elif self.call.digits is None:
+                self.call.digits = bytearray(ev.DTMF_Digit)
             else:
-                self.current_input += ev.DTMF_Digit
+                self.call.digits.extend(ev.DTMF_Digit)
 
     def create_tts_command(self, command_template, filename, message):
         params = {"filename": filename, "text": message}
@@ -93,11 +239,14 @@ class FreeSwitchESLProtocol(EventProtocol):
         key = md5.md5(message).hexdigest()
         filename = os.path.join(folder, "voice-%s.%s" % (key, ext))
         if not os.path.exists(filename):
-            self.log("Generating voice file %r" % (filename,))
+            self.logger.info("Generating voice file %r", filename)
             cmd, args = self.create_tts_command(command, filename, message)
+            start_time = time.time()
             yield getProcessOutput(cmd, args=args)
+            self.vumi_transport.latencies['tts_generation'].observe(
+                time.time() - start_time)
         else:
-            self.log("Using cached voice file %r" % (filename,))
+            self.logger.info("Using cached voice file %r", filename)
 
         yield self.output_stream(filename, settings)
 
@@ -135,7 +284,7 @@ class FreeSwitchESLProtocol(EventProtocol):
         return self.stream_text_as_speech(text, settings=settings)
 
     def output_stream(self, message, settings={}):
-        self.log("Playing back: %r" % (message,))
+        self.logger.info("Playing back: %r", message)
         if settings.get('barge_in'):
             terminator = settings.get('wait_for')
             if terminator is None:
@@ -153,11 +302,37 @@ class FreeSwitchESLProtocol(EventProtocol):
             # We have to have an invalid response message, so we set it to
             # 1ms of silence
             invalid_message = 'silence_stream://1'
-            return self.execute('play_and_get_digits', ' '.join([
+            d = self.execute('play_and_get_digits', ' '.join([
                 str(minimum), str(maximum), str(tries), str(timeout),
                 str(terminator), message, invalid_message]))
         else:
-            return self.playback(message)
+            d = self.playback(message)
+        self.media_stage_reached('sent')
+        return d
+
+    def wait_for_media(self, stage):
+        """Return a Deferred that fires with ``True`` once the next media
+        command reaches the given stage, or with ``False`` if the command
+        completes (or fails) without the stage being seen.
+        """
+        d = Deferred()
+        self.call.media_waiters += ((stage, d),)
+        return d
+
+    def media_stage_reached(self, stage):
+        rank = self.MEDIA_STAGES.index(stage)
+        waiters, self.call.media_waiters = self.call.media_waiters, ()
+        for waiter_stage, d in waiters:
+            if self.MEDIA_STAGES.index(waiter_stage) <= rank:
+                d.callback(True)
+            else:
+                self.call.media_waiters += ((waiter_stage, d),)
+
+    def release_media_waiters(self, result):
+        waiters, self.call.media_waiters = self.call.media_waiters, ()
+        for _, d in waiters:
+            d.callback(False)
+        return result
 
     def set_input_type(self, input_type):
         self.input_type = input_type
@@ -165,35 +340,40 @@ class FreeSwitchESLProtocol(EventProtocol):
     def close_call(self):
         self.request_hang_up = True
 
+    def onChannelExecute(self, ev):
+        if ev.get('Application') in self.MEDIA_APPS:
+            self.media_stage_reached('started')
+
     @inlineCallbacks
     def onChannelExecuteComplete(self, ev):
-        self.log("execute complete: %s" % ev.Application)
+        self.logger.info("execute complete: %s", ev.Application)
         if self.request_hang_up:
             yield self.hangup()
 
     def onChannelHangupComplete(self, ev):
-        self.log("Channel HangUp")
+        self.logger.info("Channel HangUp")
+        self.vumi_transport.record_hangup(self, ev.get('Hangup_Cause'))
         try:
             answered_time = int(ev.get('Caller_Channel_Answered_Time'))
             hangup_time = int(ev.get('Caller_Channel_Hangup_Time'))
             duration = hangup_time - answered_time
         except (TypeError, ValueError):
-            self.log(
-                "Unable to get call duration for %r" % self.get_address(),
-                level=logging.WARNING)
+            self.logger.warning(
+                "Unable to get call duration for %r", self.get_address())
             duration = None
         self.vumi_transport.deregister_client(self, duration)
 
     def onDisconnect(self, ev):
-        self.log("Channel disconnect received")
+        self.logger.info("Channel disconnect received")
         self.vumi_transport.deregister_client(self)
 
     def onChannelAnswer(self, ev):
-        self.log("Channel answered")
+        self.logger.info("Channel answered")
+        self.answered = True
         self.vumi_transport.client_answered(self)
 
     def unboundEvent(self, evdata, evname):
-        self.log("Unbound event %r" % (evname,), level=logging.DEBUG)
+        self.logger.debug("Unbound event %r", evname)
 
 
 class FreeSwitchESLFactory(ServerFactory):
@@ -243,11 +423,18 @@ class VoiceServerTransportConfig(Transport.CONFIG_CLASS):
         "Specify the file extension used for cached voice files (only affects"
         " tts_type 'local').", default="wav", static=True)
 
-    twisted_endpoint = ConfigServerEndpoint(
+    twisted_endpoint = ConfigListenEndpoint(
         "The endpoint the voice transport will listen on (and that Freeswitch"
         " will connect to).",
         required=True, default="tcp:port=8084", static=True)
 
+    listen_reuse_port = ConfigBool(
+        "Set SO_REUSEPORT on the listening socket so that several transport"
+        " processes (each with its own transport name) can listen on the"
+        " same port. The kernel spreads incoming calls between them."
+        " Requires a 'tcp' or 'tcp6' twisted_endpoint.",
+        default=False, static=True)
+
     freeswitch_endpoint = ConfigClientEndpoint(
         "The endpoint the voice transport will send originate commands"
         "to (and that Freeswitch listens on).",
@@ -258,6 +445,58 @@ class VoiceServerTransportConfig(Transport.CONFIG_CLASS):
         " None means no authentication credentials are offered.",
         default=None, static=True)
 
+    freeswitch_nodes = ConfigList(
+        "A list of FreeSwitch nodes to originate outbound calls on, instead"
+        " of the single freeswitch_endpoint. Each node is a dict with an"
+        " 'endpoint' and optional 'name', 'auth' (defaults to"
+        " freeswitch_auth), 'weight' (defaults to 1) and 'max_channels'"
+        " (defaults to no limit). Calls go to the node with the fewest active"
+        " calls relative to its weight.",
+        default=None, static=True)
+
+    originate_max_retries = ConfigInt(
+        "How many times to retry an originate that fails with one of the"
+        " originate_retry_causes before nacking the message.",
+        default=3, static=True)
+
+    originate_retry_causes = ConfigList(
+        "FreeSwitch hangup causes that an originate is retried for. Other"
+        " failures are nacked straight away.",
+        default=[
+            'NORMAL_TEMPORARY_FAILURE', 'SWITCH_CONGESTION',
+            'NORMAL_CIRCUIT_CONGESTION', 'GATEWAY_DOWN'],
+        static=True)
+
+    originate_retry_delay = ConfigFloat(
+        "Seconds to wait before the first originate retry. The delay doubles"
+        " for each further retry and is jittered to between half and all of"
+        " that.",
+        default=5, static=True)
+
+    originate_retry_max_delay = ConfigFloat(
+        "The longest delay (in seconds) between originate retries.",
+        default=300, static=True)
+
+    freeswitch_failure_threshold = ConfigInt(
+        "The number of consecutive failures to connect to a FreeSwitch node"
+        " after which its circuit breaker opens. While it is open, calls"
+        " fail over to other nodes (or fail immediately if there are none)"
+        " without trying to connect. None disables the circuit breaker.",
+        default=3, static=True)
+
+    freeswitch_node_retry_interval = ConfigFloat(
+        "Seconds a FreeSwitch node's circuit breaker stays open for before"
+        " a single connection is tried again.",
+        default=30, static=True)
+
+    freeswitch_poll_interval = ConfigFloat(
+        "How often (in seconds) to ask each FreeSwitch node for its session"
+        " count and limit (with the 'status' API command). While no node has"
+        " free sessions, new originates are held. Nodes that can't be"
+        " polled are not used until they are polled again successfully."
+        " None disables polling.",
+        default=None, static=True)
+
     originate_parameters = ConfigDict(
         "The parameters to pass to the originate command when initiating"
         " outbound calls. This dictionary of parameters is passed to the"
@@ -271,28 +510,271 @@ class VoiceServerTransportConfig(Transport.CONFIG_CLASS):
         },
         default=None, static=True)
 
+    originate_routes = ConfigDict(
+        "Originate parameters for particular destinations, keyed by address"
+        " prefix. Each route's parameters override originate_parameters for"
+        " addresses starting with its prefix (e.g. to send them through a"
+        " different gateway). The longest matching prefix is used.",
+        default={}, static=True)
+
     wait_for_answer = ConfigBool(
         "If True, the transport waits for a ChannelAnswer event for outbound "
         "(originated) calls before playing any media.",
         default=True, static=True)
 
+    ack_mode = ConfigText(
+        "When to acknowledge outbound messages. 'sent' acknowledges as soon"
+        " as the media command has been sent to Freeswitch, 'started' when"
+        " Freeswitch reports that playback has started and 'finished' when"
+        " Freeswitch replies to the media command.",
+        default="finished", static=True)
+
+    max_concurrent_calls = ConfigInt(
+        "The maximum number of concurrent calls (connected calls plus calls"
+        " being originated) this transport worker will handle. Inbound calls"
+        " above the limit are hung up and outbound calls are nacked. None"
+        " means no limit.",
+        default=None, static=True)
+
+    reject_hangup_cause = ConfigText(
+        "The Freeswitch hangup cause used when rejecting calls above"
+        " max_concurrent_calls.",
+        default="USER_BUSY", static=True)
+
+    bulk_dial_concurrency = ConfigInt(
+        "The most originates to have in progress at once for each bulk dial"
+        " message.",
+        default=10, static=True)
+
+    dial_pacing_max_concurrency = ConfigInt(
+        "The most originates to have in progress (dialed but not yet"
+        " answered or failed) at once. The limit starts here and is lowered"
+        " when calls fail with dial_pacing_congestion_causes or too few are"
+        " answered, and raised again as calls are answered. None disables"
+        " dial pacing.",
+        default=None, static=True)
+
+    dial_pacing_min_concurrency = ConfigInt(
+        "The lowest the dial pacing limit may be lowered to.",
+        default=1, static=True)
+
+    dial_pacing_window = ConfigInt(
+        "The number of recent outbound calls that the answer rate is"
+        " measured over.",
+        default=20, static=True)
+
+    dial_pacing_target_answer_rate = ConfigFloat(
+        "The answer rate (between 0 and 1) below which the dial pacing limit"
+        " is lowered instead of raised.",
+        default=0.5, static=True)
+
+    dial_pacing_max_answer_time = ConfigFloat(
+        "The average seconds from dialing to answer above which the dial"
+        " pacing limit is no longer raised. None means no limit.",
+        default=None, static=True)
+
+    dial_pacing_congestion_causes = ConfigList(
+        "FreeSwitch hangup causes that lower the dial pacing limit straight"
+        " away.",
+        default=[
+            'NORMAL_TEMPORARY_FAILURE', 'SWITCH_CONGESTION',
+            'NORMAL_CIRCUIT_CONGESTION'],
+        static=True)
+
+    lag_probe_interval = ConfigFloat(
+        "How often (in seconds) to measure reactor lag.",
+        default=1.0, static=True)
+
+    lag_shed_threshold = ConfigFloat(
+        "Reactor lag (in seconds) above which the transport sheds load by"
+        " rejecting new inbound calls and holding new originates. None"
+        " disables load shedding.",
+        default=None, static=True)
+
+    lag_shed_samples = ConfigInt(
+        "The number of consecutive lag measurements that must exceed"
+        " lag_shed_threshold before load is shed.",
+        default=3, static=True)
+
+    max_held_dials = ConfigInt(
+        "The most new originates to hold while dialing is paused (by reactor"
+        " lag, a lack of free FreeSwitch sessions or the dial pacing limit)."
+        " While this many are held, the transport stops consuming outbound"
+        " messages.",
+        default=100, static=True)
+
+    max_call_idle = ConfigInt(
+        "Seconds a call may go without input from the caller or a message"
+        " from the application before it is hung up. None means no limit.",
+        default=None, static=True)
+
+    max_call_duration = ConfigInt(
+        "Seconds a call may last before it is hung up. None means no"
+        " limit.",
+        default=None, static=True)
+
+    stale_call_grace = ConfigInt(
+        "Seconds, in addition to the originate timeout, to wait for an"
+        " originated call to connect and be answered before it is"
+        " considered lost and its message is nacked.",
+        default=30, static=True)
+
+    stale_call_sweep_interval = ConfigFloat(
+        "How often (in seconds) to look for lost originated calls.",
+        default=10.0, static=True)
+
+    call_state_backend = ConfigText(
+        "Where to keep call state that must be shared between transport"
+        " workers. Either 'memory' (for a single worker) or 'redis' (for"
+        " several workers sharing Freeswitch outbound socket connections).",
+        default="memory", static=True)
+
+    redis_manager = ConfigDict(
+        "How to connect to Redis (only affects call_state_backend 'redis')."
+        " Workers that share call state must use the same key_prefix.",
+        default={}, static=True)
+
+    metrics_prefix = ConfigText(
+        "Prefix for the names of metrics published by this transport."
+        " Defaults to the transport name followed by a '.'.",
+        default=None, static=True)
+
+    metrics_interval = ConfigInt(
+        "How often (in seconds) to publish metrics.",
+        default=5, static=True)
+
+    esl_slow_command_threshold = ConfigFloat(
+        "Seconds after which an ESL command that FreeSwitch hasn't replied"
+        " to is logged as slow when the reply arrives. None disables the"
+        " log messages (round-trip times are always published as esl.rtt.*"
+        " metrics).",
+        default=None, static=True)
+
+    esl_fast_parser = ConfigBool(
+        "Parse the data FreeSwitch sends, both on calls and on connections"
+        " made to originate calls, with vxfreeswitch's buffer-based parser"
+        " instead of eventsocket's line-based one.",
+        default=False, static=True)
+
+    esl_capture_file = ConfigText(
+        "File to capture the ESL traffic on calls and on connections made to"
+        " originate calls to, for replaying with benchmarks/bench_replay.py."
+        " The file is overwritten when the transport starts. None disables"
+        " capturing.",
+        default=None, static=True)
+
+    call_log_level = ConfigText(
+        "The minimum level (DEBUG, INFO, WARNING, ...) of per-call log"
+        " messages, such as those for each event on a call. Messages below"
+        " it are dropped before they are formatted.",
+        default="DEBUG", static=True)
+
+    call_timeline_size = ConfigInt(
+        "The number of recent events and commands to keep for each call."
+        " They are logged when something goes wrong with the call (an"
+        " error, a nack or an abnormal hangup). 0 disables the timeline.",
+        default=64, static=True)
+
+    call_timeline_normal_hangup_causes = ConfigList(
+        "FreeSwitch hangup causes that don't log the call's timeline.",
+        default=['NORMAL_CLEARING'], static=True)
+
+    trace_file = ConfigText(
+        "File to append sampled time-to-first-audio traces to, one JSON"
+        " object per line. None disables writing traces (the trace.*"
+        " metrics are still published).",
+        default=None, static=True)
+
+    trace_sample_rate = ConfigFloat(
+        "The fraction (between 0 and 1) of time-to-first-audio traces to"
+        " write to trace_file.",
+        default=0.01, static=True)
+
+    trace_max_pending = ConfigInt(
+        "The most time-to-first-audio traces to keep while waiting for the"
+        " application's reply.",
+        default=10000, static=True)
+
     @property
     def supports_outbound(self):
-        return self.freeswitch_endpoint is not None
+        return (self.freeswitch_endpoint is not None or
+                self.freeswitch_nodes is not None)
+
+    def freeswitch_node_configs(self):
+        """ Return the FreeSwitch nodes to originate calls on, with their
+        endpoints parsed.
+        """
+        if self.freeswitch_nodes is None:
+            return [{
+                'name': 'default',
+                'endpoint': self.freeswitch_endpoint,
+                'auth': self.freeswitch_auth,
+            }]
+        node_configs = []
+        for node in self.freeswitch_nodes:
+            if not isinstance(node, dict) or 'endpoint' not in node:
+                raise ConfigError(
+                    "Invalid FreeSwitch node %r, expected a dict with an"
+                    " 'endpoint'." % (node,))
+            try:
+                endpoint = clientFromString(reactor, node['endpoint'])
+            except ValueError:
+                raise ConfigError(
+                    "Invalid FreeSwitch node endpoint %r." % (
+                        node['endpoint'],))
+            node = dict(node, endpoint=endpoint)
+            node.setdefault('name', str(len(node_configs)))
+            node.setdefault('auth', self.freeswitch_auth)
+            node_configs.append(node)
+        return node_configs
 
     def post_validate(self):
         super(VoiceServerTransportConfig, self).post_validate()
         required_outbound = (
-            self.freeswitch_endpoint is not None,
+            self.supports_outbound,
             self.originate_parameters is not None)
         if self.supports_outbound and not all(required_outbound):
             raise ConfigError(
                 "If any outbound message parameters are supplied"
-                " (freeswitch_endpoint or originate_params), all must be"
-                " given.")
+                " (freeswitch_endpoint or freeswitch_nodes, and"
+                " originate_params), all must be given.")
+        if self.freeswitch_nodes is not None:
+            if not self.freeswitch_nodes:
+                raise ConfigError("freeswitch_nodes must not be empty.")
+            self.freeswitch_node_configs()
+        if self.ack_mode not in FreeSwitchESLProtocol.MEDIA_STAGES:
+            raise ConfigError(
+                "Invalid ack_mode %r, expected one of %r." % (
+                    self.ack_mode, FreeSwitchESLProtocol.MEDIA_STAGES))
+        if self.listen_reuse_port and (
+                not reuse_port_supported() or
+                self.twisted_endpoint.address is None):
+            raise ConfigError(
+                "listen_reuse_port requires SO_REUSEPORT support and a 'tcp'"
+                " or 'tcp6' twisted_endpoint.")
+        if self.dial_pacing_max_concurrency is not None and not (
+                1 <= self.dial_pacing_min_concurrency <=
+                self.dial_pacing_max_concurrency):
+            raise ConfigError(
+                "dial_pacing_min_concurrency must be at least 1 and no more"
+                " than dial_pacing_max_concurrency.")
+        try:
+            parse_level(self.call_log_level)
+        except ValueError as err:
+            raise ConfigError(str(err))
+        if self.call_state_backend not in ('memory', 'redis'):
+            raise ConfigError(
+                "Invalid call_state_backend %r, expected 'memory' or"
+                " 'redis'." % (self.call_state_backend,))
+        for prefix, parameters in self.originate_routes.iteritems():
+            if not isinstance(parameters, dict):
+                raise ConfigError(
+                    "Invalid originate route %r: %r is not a dict." % (
+                        prefix, parameters))
         if self.originate_parameters is not None:
             try:
-                OriginateFormatter(**self.originate_parameters)
+                OriginateRouter(
+                    self.originate_parameters, self.originate_routes)
             except OriginateMissingParameter as err:
                 raise ConfigError(str(err))
 
@@ -334,28 +816,180 @@ class VoiceServerTransport(Transport):
 
     CONFIG_CLASS = VoiceServerTransportConfig
 
+    esl_capture = None
+
+    REGISTRIES = (
+        'clients', 'originated_calls', 'unanswered_channels',
+        'msisdn_mapping')
+
+    # (key in self.latencies, metric name, histogram buckets)
+    LATENCY_METRICS = (
+        ('answer_time', 'calls.answer_time',
+         (1, 2, 5, 10, 15, 20, 30, 45, 60, 90)),
+        ('duration', 'calls.duration',
+         (5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)),
+        ('originate_time', 'calls.originate_time',
+         Histogram.DEFAULT_BUCKETS),
+        ('tts_generation', 'tts.generation_time', Histogram.DEFAULT_BUCKETS),
+    )
+
     @inlineCallbacks
     def setup_transport(self):
         self._clients = {}
         self._originated_calls = {}
         self._unanswered_channels = {}
         self._msisdn_mapping = {}
+        self._call_expiry = {}
+        self._pending_dials = 0
+        self._recording_dials = 0
+        self._dial_times = {}
+        self._capacity_waiters = []
+        self._bulk_dials = {}
+        self._bulk_dials_stopped = False
+        self._held_dials = deque()
+        self._outbound_paused = False
+        self._stopping = False
 
         self.config = self.get_static_config()
         self._to_addr = self.config.to_addr
         self._transport_type = "voice"
+        self.command_timer = CommandTimer(
+            self.config.esl_slow_command_threshold, self.log)
+        self.call_logger = CallLogger(
+            self.log, parse_level(self.config.call_log_level))
+        if self.config.esl_capture_file is not None:
+            self.esl_capture = CaptureWriter(
+                open(self.config.esl_capture_file, 'wb'))
 
         if self.config.supports_outbound:
-            self.voice_client = FreeSwitchClient(
-                self.config.freeswitch_endpoint, self.config.freeswitch_auth)
-            self.originate_formatter = OriginateFormatter(
-                **self.config.originate_parameters)
+            self.freeswitch_nodes = FreeSwitchNodePool([
+                FreeSwitchNode.from_config(
+                    node_config, self.config.freeswitch_failure_threshold,
+                    self.config.freeswitch_node_retry_interval,
+                    self.command_timer, self.config.esl_fast_parser,
+                    self.esl_capture)
+                for node_config in self.config.freeswitch_node_configs()])
+            self.originate_router = OriginateRouter(
+                self.config.originate_parameters,
+                self.config.originate_routes)
+            originate_timeout = self.originate_router.max_timeout()
+        else:
+            self.freeswitch_nodes = None
+            self.originate_router = None
+            originate_timeout = OriginateFormatter.DEFAULT_PARAMS['timeout']
+        self.stale_call_ttl = originate_timeout + self.config.stale_call_grace
+
+        if self.config.call_state_backend == "redis":
+            self.redis = yield TxRedisManager.from_config(
+                self.config.redis_manager)
+            # Not namespaced by transport name: workers sharing a port have
+            # their own transport names but must see each other's calls.
+            self.call_state = RedisCallStateStore(self.redis)
+        else:
+            self.redis = None
+            self.call_state = MemoryCallStateStore()
+
+        self.metrics = yield self.start_publisher(
+            MetricManager,
+            self.config.metrics_prefix or "%s." % (self.transport_name,),
+            self.config.metrics_interval)
+        self.command_timer.register(self.metrics)
+        self.media_timers = dict(
+            (stage, self.metrics.register(Timer('outbound.media_%s' % stage)))
+            for stage in FreeSwitchESLProtocol.MEDIA_STAGES)
+        self.rejected_counts = dict(
+            (direction, self.metrics.register(
+                Count('calls.rejected.%s' % direction)))
+            for direction in ('inbound', 'outbound'))
+
+        self.lag_monitor = ReactorLagMonitor(
+            self.config.lag_probe_interval,
+            threshold=self.config.lag_shed_threshold,
+            samples=self.config.lag_shed_samples,
+            metric=self.metrics.register(
+                Metric('reactor.lag', [AVG, MAX])),
+            on_change=self.release_held_dials)
+        self.lag_monitor.start()
+
+        self.registry_sizes = dict(
+            (name, self.metrics.register(Metric('registry.%s' % name)))
+            for name in self.REGISTRIES)
+        self.call_limits = Scheduler()
+        self.originate_retries = Scheduler()
+        self._retrying_messages = {}
+        self.retried_count = self.metrics.register(Count('calls.retried'))
+        self.hangup_counts = {}
+        self._trace_file = None
+        if self.config.trace_file is not None:
+            self._trace_file = open(self.config.trace_file, 'a')
+        self.tracer = FirstAudioTracer(
+            max_pending=self.config.trace_max_pending,
+            sample_rate=self.config.trace_sample_rate,
+            trace_file=self._trace_file).register(self.metrics)
+        self.latencies = dict(
+            (name, Histogram(metric_name, buckets).register(self.metrics))
+            for name, metric_name, buckets in self.LATENCY_METRICS)
+        for name, func in [
+                ('calls.active', self.active_call_count),
+                ('calls.unanswered', lambda: len(self._unanswered_channels)),
+                ('calls.pending_originate', lambda: self._pending_dials),
+                ('calls.held', lambda: len(self._held_dials))]:
+            self.metrics.register(Gauge(name, func))
+        self.stale_call_sweeper = LoopingCall(self.sweep_stale_calls)
+        self.stale_call_sweeper.start(
+            self.config.stale_call_sweep_interval, now=False)
+
+        self.freeswitch_poller = None
+        if self.config.supports_outbound:
+            self.node_metrics = dict(
+                (node.name, dict(
+                    (name, self.metrics.register(Metric(
+                        'freeswitch.%s.%s' % (
+                            metric_safe(node.name), name))))
+                    for name in ('sessions', 'max_sessions', 'headroom')))
+                for node in self.freeswitch_nodes.nodes)
+            for node in self.freeswitch_nodes.nodes:
+                # The breaker only half-opens when its state is next read,
+                # so the state is read when metrics are published.
+                if node.client.breaker is not None:
+                    self.metrics.register(Gauge(
+                        'freeswitch.%s.circuit' % metric_safe(node.name),
+                        node.client.breaker.metric_value))
+        self.dial_pacer = None
+        if (self.config.supports_outbound and
+                self.config.dial_pacing_max_concurrency is not None):
+            self.dial_pacer = DialPacer(
+                self.config.dial_pacing_min_concurrency,
+                self.config.dial_pacing_max_concurrency,
+                window=self.config.dial_pacing_window,
+                target_answer_rate=self.config.dial_pacing_target_answer_rate,
+                max_answer_time=self.config.dial_pacing_max_answer_time,
+                congestion_causes=self.config.dial_pacing_congestion_causes,
+                metrics=dict(
+                    (name, self.metrics.register(
+                        Metric('dial_pacing.%s' % (name,))))
+                    for name in (
+                        'limit', 'in_flight', 'answer_rate', 'answer_time')),
+                on_release=self.release_held_dials)
+        if (self.config.supports_outbound and
+                self.config.freeswitch_poll_interval is not None):
+            self.freeswitch_poller = LoopingCall(self.poll_freeswitch_nodes)
+            self.freeswitch_poller.start(
+                self.config.freeswitch_poll_interval)
+
+        factory = FreeSwitchESLFactory(self)
+        if self.config.listen_reuse_port:
+            self.voice_server = yield listen_reuse_port(
+                self.config.twisted_endpoint.address, factory)
         else:
-            self.voice_client = None
-            self.originate_formatter = None
+            self.voice_server = yield self.config.twisted_endpoint.listen(
+                factory)
 
-        self.voice_server = yield self.config.twisted_endpoint.listen(
-            FreeSwitchESLFactory(self))
+    def teardown_worker(self):
+        # Stop held dials from resuming the connectors while they are being
+        # paused.
+        self._stopping = True
+        return super(VoiceServerTransport, self).teardown_worker()
 
     @inlineCallbacks
     def teardown_transport(self):
@@ -367,6 +1001,99 @@ class VoiceServerTransport(Transport):
             self.voice_server.loseConnection()
             yield gatherResults([
                 client.registration_d for client in self._clients.values()])
+        if getattr(self, '_held_dials', None):
+            held, self._held_dials = self._held_dials, deque()
+            for message, attempt, d in held:
+                yield self.publish_nack(
+                    message['message_id'],
+                    "Transport stopped before dialing %r" % (
+                        message['to_addr'],),
+                    **self.event_fields(message))
+                d.callback(None)
+        if getattr(self, '_bulk_dials', None):
+            # Stop dialing bulk messages, nacking their remaining recipients,
+            # and wait for the originates already in progress.
+            self._bulk_dials_stopped = True
+            waiters, self._capacity_waiters = self._capacity_waiters, []
+            for d in waiters:
+                d.callback(None)
+            yield gatherResults(self._bulk_dials.values())
+        if getattr(self, 'stale_call_sweeper', None) is not None:
+            if self.stale_call_sweeper.running:
+                self.stale_call_sweeper.stop()
+            self.call_limits.stop()
+            self.originate_retries.stop()
+            yield gatherResults([
+                self.publish_nack(
+                    message['message_id'],
+                    "Transport stopped before retrying call to %r" % (
+                        message['to_addr'],),
+                    **self.event_fields(message))
+                for message in self._retrying_messages.values()])
+            self._retrying_messages.clear()
+        if getattr(self, 'freeswitch_poller', None) is not None:
+            if self.freeswitch_poller.running:
+                self.freeswitch_poller.stop()
+        if hasattr(self, 'lag_monitor'):
+            self.lag_monitor.stop()
+        if hasattr(self, 'metrics'):
+            self.metrics.stop()
+        if getattr(self, '_trace_file', None) is not None:
+            self._trace_file.close()
+            self._trace_file = None
+        if self.esl_capture is not None:
+            self.esl_capture.close()
+            self.esl_capture = None
+        if getattr(self, 'redis', None) is not None:
+            yield self.redis.close_manager()
+
+    def active_call_count(self):
+        return (
+            len(self._clients) + len(self._originated_calls) +
+            self._pending_dials)
+
+    def has_call_capacity(self):
+        max_calls = self.config.max_concurrent_calls
+        return max_calls is None or self.active_call_count() < max_calls
+
+    def wait_for_call_capacity(self):
+        """Return a Deferred that fires once there is room for another call
+        (or immediately if there is room already).
+        """
+        if self.has_call_capacity():
+            return succeed(None)
+        d = Deferred()
+        self._capacity_waiters.append(d)
+        return d
+
+    def release_capacity_waiters(self):
+        if not self._capacity_waiters or not self.has_call_capacity():
+            return
+        waiters, self._capacity_waiters = self._capacity_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def admit_client(self, client):
+        """Return ``True`` if the client's call may be handled, or ``False``
+        if it should be rejected because the worker is at capacity.
+
+        Calls we originated were counted when they were dialed, so they are
+        always admitted.
+        """
+        client_addr = client.get_address()
+        if client_addr in self._originated_calls:
+            return True
+        if self.lag_monitor.overloaded:
+            reason = "reactor lag %.3fs (max %.3fs)" % (
+                self.lag_monitor.lag, self.config.lag_shed_threshold)
+        elif not self.has_call_capacity():
+            reason = "%d concurrent calls (max %d)" % (
+                self.active_call_count(), self.config.max_concurrent_calls)
+        else:
+            return True
+        self.log.warning("Rejecting call from %r: %s" % (client_addr, reason))
+        self.rejected_counts['inbound'].inc()
+        return False
 
     @inlineCallbacks
     def register_client(self, client):
@@ -374,17 +1101,38 @@ class VoiceServerTransport(Transport):
         # fire it after we're finished with our own deregistration process.
         client.registration_d = Deferred()
         client_addr = client.get_address()
-        self.log.info("Registering client connected from %r" % (client_addr,))
+        self.call_logger.info(
+            "Registering client connected from %r", client_addr)
         self._clients[client_addr] = client
+        if self.config.max_call_duration is not None:
+            self.call_limits.schedule(
+                (client_addr, 'duration'), self.config.max_call_duration,
+                self.reap_call, client, 'max_duration')
+        self.reset_idle_timer(client)
         originated_msg = self._originated_calls.pop(client_addr, None)
+        claimed = yield self.call_state.claim_originated_call(client_addr)
+        if originated_msg is None and claimed is not None:
+            originated_msg = self.adopt_originated_call(client, *claimed)
         if originated_msg is not None:
             yield self.send_outbound_message(client, originated_msg)
         else:
             self.send_inbound_message(
                 client, None, TransportUserMessage.SESSION_NEW)
-        self.log.info("Registration complete.")
+        self.call_logger.info("Registration complete.")
 
-    def deregister_client(self, client, duration=None):
+    def adopt_originated_call(self, client, message, msisdn):
+        """Take over a call that another transport worker originated."""
+        client_addr = client.get_address()
+        self.log.info(
+            "Adopting call %r originated by another worker" % (client_addr,))
+        self._msisdn_mapping[client_addr] = msisdn
+        if self.config.wait_for_answer and not client.answered:
+            self._unanswered_channels[client_addr] = Deferred()
+            self._call_expiry[client_addr] = (
+                time.time() + self.stale_call_ttl)
+        return message
+
+    def deregister_client(self, client, duration=None, hangup_reason=None):
         client_addr = client.get_address()
 
         # If originated call has not yet been answered
@@ -392,33 +1140,77 @@ class VoiceServerTransport(Transport):
             d = self._unanswered_channels[client_addr]
             d.errback(FreeSwitchClientError('Call is unanswered'))
 
+        if self.freeswitch_nodes is not None:
+            self.freeswitch_nodes.call_ended(client_addr)
+        if self.dial_pacer is not None:
+            self.dial_pacer.call_ended(client_addr)
+        self._dial_times.pop(client_addr, None)
         if client_addr not in self._clients:
             return
-        self.log.info(
-            "Deregistering client connected from %r" % (client_addr,))
+        self.call_logger.info(
+            "Deregistering client connected from %r", client_addr)
         del self._clients[client_addr]
+        if duration is not None:
+            # FreeSwitch's channel times are in microseconds.
+            self.latencies['duration'].observe(duration / 1000000.0)
+        self.call_limits.cancel((client_addr, 'duration'))
+        self.call_limits.cancel((client_addr, 'idle'))
 
         self.send_inbound_message(
-            client, None, TransportUserMessage.SESSION_CLOSE, duration)
+            client, None, TransportUserMessage.SESSION_CLOSE, duration,
+            hangup_reason)
         client.registration_d.callback(None)
         # Delete the msisdn mapping if it exists
         self._msisdn_mapping.pop(client_addr, None)
-        self.log.info("Deregistration complete.")
+        self._call_expiry.pop(client_addr, None)
+        self.release_capacity_waiters()
+        self.call_logger.info("Deregistration complete.")
+
+    def reset_idle_timer(self, client):
+        client_addr = client.get_address()
+        if (self.config.max_call_idle is not None and
+                self._clients.get(client_addr) is client and
+                not client.playing_media):
+            self.call_limits.schedule(
+                (client_addr, 'idle'), self.config.max_call_idle,
+                self.reap_call, client, 'idle_timeout')
+
+    def reap_call(self, client, reason):
+        """Hang up and deregister a call that has exceeded one of its
+        limits. The reason is passed on to the application in the
+        SESSION_CLOSE message.
+        """
+        self.log.warning(
+            "Hanging up call %r: %s" % (client.get_address(), reason))
+        self.dump_call_timeline(client, reason)
+        self.deregister_client(client, hangup_reason=reason)
+        d = client.hangup('ALLOTTED_TIMEOUT')
+        d.addErrback(
+            self.log.err, "Error hanging up call %r" % (client.get_address(),))
 
     def handle_input(self, client, text):
+        self.reset_idle_timer(client)
         self.send_inbound_message(
             client, text, TransportUserMessage.SESSION_RESUME)
 
-    def send_inbound_message(self, client, text, session_event, duration=None):
+    def send_inbound_message(self, client, text, session_event, duration=None,
+                             hangup_reason=None):
         helper_metadata = {}
         if duration:
             if not helper_metadata.get('voice'):
                 helper_metadata['voice'] = voice = {}
             voice['call_duration'] = duration
+        if hangup_reason is not None:
+            voice = helper_metadata.setdefault('voice', {})
+            voice['hangup_reason'] = hangup_reason
 
         helper_metadata['caller_id_number'] = client.get_caller_id_number()
 
+        message_id = self.generate_message_id()
+        if session_event != TransportUserMessage.SESSION_CLOSE:
+            self.tracer.start(message_id, client.get_address())
         self.publish_message(
+            message_id=message_id,
             from_addr=self._msisdn_mapping.get(
                 client.get_address(), client.get_address()),
             to_addr=self._to_addr,
@@ -428,12 +1220,35 @@ class VoiceServerTransport(Transport):
             transport_type=self._transport_type,
             helper_metadata=helper_metadata,
         )
+        self.tracer.mark(message_id, 'published')
+
+    def event_fields(self, message):
+        """Return the extra fields for events about ``message``. Events
+        about a recipient of a bulk dial message have the bulk message's ID,
+        so the recipient is given in their ``helper_metadata``.
+        """
+        voice = get_in(message, 'helper_metadata', 'voice', default={})
+        if 'bulk_recipient' not in voice:
+            return {}
+        return {'helper_metadata': {'voice': {
+            'bulk_recipient': voice['bulk_recipient'],
+            'bulk_index': voice['bulk_index'],
+        }}}
+
+    def dial_key(self, message):
+        """Return the key to track an originate for ``message`` by, which
+        is distinct for each recipient of a bulk dial message.
+        """
+        voice = get_in(message, 'helper_metadata', 'voice', default={})
+        if 'bulk_index' not in voice:
+            return message['message_id']
+        return (message['message_id'], voice['bulk_index'])
 
     @inlineCallbacks
     def log_and_nack(self, message, error):
         self.log.warning(error)
         yield self.publish_nack(
-            message["message_id"], reason=error)
+            message["message_id"], reason=error, **self.event_fields(message))
 
     @inlineCallbacks
     def send_outbound_message(self, client, message):
@@ -444,7 +1259,6 @@ class VoiceServerTransport(Transport):
         content = content.encode('utf-8')
 
         voicemeta = get_in(message, 'helper_metadata', 'voice', default={})
-        client.set_input_type(voicemeta.get('wait_for', None))
         overrideURL = voicemeta.get('speech_url', None)
 
         # Wait if call isn't answered
@@ -452,37 +1266,147 @@ class VoiceServerTransport(Transport):
             try:
                 yield self._unanswered_channels.get(client.get_address())
             except FreeSwitchClientError:
+                self.dump_call_timeline(client, "unanswered")
                 yield self.publish_nack(
-                    message['message_id'], 'Unanswered Call')
+                    message['message_id'], 'Unanswered Call',
+                    **self.event_fields(message))
                 returnValue(None)
             finally:
-                self._unanswered_channels.pop(client.get_address())
+                self._unanswered_channels.pop(client.get_address(), None)
 
         if overrideURL is None:
-            yield client.output_message("%s\n" % content, voicemeta)
+            media = None
         elif isinstance(overrideURL, basestring):
-            yield client.output_stream(overrideURL, voicemeta)
+            media = overrideURL
         elif isinstance(overrideURL, list):
             try:
-                urllist = 'file_string://%s' % '!'.join(overrideURL)
-                yield client.output_stream(urllist, voicemeta)
+                media = 'file_string://%s' % '!'.join(overrideURL)
             except TypeError:
                 error = "Invalid URL list %r" % overrideURL
                 yield self.log_and_nack(message, error)
+                self.dump_call_timeline(client, error)
                 return
         else:
             error = "Invalid URL %r" % overrideURL
             yield self.log_and_nack(message, error)
+            self.dump_call_timeline(client, error)
             return
 
+        # A message that arrives while another is being output waits for it
+        # to finish, as FreeSwitch would, rather than sharing its media
+        # waiters.
+        yield client.output_lock.acquire()
+        try:
+            client.set_input_type(voicemeta.get('wait_for', None))
+            # The caller isn't idle while they listen, however long the
+            # prompt is.
+            client.playing_media = True
+            self.call_limits.cancel((client.get_address(), 'idle'))
+            start_time = time.time()
+            stage_ds = {}
+            for stage in FreeSwitchESLProtocol.MEDIA_STAGES[:-1]:
+                stage_ds[stage] = client.wait_for_media(stage).addCallback(
+                    self.record_media_stage, stage, start_time).addCallback(
+                    self.trace_media_stage, stage, message['message_id'])
+
+            if media is None:
+                output_d = client.output_message("%s\n" % content, voicemeta)
+            else:
+                output_d = client.output_stream(media, voicemeta)
+            output_d.addBoth(client.release_media_waiters)
+            output_d.addErrback(self._dump_timeline_on_error, client)
+
+            acked = False
+            if self.config.ack_mode in stage_ds:
+                reached = yield stage_ds[self.config.ack_mode]
+                if reached:
+                    yield self.publish_ack(
+                        message["message_id"], message["message_id"],
+                        **self.event_fields(message))
+                    acked = True
+
+            yield output_d
+            self.record_media_stage(True, 'finished', start_time)
+        finally:
+            client.playing_media = False
+            client.output_lock.release()
+            self.reset_idle_timer(client)
+
         if message['session_event'] == TransportUserMessage.SESSION_CLOSE:
             client.close_call()
 
-        yield self.publish_ack(message["message_id"], message["message_id"])
+        if not acked:
+            yield self.publish_ack(
+                message["message_id"], message["message_id"],
+                **self.event_fields(message))
+
+    def trace_media_stage(self, reached, stage, message_id):
+        if stage == 'sent' and reached:
+            self.tracer.mark_reply(message_id, 'media_sent')
+        elif stage == 'started':
+            if reached:
+                self.tracer.finish_reply(message_id)
+            else:
+                self.tracer.discard_reply(message_id)
+        return reached
+
+    def dump_call_timeline(self, client, reason):
+        """Log a call's recent events and commands."""
+        if client.timeline is None or not len(client.timeline):
+            return
+        self.log.warning("Timeline for call %r (%s):\n  %s" % (
+            client.get_address(), reason,
+            "\n  ".join(client.timeline.format())))
+
+    def get_client(self, addr):
+        """Return the connected call with the given address (its call UUID
+        or, for an originated call, the number dialed), or ``None``.
+        """
+        return self._clients.get(
+            reverse_dict_lookup(self._msisdn_mapping, addr) or addr)
+
+    def call_timeline(self, call_uuid):
+        """Return the timeline of a connected call as lines of text, or
+        ``None`` if the call isn't connected to this worker.
+        """
+        client = self._clients.get(call_uuid)
+        if client is None or client.timeline is None:
+            return None
+        return client.timeline.format()
+
+    def record_hangup(self, client, cause):
+        self.count_hangup(cause)
+        if cause not in self.config.call_timeline_normal_hangup_causes:
+            self.dump_call_timeline(client, "hangup cause %s" % (cause,))
+
+    def count_hangup(self, cause):
+        """Count a call that hung up with the given FreeSwitch cause."""
+        cause = metric_safe(cause or 'UNKNOWN')
+        count = self.hangup_counts.get(cause)
+        if count is None:
+            count = self.hangup_counts[cause] = self.metrics.register(
+                Count('calls.hangup.%s' % (cause,)))
+        count.inc()
+
+    def _dump_timeline_on_error(self, failure, client):
+        self.dump_call_timeline(
+            client, "error: %s" % (failure.getErrorMessage(),))
+        return failure
+
+    def record_media_stage(self, reached, stage, start_time):
+        if reached:
+            self.media_timers[stage].set(time.time() - start_time)
+        return reached
 
     def client_answered(self, client):
         """Function that is called when the ChannelAnswer event is received.
         Fires the deferred related to the outbound call"""
+        self.reset_idle_timer(client)
+        if self.dial_pacer is not None:
+            self.dial_pacer.call_answered(client.get_address())
+        dialed = self._dial_times.pop(client.get_address(), None)
+        if dialed is not None:
+            self.latencies['answer_time'].observe(time.time() - dialed)
         d = self._unanswered_channels.get(client.get_address(), None)
         if d:
             d.callback(None)
@@ -491,38 +1415,424 @@ class VoiceServerTransport(Transport):
                 'Cannot find unanswered channel for %r' % client.get_address())
 
     @inlineCallbacks
-    def dial_outbound(self, to_addr):
+    def dial_outbound(self, to_addr, message=None):
+        """Originate a call to ``to_addr`` and return its UUID.
+
+        If ``message`` is given, the call is recorded as originated for it.
+        FreeSwitch may connect the call before it replies to the originate,
+        so if the originate command sets the call's UUID the call is
+        recorded before it is dialed (and forgotten if the dial fails).
+        """
         call_uuid = self.generate_message_id()
-        command = self.originate_formatter.format_call(
+        command = self.originate_router.format_call(
             self._to_addr, to_addr, call_uuid)
-        self.log.info("Dialing outbound via Freeswitch ESL: %r" % command)
-        reply = yield self.voice_client.api(command)
-        if call_uuid not in command:
-            call_uuid = reply.args[1]
+        recorded = message is not None and call_uuid in command
+        paced = message is not None and self.dial_pacer is not None
+        if paced:
+            # The slot is taken before anything yields, so that held dials
+            # released together can't go over the limit. FreeSwitch only
+            # replies to the originate once the call is answered, so the
+            # pacer also has to start timing the call now.
+            self.dial_pacer.dial_started(call_uuid, time.time())
+        if recorded:
+            # Until the call is sent to a node, this reserves the session
+            # it will take there.
+            self._recording_dials += 1
+            try:
+                yield self.record_originated_call(call_uuid, message)
+            except Exception:
+                self._forget_call(call_uuid)
+                if paced:
+                    self.dial_pacer.dial_cancelled(call_uuid)
+                raise
+            finally:
+                self._recording_dials -= 1
+        else:
+            self._pending_dials += 1
+        self.call_logger.info(
+            "Dialing outbound via Freeswitch ESL: %r", command)
+        start_time = time.time()
+        if recorded:
+            self._dial_times[call_uuid] = start_time
+        node = None
+        try:
+            node, reply = yield self.freeswitch_nodes.api(command)
+            self.latencies['originate_time'].observe(
+                time.time() - start_time)
+            if call_uuid not in command:
+                if paced:
+                    self.dial_pacer.call_renamed(call_uuid, reply.args[1])
+                call_uuid = reply.args[1]
+            if message is not None and not recorded:
+                client = self._clients.get(call_uuid)
+                if client is None:
+                    self._dial_times[call_uuid] = start_time
+                    yield self.record_originated_call(call_uuid, message)
+                else:
+                    self.output_connected_call_message(client, message)
+        except Exception:
+            failure = Failure()
+            if node is not None:
+                self.freeswitch_nodes.release(node)
+            if paced:
+                self.dial_pacer.dial_failed(
+                    call_uuid,
+                    originate_failure_cause(failure.getErrorMessage()))
+            if recorded:
+                yield self.forget_originated_call(call_uuid)
+            failure.raiseException()
+        finally:
+            if not recorded:
+                self._pending_dials -= 1
+        if message is None or (call_uuid in self._originated_calls or
+                               call_uuid in self._clients):
+            self.freeswitch_nodes.call_started(call_uuid, node)
+        else:
+            # The call has already ended or been connected to another
+            # worker.
+            self.freeswitch_nodes.release(node)
+        client = self._clients.get(call_uuid)
+        if paced and not recorded and client is not None and client.answered:
+            # The call was answered before the pacer knew its UUID.
+            self.dial_pacer.call_answered(call_uuid)
+        returnValue(call_uuid)
+
+    def output_connected_call_message(self, client, message):
+        """Output the message of a call that FreeSwitch connected before
+        replying to its originate. The call was registered without it, so
+        it is sent to the call rather than recorded as originated.
+        """
+        client_addr = client.get_address()
+        self._msisdn_mapping[client_addr] = message['to_addr']
+        d = self.send_outbound_message(client, message)
+        d.addErrback(
+            self.log.err, "Error sending message to call %r" % (client_addr,))
+
+    def record_originated_call(self, call_uuid, message):
+        """Record a call originated for ``message``, both locally and where
+        every worker can claim it.
+        """
+        to_addr = message['to_addr']
+        self._originated_calls[call_uuid] = message
         if self.config.wait_for_answer:
             self._unanswered_channels[call_uuid] = Deferred()
         self._msisdn_mapping[call_uuid] = to_addr
-        returnValue(call_uuid)
+        self._call_expiry[call_uuid] = time.time() + self.stale_call_ttl
+        # Keep the shared record for longer than the local one so that the
+        # sweeper always finds it if no worker claims it.
+        return self.call_state.add_originated_call(
+            call_uuid, message, to_addr, 2 * self.stale_call_ttl)
+
+    def forget_originated_call(self, call_uuid):
+        """Remove the records of a call that failed to dial."""
+        self._forget_call(call_uuid)
+        return self.call_state.claim_originated_call(call_uuid)
+
+    def _forget_call(self, call_uuid):
+        self._originated_calls.pop(call_uuid, None)
+        self._unanswered_channels.pop(call_uuid, None)
+        self._msisdn_mapping.pop(call_uuid, None)
+        self._call_expiry.pop(call_uuid, None)
+        self._dial_times.pop(call_uuid, None)
+
+    @inlineCallbacks
+    def poll_freeswitch_nodes(self):
+        """Update the session counts and limits of the FreeSwitch nodes."""
+        yield self.freeswitch_nodes.poll()
+        for node in self.freeswitch_nodes.nodes:
+            if node.max_sessions is None:
+                continue
+            metrics = self.node_metrics[node.name]
+            metrics['sessions'].set(node.sessions)
+            metrics['max_sessions'].set(node.max_sessions)
+            metrics['headroom'].set(node.headroom())
+        self.release_held_dials()
+
+    def sweep_stale_calls(self):
+        """Clean up originated calls that were not connected or answered
+        within their time limit, nacking the messages that started them.
+        """
+        now = time.time()
+        claims = []
+        for call_uuid, expiry in self._call_expiry.items():
+            if call_uuid in self._clients and (
+                    call_uuid not in self._unanswered_channels):
+                # Connected and answered, so the call is no longer ours to
+                # clean up.
+                del self._call_expiry[call_uuid]
+                continue
+            if expiry > now:
+                if call_uuid in self._originated_calls:
+                    d = self.call_state.originated_call_pending(call_uuid)
+                    d.addCallback(self._forget_adopted_call, call_uuid)
+                    d.addErrback(
+                        self.log.err,
+                        "Error checking call %r" % (call_uuid,))
+                    claims.append(d)
+                continue
+            del self._call_expiry[call_uuid]
+            if call_uuid in self._clients:
+                # If send_outbound_message is waiting for the answer, it will
+                # nack the message.
+                d = self._unanswered_channels.pop(call_uuid)
+                d.addErrback(lambda f: None)
+                d.errback(FreeSwitchClientError('Call is unanswered'))
+                continue
+            self._unanswered_channels.pop(call_uuid, None)
+            self._msisdn_mapping.pop(call_uuid, None)
+            self.freeswitch_nodes.call_ended(call_uuid)
+            self._dial_times.pop(call_uuid, None)
+            message = self._originated_calls.pop(call_uuid, None)
+            if message is None:
+                if self.dial_pacer is not None:
+                    self.dial_pacer.call_ended(call_uuid)
+                continue
+            # Whether the call went unanswered depends on whether another
+            # worker picked it up.
+            d = self.call_state.claim_originated_call(call_uuid)
+            d.addCallback(self._nack_stale_call, call_uuid, message)
+            d.addErrback(
+                self.log.err,
+                "Error cleaning up stale call %r" % (call_uuid,))
+            claims.append(d)
+
+        for name in self.REGISTRIES:
+            self.registry_sizes[name].set(len(getattr(self, '_' + name)))
+        self.release_capacity_waiters()
+        return gatherResults(claims)
+
+    def _forget_adopted_call(self, pending, call_uuid):
+        # The call may have been connected to this worker (or failed to
+        # dial) while we were checking.
+        if pending or call_uuid not in self._originated_calls:
+            return
+        self.log.info(
+            "Call %r was connected to another worker" % (call_uuid,))
+        self._forget_call(call_uuid)
+        self.freeswitch_nodes.call_ended(call_uuid)
+        if self.dial_pacer is not None:
+            self.dial_pacer.call_adopted(call_uuid)
+        self.release_capacity_waiters()
+
+    def _nack_stale_call(self, claimed, call_uuid, message):
+        if claimed is None:
+            self.log.info(
+                "Call %r was connected to another worker" % (call_uuid,))
+            if self.dial_pacer is not None:
+                self.dial_pacer.call_adopted(call_uuid)
+            return
+        if self.dial_pacer is not None:
+            self.dial_pacer.call_ended(call_uuid)
+        return self.log_and_nack(
+            message, "Call %r to %r was not connected within %ds" % (
+                call_uuid, message['to_addr'], self.stale_call_ttl))
+
+    def bulk_recipient_message(self, message, index, to_addr):
+        """Return the message for one recipient of a bulk dial message. It
+        keeps the bulk message's ``message_id``, with the recipient and its
+        index in the list given in ``helper_metadata``, so that acks and
+        nacks can be matched up.
+        """
+        recipient_message = message.copy()
+        recipient_message['to_addr'] = to_addr
+        voice = recipient_message['helper_metadata']['voice']
+        voice['bulk_recipient'] = to_addr
+        voice['bulk_index'] = index
+        return recipient_message
+
+    @inlineCallbacks
+    def handle_bulk_dial(self, message, recipients):
+        """Originate a call to each recipient of a bulk dial message.
+
+        Recipient messages are only created as they are dialed, at most
+        ``bulk_dial_concurrency`` at a time and waiting for call capacity,
+        so a campaign of any size uses a bounded amount of memory.
+        """
+        bulk_id = message['message_id']
+        if not self.config.supports_outbound:
+            yield self.log_and_nack(
+                message, "Bulk dial not supported: no FreeSwitch endpoint or"
+                " nodes are configured for outbound calls")
+            return
+        if message['session_event'] != TransportUserMessage.SESSION_NEW:
+            yield self.log_and_nack(
+                message, "Invalid session_event %r for bulk dial: expected"
+                " %r" % (message['session_event'],
+                         TransportUserMessage.SESSION_NEW))
+            return
+        if (not isinstance(recipients, list) or
+                not all(isinstance(r, basestring) for r in recipients)):
+            yield self.log_and_nack(
+                message, "Invalid bulk_recipients %r: expected a list of"
+                " addresses" % (recipients,))
+            return
+        yield self.publish_ack(bulk_id, bulk_id)
+        self.log.info("Dialing %d recipients of bulk message %r" % (
+            len(recipients), bulk_id))
+        in_progress = DeferredSemaphore(self.config.bulk_dial_concurrency)
+        for index, to_addr in enumerate(recipients):
+            yield in_progress.acquire()
+            while (not self._bulk_dials_stopped and
+                    not self.has_call_capacity()):
+                yield self.wait_for_call_capacity()
+            recipient_message = self.bulk_recipient_message(
+                message, index, to_addr)
+            if self._bulk_dials_stopped:
+                in_progress.release()
+                yield self.publish_nack(
+                    recipient_message['message_id'],
+                    "Transport stopped before dialing %r" % (to_addr,),
+                    **self.event_fields(recipient_message))
+                continue
+            d = self.originate(recipient_message)
+            d.addErrback(
+                self.log.err, "Error dialing %r for bulk message %r" % (
+                    to_addr, bulk_id))
+            d.addBoth(lambda _: in_progress.release())
+        # Wait for the last originates to finish.
+        for _ in range(in_progress.limit):
+            yield in_progress.acquire()
+
+    def schedule_originate_retry(self, message, attempt, cause):
+        delay = backoff_delay(
+            attempt, self.config.originate_retry_delay,
+            self.config.originate_retry_max_delay)
+        self.log.info(
+            "Retrying call to %r in %.1fs (attempt %d of %d): %s" % (
+                message['to_addr'], delay, attempt + 1,
+                self.config.originate_max_retries, cause))
+        self.retried_count.inc()
+        key = self.dial_key(message)
+        self._retrying_messages[key] = message
+        self.originate_retries.schedule(
+            key, delay, self.retry_originate, message, attempt + 1)
+
+    def retry_originate(self, message, attempt):
+        del self._retrying_messages[self.dial_key(message)]
+        d = self.handle_outbound_message(message, attempt)
+        d.addErrback(
+            self.log.err, "Error retrying call to %r" % (message['to_addr'],))
+
+    def dial_held_reason(self):
+        """Return why new originates must be held instead of dialed, or
+        ``None`` if they may be dialed now.
+        """
+        if self.lag_monitor.overloaded:
+            return "reactor lag %.3fs (max %.3fs)" % (
+                self.lag_monitor.lag, self.config.lag_shed_threshold)
+        if not self.freeswitch_nodes.has_headroom(self._recording_dials):
+            return "no free FreeSwitch sessions"
+        if self.dial_pacer is not None and not self.dial_pacer.has_slot():
+            return "dial pacing limit of %d reached" % (
+                self.dial_pacer.current_limit(),)
+        return None
+
+    def originate(self, message, attempt=0):
+        """Dial a call for ``message``, or hold it until dialing resumes.
+        Returns a Deferred that fires once the call has been dialed (or the
+        message nacked).
+        """
+        reason = self.dial_held_reason()
+        if reason is None:
+            return self.dial_message(message, attempt)
+        return self.hold_dial(message, attempt, reason)
+
+    def hold_dial(self, message, attempt, reason):
+        self.log.warning(
+            "Holding call to %r: %s" % (message['to_addr'], reason))
+        d = Deferred()
+        self._held_dials.append((message, attempt, d))
+        self.update_outbound_consumer()
+        return d
+
+    def release_held_dials(self):
+        """Dial held originates for as long as dialing isn't paused."""
+        while self._held_dials and self.dial_held_reason() is None:
+            message, attempt, d = self._held_dials.popleft()
+            self.dial_message(message, attempt).chainDeferred(d)
+        self.update_outbound_consumer()
+
+    def update_outbound_consumer(self):
+        """Stop consuming outbound messages while too many originates are
+        held, and resume once there is room to hold more. Replies to calls
+        in progress are only held up while the consumer is paused, so it
+        isn't paused for reactor lag alone.
+        """
+        paused = len(self._held_dials) >= self.config.max_held_dials
+        if self._stopping or paused == self._outbound_paused:
+            return
+        self._outbound_paused = paused
+        if paused:
+            self.log.warning(
+                "Pausing outbound messages: %d calls held (max %d)" % (
+                    len(self._held_dials), self.config.max_held_dials))
+            d = self.pause_connectors()
+            d.addErrback(self.log.err, "Error pausing outbound messages")
+        else:
+            self.log.info("Resuming outbound messages")
+            self.unpause_connectors()
 
     @inlineCallbacks
-    def handle_outbound_message(self, message):
+    def dial_message(self, message, attempt=0):
         client_addr = message['to_addr']
-        client = self._clients.get(
-            reverse_dict_lookup(self._msisdn_mapping, client_addr) or
-            client_addr)
+        if not self.has_call_capacity():
+            self.rejected_counts['outbound'].inc()
+            yield self.log_and_nack(
+                message, "Could not make call to client %r: %d"
+                " concurrent calls (max %d)" % (
+                    client_addr, self.active_call_count(),
+                    self.config.max_concurrent_calls))
+            return
+        try:
+            yield self.dial_outbound(client_addr, message)
+        except FreeSwitchClientError as e:
+            cause = originate_failure_cause(str(e))
+            if (cause in self.config.originate_retry_causes and
+                    attempt < self.config.originate_max_retries):
+                self.schedule_originate_retry(message, attempt, cause)
+            else:
+                yield self.log_and_nack(
+                    message, "Could not make call to client %r: %s" % (
+                        client_addr, e))
+        finally:
+            self.release_capacity_waiters()
+
+    @inlineCallbacks
+    def handle_outbound_message(self, message, attempt=0):
+        if message.get('in_reply_to') is not None:
+            self.tracer.reply(message['message_id'], message['in_reply_to'])
+        voice = get_in(message, 'helper_metadata', 'voice', default={})
+        if 'bulk_recipients' in voice:
+            # Take the recipients out of the message so that copying it for
+            # each recipient is cheap.
+            bulk_id = message['message_id']
+            recipients = voice.pop('bulk_recipients')
+            d = self.handle_bulk_dial(message, recipients)
+            d.addErrback(
+                self.log.err, "Error in bulk message %r" % (bulk_id,))
+            d.addBoth(lambda _: self._bulk_dials.pop(bulk_id, None))
+            if not d.called:
+                self._bulk_dials[bulk_id] = d
+            return
+
+        client_addr = message['to_addr']
+        client = self.get_client(client_addr)
 
         if (self.config.supports_outbound and
             client is None and
             message.get('session_event') ==
                 TransportUserMessage.SESSION_NEW):
-            try:
-                call_uuid = yield self.dial_outbound(client_addr)
-            except FreeSwitchClientError as e:
-                yield self.log_and_nack(
-                    message, "Could not make call to client %r: %s" % (
-                        client_addr, e))
+            reason = self.dial_held_reason()
+            if reason is None:
+                yield self.dial_message(message, attempt)
             else:
-                self._originated_calls[call_uuid] = message
+                # Outbound messages are handled one at a time, so waiting
+                # here for dialing to resume would hold up the replies to
+                # calls in progress.
+                d = self.hold_dial(message, attempt, reason)
+                d.addErrback(
+                    self.log.err, "Error dialing held call to %r" % (
+                        client_addr,))
             return
 
         if client is None:
@@ -534,6 +1844,10 @@ class VoiceServerTransport(Transport):
         yield self.send_outbound_message(client, message)
 
 
+def metric_safe(name):
+    return re.sub(r'[^\w-]', '_', name)
+
+
 def get_in(d, *args, **kwargs):
     for arg in args:
         d = d.get(arg)